@@ -0,0 +1,313 @@
+'''Synthetic peru projects for the benchmark suite. Each project generates its
+module sources and its peru.yaml under a root dir, using only plugins that
+work offline (cp, empty, and git with local repos), so that the results only
+depend on peru and the machine it runs on.'''
+
+import os
+import subprocess
+
+# Every import is synced somewhere under here.
+IMPORTS_DIR = 'deps'
+
+# How many leaf modules each module of a RecursiveProject imports.
+RECURSIVE_FANOUT = 3
+
+
+def file_paths(num_files, depth):
+    '''Spread the files over a tree with four dirs at each of `depth` levels.
+    A depth of 0 puts them all at the top.'''
+    paths = []
+    for n in range(num_files):
+        dirs = ['d{}'.format((n // 4**level) % 4) for level in range(depth)]
+        paths.append('/'.join(dirs + ['f{}.txt'.format(n)]))
+    return paths
+
+
+def write_files(root, files):
+    for path, content in files.items():
+        full_path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as f:
+            f.write(content)
+
+
+def render_yaml(modules, rules, imports):
+    '''Build peru.yaml text from (type, name, fields) modules, (name, fields)
+    rules and (target, path) imports. Fields are strings, booleans, lists of
+    strings, or dicts of strings.'''
+    lines = ['imports:']
+    lines.extend('    {}: {}'.format(_quote(target), _quote(path))
+                 for target, path in imports)
+    for type, name, fields in modules:
+        lines.append('')
+        lines.append('{} module {}:'.format(type, name))
+        lines.extend(_render_fields(fields))
+    for name, fields in rules:
+        lines.append('')
+        lines.append('rule {}:'.format(name))
+        lines.extend(_render_fields(fields))
+    return '\n'.join(lines) + '\n'
+
+
+def _render_fields(fields):
+    lines = []
+    for field, value in fields.items():
+        if isinstance(value, list):
+            lines.append('    {}:'.format(field))
+            lines.extend('        - ' + _quote(item) for item in value)
+        elif isinstance(value, dict):
+            lines.append('    {}:'.format(field))
+            lines.extend('        {}: {}'.format(_quote(k), _quote(v))
+                         for k, v in value.items())
+        else:
+            lines.append('    {}: {}'.format(field, _quote(value)))
+    return lines
+
+
+def _quote(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+class Project:
+    '''The base class. A project has `num_modules` modules, each of which
+    has about `num_files` files, spread over `depth` levels of dirs.
+    Subclasses fill in module_definitions() and write their sources in
+    generate().'''
+
+    name = None
+    can_reup = False
+
+    def __init__(self, root, num_modules, num_files, depth):
+        self.root = root
+        self.sources = os.path.join(root, 'sources')
+        self.num_modules = num_modules
+        self.num_files = num_files
+        self.depth = depth
+        self.version = 0
+
+    def generate(self):
+        self.write_peru_yaml()
+
+    def write_peru_yaml(self):
+        modules, rules, imports = self.module_definitions()
+        with open(os.path.join(self.root, 'peru.yaml'), 'w') as f:
+            f.write(render_yaml(modules, rules, imports))
+
+    def module_definitions(self):
+        raise NotImplementedError
+
+    def module_files(self, i, version=0):
+        return {
+            path: 'module {} file {} version {}\n'.format(i, path, version)
+            for path in file_paths(self.num_files, self.depth)
+        }
+
+    def change_one_module(self):
+        '''Change the contents of module 0, so that the next sync has to
+        fetch it again and update its files.'''
+        raise NotImplementedError
+
+    def copy_target(self):
+        return 'mod0'
+
+
+class CpProject(Project):
+    '''cp modules, each imported into its own dir.'''
+
+    name = 'flat'
+
+    def generate(self):
+        for i in range(self.num_modules):
+            write_files(self.source_dir(i), self.module_files(i))
+        super().generate()
+
+    def source_dir(self, i):
+        if i == 0 and self.version:
+            return os.path.join(self.sources,
+                                'mod0-v{}'.format(self.version))
+        return os.path.join(self.sources, 'mod{}'.format(i))
+
+    def module_definitions(self):
+        modules = [('cp', 'mod{}'.format(i), {'path': self.source_dir(i)})
+                   for i in range(self.num_modules)]
+        imports = [('mod{}'.format(i), '{}/mod{}/'.format(IMPORTS_DIR, i))
+                   for i in range(self.num_modules)]
+        return modules, [], imports
+
+    def change_one_module(self):
+        # The cp plugin's results are cached by its fields, so the changed
+        # module gets a new path.
+        self.version += 1
+        write_files(self.source_dir(0), self.module_files(0, self.version))
+        self.write_peru_yaml()
+
+
+class DeepProject(CpProject):
+    '''Like the flat project, but with every module's files spread through a
+    much deeper tree.'''
+
+    name = 'deep'
+
+    def __init__(self, root, num_modules, num_files, depth):
+        super().__init__(root, num_modules, num_files, depth * 3)
+
+
+class RulesProject(CpProject):
+    '''cp modules that use every kind of rule field, in default rules and
+    named rules.'''
+
+    name = 'rules'
+
+    def module_files(self, i, version=0):
+        files = {}
+        for path, content in super().module_files(i, version).items():
+            files['src/' + path] = content
+            # Junk for the rules to drop.
+            files['src/' + path[:-len('.txt')] + '.tmp'] = content
+        files['src/run.sh'] = '#! /bin/sh\n'
+        files['docs/README'] = 'module {}\n'.format(i)
+        return files
+
+    def module_definitions(self):
+        modules, _, _ = super().module_definitions()
+        for _, _, fields in modules:
+            fields.update({
+                'copy': {'src/run.sh': 'src/run2.sh'},
+                'move': {'docs': 'src/docs'},
+                'drop': 'src/**/*.tmp',
+                'pick': 'src',
+                'executable': 'src/*.sh',
+                'export': 'src',
+            })
+        rules = [
+            ('text', {'pick': '**/*.txt'}),
+            ('scripts', {'pick': '*.sh', 'executable': '*.sh'}),
+        ]
+        imports = []
+        for i in range(self.num_modules):
+            imports.append(('mod{}|text'.format(i),
+                            '{}/mod{}/text/'.format(IMPORTS_DIR, i)))
+            imports.append(('mod{}|scripts'.format(i),
+                            '{}/mod{}/scripts/'.format(IMPORTS_DIR, i)))
+        return modules, rules, imports
+
+
+class RecursiveProject(CpProject):
+    '''cp modules that are peru projects themselves, each importing a few
+    leaf modules of its own, with `recursive: true`.'''
+
+    name = 'recursive'
+
+    def generate(self):
+        for i in range(self.num_modules):
+            for j in range(RECURSIVE_FANOUT):
+                write_files(self.leaf_dir(i, j),
+                            self.module_files(i * RECURSIVE_FANOUT + j))
+            self.write_module_source(i)
+        self.write_peru_yaml()
+
+    def leaf_dir(self, i, j):
+        return os.path.join(self.sources, 'leaf{}-{}'.format(i, j))
+
+    def write_module_source(self, i):
+        modules = [('cp', 'leaf{}'.format(j), {'path': self.leaf_dir(i, j)})
+                   for j in range(RECURSIVE_FANOUT)]
+        imports = [('leaf{}'.format(j), 'leaf{}/'.format(j))
+                   for j in range(RECURSIVE_FANOUT)]
+        write_files(self.source_dir(i), {
+            'peru.yaml': render_yaml(modules, [], imports),
+            'README': 'module {} version {}\n'.format(i, self.version),
+        })
+
+    def module_definitions(self):
+        modules, rules, imports = super().module_definitions()
+        for _, _, fields in modules:
+            fields['recursive'] = True
+        return modules, rules, imports
+
+    def change_one_module(self):
+        self.version += 1
+        self.write_module_source(0)
+        self.write_peru_yaml()
+
+
+class EmptyProject(Project):
+    '''empty modules, to measure peru's own overhead per module.'''
+
+    name = 'empty'
+
+    def module_definitions(self):
+        modules = [('empty', 'mod{}'.format(i), {})
+                   for i in range(self.num_modules)]
+        imports = [('mod{}'.format(i), '{}/mod{}/'.format(IMPORTS_DIR, i))
+                   for i in range(self.num_modules)]
+        if self.version:
+            modules.append(('empty', 'extra{}'.format(self.version), {}))
+            imports.append(('extra{}'.format(self.version), IMPORTS_DIR))
+        return modules, [], imports
+
+    def change_one_module(self):
+        # There's nothing in an empty module to change. Add one instead.
+        self.version += 1
+        self.write_peru_yaml()
+
+
+class GitProject(Project):
+    '''git modules fetched from local repos, with their revs pinned, so that
+    reup has something to do.'''
+
+    name = 'git'
+    can_reup = True
+
+    def generate(self):
+        self.revs = {}
+        for i in range(self.num_modules):
+            repo = self.repo_dir(i)
+            os.makedirs(repo)
+            _git(repo, 'init', '--quiet')
+            write_files(repo, self.module_files(i))
+            self.revs[i] = _commit(repo, 'version 0')
+        super().generate()
+
+    def repo_dir(self, i):
+        return os.path.join(self.sources, 'repo{}'.format(i))
+
+    def module_definitions(self):
+        modules = [('git', 'mod{}'.format(i), {
+            'url': self.repo_dir(i),
+            'rev': self.revs[i],
+        }) for i in range(self.num_modules)]
+        imports = [('mod{}'.format(i), '{}/mod{}/'.format(IMPORTS_DIR, i))
+                   for i in range(self.num_modules)]
+        return modules, [], imports
+
+    def change_one_module(self):
+        self.version += 1
+        repo = self.repo_dir(0)
+        write_files(repo, {'changed.txt': str(self.version)})
+        self.revs[0] = _commit(repo, 'version {}'.format(self.version))
+        self.write_peru_yaml()
+
+
+def _git(repo, *args):
+    return subprocess.run(
+        ['git', '-c', 'user.name=peru', '-c', 'user.email=peru@example.com']
+        + list(args),
+        cwd=repo,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True).stdout.strip()
+
+
+def _commit(repo, message):
+    _git(repo, 'add', '--all')
+    _git(repo, 'commit', '--quiet', '--message', message)
+    return _git(repo, 'rev-parse', 'HEAD')
+
+
+PROJECTS = [
+    CpProject, DeepProject, RulesProject, RecursiveProject, EmptyProject,
+    GitProject
+]
@@ -0,0 +1,254 @@
+'''Runs the benchmark suite. Each synthetic project from benchmarks/projects.py
+is generated in a temp dir, and then peru is run against it in a fresh process
+for each of these scenarios:
+
+    cold sync      `peru sync` with no cache and nothing synced yet
+    no-op sync     `peru sync` again, with nothing changed
+    single change  `peru sync` after one module's contents change
+    reup           `peru reup --no-sync`, for projects with git modules
+    copy           `peru copy` of one module to a new dir
+
+Every run records its wall time, the number of git commands peru ran on its
+cache (from --profile-git-json), its cache hits and misses (from the last
+--progress-file event), and the peak RSS of peru or any of its child
+processes. The results are written as JSON, to stdout or to --output, so that
+they can be compared across releases. A summary goes to stderr as it runs.
+
+    python -m benchmarks [--projects flat,git] [--modules N] [--files M]
+                         [--depth D] [--repeat R] [--output results.json]
+
+See also benchmarks/startup.py and benchmarks/yaml_startup.py, which measure
+peru's startup in more detail.'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import projects
+from .startup import REPO_ROOT
+
+
+class RunError(Exception):
+    pass
+
+
+def run_peru(cwd, args, work_dir):
+    '''Runs peru once, and returns a dict of its measurements.'''
+    profile_path = os.path.join(work_dir, 'git-profile.json')
+    progress_path = os.path.join(work_dir, 'progress.json')
+    env = {
+        var: val
+        for var, val in os.environ.items() if not var.startswith('PERU_')
+    }
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    for path in (profile_path, progress_path):
+        if os.path.exists(path):
+            os.remove(path)
+    command = [
+        sys.executable, '-m', 'peru', '--quiet',
+        '--profile-git-json=' + profile_path,
+        '--progress-file=' + progress_path
+    ] + args
+    with tempfile.TemporaryFile() as output:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            command,
+            cwd=cwd,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=output,
+            stderr=subprocess.STDOUT)
+        returncode, max_rss_kb = _wait(proc)
+        wall_seconds = time.perf_counter() - start
+        if returncode != 0:
+            output.seek(0)
+            raise RunError('`{}` failed with code {}:\n{}'.format(
+                ' '.join(command), returncode,
+                output.read().decode(errors='replace')))
+    with open(profile_path) as f:
+        profile = json.load(f)
+    with open(progress_path) as f:
+        finished = json.loads(f.read().splitlines()[-1])
+    return {
+        'wall_seconds': wall_seconds,
+        'git_commands': sum(stats['count'] for stats in profile.values()),
+        'max_rss_kb': max_rss_kb,
+        'cache': finished['cache'],
+    }
+
+
+def _wait(proc):
+    '''Returns the exit code of the process and the peak RSS in KB of it or
+    any child it waited for, or None where we can't measure that.'''
+    if not hasattr(os, 'wait4'):
+        return proc.wait(), None
+    _, status, rusage = os.wait4(proc.pid, 0)
+    # Popen would otherwise try to wait for the process again.
+    proc.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status) else
+                       -os.WTERMSIG(status))
+    max_rss = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        # macOS reports bytes rather than KB.
+        max_rss //= 1024
+    return proc.returncode, max_rss
+
+
+def scenarios(project, work_dir):
+    '''Yields (name, prepare) pairs, in the order they have to run. Each
+    prepare function sets up one run and returns the peru args for it.'''
+
+    def cold_sync():
+        shutil.rmtree(os.path.join(project.root, '.peru'), ignore_errors=True)
+        shutil.rmtree(
+            os.path.join(project.root, projects.IMPORTS_DIR),
+            ignore_errors=True)
+        return ['sync']
+
+    def change_one_module():
+        project.change_one_module()
+        return ['sync']
+
+    def copy():
+        dest = tempfile.mkdtemp(dir=work_dir, prefix='copy-')
+        return ['copy', project.copy_target(), dest]
+
+    yield 'cold sync', cold_sync
+    yield 'no-op sync', lambda: ['sync']
+    yield 'single change', change_one_module
+    if project.can_reup:
+        yield 'reup', lambda: ['reup', '--no-sync']
+    yield 'copy', copy
+
+
+def run_project(project_class, args, work_dir):
+    root = os.path.join(work_dir, project_class.name)
+    os.makedirs(root)
+    project = project_class(root, args.modules, args.files, args.depth)
+    project.generate()
+    results = []
+    for name, prepare in scenarios(project, work_dir):
+        runs = []
+        for _ in range(args.repeat):
+            runs.append(run_peru(project.root, prepare(), work_dir))
+        wall_times = [run['wall_seconds'] for run in runs]
+        result = {
+            'project': project.name,
+            'scenario': name,
+            'best_wall_seconds': min(wall_times),
+            'median_wall_seconds': statistics.median(wall_times),
+            'git_commands': max(run['git_commands'] for run in runs),
+            'max_rss_kb': max(run['max_rss_kb'] or 0 for run in runs) or None,
+            'runs': runs,
+        }
+        print_result(result)
+        results.append(result)
+    return results
+
+
+def print_result(result):
+    print(
+        '{:<10} {:<14} {:8.3f}s best {:8.3f}s median {:6} git {:>8} KB'.format(
+            result['project'], result['scenario'],
+            result['best_wall_seconds'], result['median_wall_seconds'],
+            result['git_commands'], result['max_rss_kb'] or '?'),
+        file=sys.stderr)
+
+
+def environment_info():
+    with open(os.path.join(REPO_ROOT, 'peru', 'VERSION')) as f:
+        peru_version = f.read().strip()
+    return {
+        'peru_version': peru_version,
+        'peru_commit': _command_output(['git', 'rev-parse', 'HEAD'],
+                                       REPO_ROOT),
+        'git_version': _command_output(['git', '--version'], REPO_ROOT),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'date': datetime.datetime.utcnow().isoformat() + 'Z',
+    }
+
+
+def _command_output(command, cwd):
+    try:
+        return subprocess.check_output(
+            command,
+            cwd=cwd,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv):
+    names = [project.name for project in projects.PROJECTS]
+    argparser = argparse.ArgumentParser(
+        prog='python -m benchmarks', description=__doc__.split('\n')[0])
+    argparser.add_argument(
+        '--projects',
+        default=','.join(names),
+        help='comma-separated, from: ' + ', '.join(names))
+    argparser.add_argument('--modules', type=int, default=20)
+    argparser.add_argument('--files', type=int, default=100,
+                           help='files per module')
+    argparser.add_argument('--depth', type=int, default=2,
+                           help='dir levels in each module')
+    argparser.add_argument('--repeat', type=int, default=3)
+    argparser.add_argument('--output', help='write JSON here, not stdout')
+    argparser.add_argument(
+        '--work-dir', help='generate projects here and keep them')
+    args = argparser.parse_args(argv)
+    selected = args.projects.split(',')
+    unknown = set(selected) - set(names)
+    if unknown:
+        argparser.error('unknown projects: ' + ', '.join(sorted(unknown)))
+    args.project_classes = [
+        project for project in projects.PROJECTS if project.name in selected
+    ]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.work_dir:
+        os.makedirs(args.work_dir)
+        work_dir = args.work_dir
+    else:
+        tmp = tempfile.TemporaryDirectory(prefix='peru-benchmarks-')
+        work_dir = tmp.name
+    results = []
+    try:
+        for project_class in args.project_classes:
+            results.extend(run_project(project_class, args, work_dir))
+    except RunError as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        if not args.work_dir:
+            tmp.cleanup()
+    report = {
+        'environment': environment_info(),
+        'parameters': {
+            'modules': args.modules,
+            'files': args.files,
+            'depth': args.depth,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    return 0
@@ -0,0 +1,63 @@
+'''Measures how long peru takes to start, using `python -X importtime`.
+
+    python -m benchmarks.startup [--repeat R] [-- <peru args>...]
+
+By default this runs `peru --version`, which should load almost nothing, and
+then lists the slowest imports so that regressions are easy to spot. Any other
+peru command line can be measured by giving it after `--`.'''
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_importtime(peru_args, cwd=None):
+    '''Runs peru once under -X importtime. Returns a dict of every module that
+    was imported, mapped to its cumulative import time in microseconds.'''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'peru'] + peru_args,
+        cwd=cwd or REPO_ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if not fields[1].strip().isdigit():
+            continue  # the header line
+        modules[fields[2].strip()] = int(fields[1])
+    return modules
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('--repeat', type=int, default=5)
+    argparser.add_argument('--top', type=int, default=15)
+    argparser.add_argument('peru_args', nargs='*')
+    args = argparser.parse_args()
+    peru_args = args.peru_args or ['--version']
+
+    wall_times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        modules = run_importtime(peru_args)
+        wall_times.append(time.perf_counter() - start)
+    print('peru {}: {:.1f} ms best wall time, {} modules imported'.format(
+        ' '.join(peru_args), min(wall_times) * 1000, len(modules)))
+    slowest = sorted(modules.items(), key=lambda item: -item[1])
+    for name, micros in slowest[:args.top]:
+        print('  {:8.2f} ms  {}'.format(micros / 1000, name))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
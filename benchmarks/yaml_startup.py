@@ -0,0 +1,91 @@
+'''Measures how long peru takes to load a large peru.yaml at startup.
+
+    python -m benchmarks.yaml_startup [--modules N] [--repeat R]
+
+This generates a project with N modules, several lines each, and times each
+way of loading it: PyYAML's pure-Python loader, the LibYAML loader that peru
+uses when it's available, and peru's cached load from the state dir.'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import yaml
+
+from peru import parser
+
+
+def make_peru_yaml(num_modules):
+    lines = ['imports:']
+    for i in range(num_modules):
+        lines.append('    mod{0}: third_party/mod{0}/'.format(i))
+    lines.append('')
+    for i in range(num_modules):
+        lines.extend([
+            'git module mod{}:'.format(i),
+            '    url: https://example.com/repos/mod{}.git'.format(i),
+            '    rev: {:040x}'.format(i),
+            '    pick:',
+            '        - include/',
+            '        - src/',
+            '    export: src/',
+            '',
+        ])
+    return '\n'.join(lines)
+
+
+def best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('--modules', type=int, default=500)
+    argparser.add_argument('--repeat', type=int, default=5)
+    args = argparser.parse_args()
+
+    text = make_peru_yaml(args.modules)
+    with tempfile.TemporaryDirectory() as tmp:
+        peru_file = os.path.join(tmp, 'peru.yaml')
+        with open(peru_file, 'w') as f:
+            f.write(text)
+        # Backdate the file, so that the cache will accept it.
+        old = time.time() - 60
+        os.utime(peru_file, (old, old))
+        cache_path = os.path.join(tmp, 'peru_file_cache')
+        blob, _ = parser.load_file(peru_file, cache_path)
+        blob_json = json.dumps(blob)
+
+        results = [
+            ('pure-Python safe_load',
+             lambda: yaml.load(text, Loader=yaml.SafeLoader)),
+            ('LibYAML safe_load', lambda: yaml.load(
+                text, Loader=yaml.CSafeLoader)
+             if yaml.__with_libyaml__ else None),
+            ('duplicate key scan',
+             lambda: parser._get_duplicate_keys_approximate(text)),
+            ('load_file, uncached', lambda: parser.load_file(peru_file)),
+            ('load_file, cached',
+             lambda: parser.load_file(peru_file, cache_path)),
+            # parse_blob consumes its input, so give it a fresh copy.
+            ('json copy + parse_blob',
+             lambda: parser.parse_blob(json.loads(blob_json))),
+        ]
+        print('{} modules, {} lines, LibYAML {}'.format(
+            args.modules, text.count('\n') + 1,
+            'available' if yaml.__with_libyaml__ else 'NOT available'))
+        for name, fn in results:
+            print('{:<24} {:8.2f} ms'.format(
+                name, best_time(fn, args.repeat) * 1000))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
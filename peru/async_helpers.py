@@ -1,8 +1,9 @@
 import asyncio
 import atexit
 import codecs
+import collections
 import contextlib
-import io
+import json
 import os
 import subprocess
 import sys
@@ -11,27 +12,38 @@ import traceback
 from .error import PrintableError
 
 
-# Prior to Python 3.8 (which switched to the ProactorEventLoop by default on
-# Windows), the default event loop on Windows doesn't support subprocesses, so
-# we need to use the proactor loop. See:
-# https://docs.python.org/3/library/asyncio-eventloops.html#available-event-loops
-# Because the event loop is essentially a global variable, we have to set this
-# at import time. Otherwise asyncio objects that get instantiated early
-# (particularly Locks and Semaphores) could grab a reference to the wrong loop.
-# TODO: Importing for side effects isn't very clean. Find a better way.
-if os.name == 'nt':
-    EVENT_LOOP = asyncio.ProactorEventLoop()
-else:
-    EVENT_LOOP = asyncio.new_event_loop()
-asyncio.set_event_loop(EVENT_LOOP)
+_event_loop = None
 
-# We also need to make sure the event loop is explicitly closed, to avoid a bug
-# in _UnixSelectorEventLoop.__del__. See http://bugs.python.org/issue23548.
-atexit.register(EVENT_LOOP.close)
+
+def get_event_loop():
+    '''Peru runs everything on one global event loop, which is created the
+    first time it's needed rather than at import time, so that commands that
+    never run a task (like `peru --version`) don't pay for it.
+
+    Prior to Python 3.8 (which switched to the ProactorEventLoop by default on
+    Windows), the default event loop on Windows doesn't support subprocesses,
+    so we need to use the proactor loop. See:
+    https://docs.python.org/3/library/asyncio-eventloops.html#available-event-loops
+    The loop is also set as the current loop, and that has to happen before
+    any asyncio objects get instantiated (particularly Locks and Semaphores),
+    or they could grab a reference to the wrong loop. Creating them inside a
+    running task, like the Runtime does, takes care of that.'''
+    global _event_loop
+    if _event_loop is None:
+        if os.name == 'nt':
+            _event_loop = asyncio.ProactorEventLoop()
+        else:
+            _event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_event_loop)
+        # We also need to make sure the event loop is explicitly closed, to
+        # avoid a bug in _UnixSelectorEventLoop.__del__. See
+        # http://bugs.python.org/issue23548.
+        atexit.register(_event_loop.close)
+    return _event_loop
 
 
 def run_task(coro):
-    return EVENT_LOOP.run_until_complete(coro)
+    return get_event_loop().run_until_complete(coro)
 
 
 class GatheredExceptions(PrintableError):
@@ -99,15 +111,73 @@ async def gather_coalescing_exceptions(coros, display, *, verbose):
         return results
 
 
+# How much output to read from a subprocess at once.
+READ_SIZE = 65536
+
+# How much of the end of a job's output to keep in memory, for error messages.
+OUTPUT_CAPTURE_LIMIT = 64 * 1024
+
+
+class OutputCapture:
+    '''Keeps the last `limit` characters written to it, which is all that an
+    error message needs, so that a job that prints gigabytes of progress
+    doesn't hold on to all of it. If log_path is given, everything is also
+    written to that file, and getvalue() says where to find it.'''
+
+    def __init__(self, limit=OUTPUT_CAPTURE_LIMIT, log_path=None):
+        self._limit = limit
+        self._chunks = collections.deque()
+        self._size = 0
+        self._dropped = 0
+        self.log_path = log_path
+        self._log_file = None
+        if log_path is not None:
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+            self._log_file = open(log_path, 'w', encoding='utf8')
+
+    def write(self, string):
+        if self._log_file is not None:
+            self._log_file.write(string)
+        self._chunks.append(string)
+        self._size += len(string)
+        while self._size - len(self._chunks[0]) >= self._limit:
+            dropped = self._chunks.popleft()
+            self._size -= len(dropped)
+            self._dropped += len(dropped)
+
+    def getvalue(self):
+        value = ''.join(self._chunks)
+        dropped = self._dropped
+        if len(value) > self._limit:
+            dropped += len(value) - self._limit
+            value = value[-self._limit:]
+        if not dropped:
+            return value
+        if self.log_path is not None:
+            note = '[{} earlier characters of output are in {}]\n'.format(
+                dropped, self.log_path)
+        else:
+            note = '[{} earlier characters of output omitted]\n'.format(
+                dropped)
+        return note + value
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+
 async def create_subprocess_with_handle(command,
                                         display_handle,
                                         *,
                                         shell=False,
                                         cwd,
+                                        log_path=None,
                                         **kwargs):
     '''Writes subprocess output to a display handle as it comes in, and also
-    returns a copy of it as a string. Throws if the subprocess returns an
-    error. Note that cwd is a required keyword-only argument, on theory that
+    returns the end of it as a string (see OutputCapture), along with the
+    whole thing in log_path if that's given. Throws if the subprocess returns
+    an error. Note that cwd is a required keyword-only argument, on theory that
     peru should never start child processes "wherever I happen to be running
     right now."'''
 
@@ -121,11 +191,11 @@ async def create_subprocess_with_handle(command,
     decoder_factory = codecs.getincrementaldecoder(encoding)
     decoder = decoder_factory(errors='replace')
 
-    output_copy = io.StringIO()
+    output_copy = OutputCapture(log_path=log_path)
 
     # Display handles are context managers. Entering and exiting the display
     # handle lets the display know when the job starts and stops.
-    with display_handle:
+    with display_handle, contextlib.closing(output_copy):
         stdin = asyncio.subprocess.DEVNULL
         stdout = asyncio.subprocess.PIPE
         stderr = asyncio.subprocess.STDOUT
@@ -146,17 +216,25 @@ async def create_subprocess_with_handle(command,
                 cwd=cwd,
                 **kwargs)
 
-        # Read all the output from the subprocess as its comes in.
-        while True:
-            outputbytes = await proc.stdout.read(4096)
-            if not outputbytes:
-                break
-            outputstr = decoder.decode(outputbytes)
-            outputstr_unified = _unify_newlines(outputstr)
-            display_handle.write(outputstr_unified)
-            output_copy.write(outputstr_unified)
-
-        returncode = await proc.wait()
+        try:
+            # Read all the output from the subprocess as its comes in.
+            while True:
+                outputbytes = await proc.stdout.read(READ_SIZE)
+                if not outputbytes:
+                    break
+                outputstr = decoder.decode(outputbytes)
+                outputstr_unified = _unify_newlines(outputstr)
+                display_handle.write(outputstr_unified)
+                output_copy.write(outputstr_unified)
+
+            returncode = await proc.wait()
+        except asyncio.CancelledError:
+            # If the caller gives up on us (for example, on a timeout), don't
+            # leave the child running.
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+            raise
 
     if returncode != 0:
         raise subprocess.CalledProcessError(returncode, command,
@@ -169,6 +247,56 @@ async def create_subprocess_with_handle(command,
     return output_copy.getvalue()
 
 
+async def run_worker_job_with_handle(proc,
+                                     request,
+                                     display_handle,
+                                     *,
+                                     log_path=None):
+    '''Sends one JSON request line to a plugin worker process (see
+    peru/plugin_worker.py) and writes the output messages it answers with to a
+    display handle, until the worker reports the job's return code. Returns a
+    (returncode, output) pair, where returncode is None if the worker died
+    before finishing the job. Unlike create_subprocess_with_handle, this
+    doesn't raise for a nonzero return code, because the caller needs to know
+    whether the worker can be reused first.'''
+
+    output_copy = OutputCapture(log_path=log_path)
+
+    def write(outputstr):
+        outputstr_unified = _unify_newlines(outputstr)
+        display_handle.write(outputstr_unified)
+        output_copy.write(outputstr_unified)
+
+    returncode = None
+    with display_handle, contextlib.closing(output_copy):
+        try:
+            proc.stdin.write(json.dumps(request).encode() + b'\n')
+            await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                # The worker exited without finishing the job.
+                break
+            try:
+                message = json.loads(line.decode('utf8'))
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                # Anything that isn't a protocol message, like a traceback
+                # from a worker that failed to start, is just output.
+                write(line.decode('utf8', errors='replace'))
+                continue
+            if 'output' in message:
+                write(message['output'])
+            if 'returncode' in message:
+                returncode = message['returncode']
+                break
+
+    return returncode, output_copy.getvalue()
+
+
 def _unify_newlines(s):
     r'''Because all asyncio subprocess output is read in binary mode, we don't
     get universal newlines for free. But it's the right thing to do, because we
@@ -6,12 +6,17 @@ import json
 import os
 import pathlib
 import re
+import shutil
+import sys
+import tempfile
 import textwrap
+import time
 
 from .async_helpers import safe_communicate
 from .compat import makedirs
 from .error import PrintableError
 from .keyval import KeyVal
+from . import trace
 
 # git output modes
 TEXT_MODE = object()
@@ -20,6 +25,9 @@ BINARY_MODE = object()
 # for tests
 DEBUG_GIT_COMMAND_COUNT = 0
 
+# Set to a GitProfiler to collect statistics about every git command.
+GIT_PROFILER = None
+
 
 def compute_key(data):
     # To hash this dictionary of fields, serialize it as a JSON string, and
@@ -28,11 +36,12 @@ def compute_key(data):
     # JSON slightly more compact, and protects us against changes in the
     # default.  "ensure_ascii" defaults to true, so specifying it just
     # protects us from changes in the default.
-    json_representation = json.dumps(
-        data, sort_keys=True, ensure_ascii=True, separators=(',', ':'))
-    sha1 = hashlib.sha1()
-    sha1.update(json_representation.encode("utf8"))
-    return sha1.hexdigest()
+    with trace.span('compute key'):
+        json_representation = json.dumps(
+            data, sort_keys=True, ensure_ascii=True, separators=(',', ':'))
+        sha1 = hashlib.sha1()
+        sha1.update(json_representation.encode("utf8"))
+        return sha1.hexdigest()
 
 
 class GitSession:
@@ -46,29 +55,47 @@ class GitSession:
     class to abstract away the low level details of git command flags. (And in
     the future, this could be where we plug in libgit2.)'''
 
-    def __init__(self, git_dir, index_file, working_copy):
+    def __init__(self, git_dir, index_file, working_copy, config=()):
         self.git_dir = git_dir
         self.index_file = index_file
         self.working_copy = working_copy
+        # Extra `git -c` settings, like the index format.
+        self.config = config
 
     async def git(self, *args, input=None, output_mode=TEXT_MODE, cwd=None):
         global DEBUG_GIT_COMMAND_COUNT
         DEBUG_GIT_COMMAND_COUNT += 1
+        profiler = GIT_PROFILER
+        if profiler is not None:
+            # Find the call site before the first await, while the callers'
+            # frames are still on the stack.
+            site = _git_call_site(sys._getframe(1))
+            start = time.perf_counter()
         command = ['git']
+        for setting in self.config:
+            command += ['-c', setting]
         command.append('--git-dir=' + self.git_dir)
         if self.working_copy:
             command.append("--work-tree=" + self.working_copy)
         command.extend(args)
+        # Skip options like --literal-pathspecs that go before the
+        # subcommand.
+        subcommand = next(arg for arg in args if not arg.startswith('-'))
         if isinstance(input, str):
             input = input.encode()
-        process = await asyncio.subprocess.create_subprocess_exec(
-            *command,
-            cwd=cwd,
-            env=self.git_env(),
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE)
-        stdout, stderr = await safe_communicate(process, input)
+        with trace.span('git ' + subcommand):
+            process = await asyncio.subprocess.create_subprocess_exec(
+                *command,
+                cwd=cwd,
+                env=self.git_env(),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            stdout, stderr = await safe_communicate(process, input)
+        if profiler is not None:
+            profiler.record(subcommand, time.perf_counter() - start,
+                            len(input or b''),
+                            len(stdout) + len(stderr), site)
         stderr = stderr.decode()
         if output_mode == TEXT_MODE:
             stdout = stdout.decode()
@@ -96,19 +123,21 @@ class GitSession:
 
     async def read_tree_and_stats_into_index(self, tree):
         await self.read_tree_into_index(tree)
-        # Refresh all the stat() information in the index.
-        try:
-            # This throws an error on modified files. Suppress it.
-            await self.git('update-index', '--refresh')
-        except GitError as e:
-            if 'needs update' not in e.stdout:
-                # Reraise any errors we don't recognize.
-                raise
+        await self.refresh_stats_in_index()
 
     async def make_tree_from_index(self):
         tree = await self.git('write-tree')
         return tree
 
+    async def get_tree_of_index(self):
+        '''Like make_tree_from_index(), but returns None if the index can't be
+        read or written as a tree. An index left in a good state by a previous
+        sync has a complete cache-tree extension, so this is cheap.'''
+        try:
+            return await self.make_tree_from_index()
+        except GitError:
+            return None
+
     async def read_working_copy_into_index(self, picks):
         # Use --force to avoid .gitignore rules. We shouldn't respect them.
         if picks:
@@ -143,17 +172,67 @@ class GitSession:
         # stomp on the working copy. The -i flag ignores the working copy.
         await self.git('read-tree', '-i', '--prefix', prefix_arg, tree)
 
-    async def working_copy_matches_index(self):
-        diff_output = await self.git('diff-files', output_mode=BINARY_MODE)
-        return len(diff_output) == 0
-
-    async def get_modified_files_skipping_deletes(self):
+    async def working_copy_matches_index(self, paths=None):
+        '''If `paths` is given, only check those, as in
+        get_modified_files_skipping_deletes().'''
+        if paths is None:
+            diff_output = await self.git('diff-files', output_mode=BINARY_MODE)
+            return len(diff_output) == 0
+        for batch in _pathspec_batches(paths):
+            diff_output = await self.git(
+                '--literal-pathspecs', 'diff-files', '--', *batch,
+                output_mode=BINARY_MODE, cwd=self.working_copy)
+            if diff_output:
+                return False
+        return True
+
+    async def get_modified_files_skipping_deletes(self, paths=None):
         # We want to ignore deleted files, so we exclude only deletes using
         # 'd' instead of including all of the capital letter forms.
         # https://git-scm.com/docs/git-diff#Documentation/git-diff.txt---diff-filterACDMRTUXB82308203
-        diff_output = await self.git('diff-files', '-z', '--name-only',
-                                     '--diff-filter=d')
-        return [name for name in diff_output.split('\x00') if name]
+        if paths is None:
+            diff_output = await self.git('diff-files', '-z', '--name-only',
+                                         '--diff-filter=d')
+            return [name for name in diff_output.split('\x00') if name]
+        modified = []
+        for batch in _pathspec_batches(paths):
+            diff_output = await self.git(
+                '--literal-pathspecs', 'diff-files', '-z', '--name-only',
+                '--diff-filter=d', '--', *batch, cwd=self.working_copy)
+            modified.extend(name for name in diff_output.split('\x00')
+                            if name)
+        return modified
+
+    async def refresh_stats_in_index(self, paths=None):
+        '''Refresh the stat() information in the index, either for every file
+        or only for the given paths, which must all be in the index. Paths
+        that are missing from the working copy are fine. Git only rewrites the
+        index file if something actually changed.'''
+        if paths is None:
+            try:
+                # This throws an error on modified files. Suppress it.
+                await self.git('update-index', '--refresh')
+            except GitError as e:
+                if 'needs update' not in e.stdout:
+                    # Reraise any errors we don't recognize.
+                    raise
+            return
+        for batch in _pathspec_batches(paths):
+            await self.git(
+                '--literal-pathspecs', 'add', '--refresh', '--', *batch,
+                cwd=self.working_copy)
+
+    async def get_changed_paths(self, previous_tree, new_tree):
+        '''Returns a dictionary of {path: status} for every file that differs
+        between the two trees. The status is a letter like 'A' for added, 'D'
+        for deleted, or 'M' for modified, as in `git diff --name-status`.'''
+        # Use binary mode, because text mode would strip trailing whitespace
+        # from the last filename.
+        diff_output = await self.git(
+            'diff-tree', '-r', '-z', '--no-renames', '--name-status',
+            previous_tree, new_tree, output_mode=BINARY_MODE)
+        fields = diff_output.decode().split('\x00')
+        return dict(zip(fields[1::2], fields[0::2]))
 
     async def get_new_files_in_tree(self, previous_tree, new_tree):
         added_files_output = await self.git('diff-tree', '--diff-filter=A',
@@ -172,15 +251,36 @@ class GitSession:
         else:
             await self.git('read-tree', '-m', '-u', tree)
 
-    async def checkout_files_from_index(self):
+    async def checkout_files_from_index(self, paths=None, *, force=False):
         # This recreates any deleted files. As far as I can tell,
         # checkout-index has no equivalent of the --full-tree flag we use with
         # ls-tree below. Instead, the --all flag seems to respect the directory
         # from which it's invoked, and only check out files below that
-        # directory. This, this is currently the only command we invoke with an
-        # explicit cwd. Original bug report:
+        # directory. Paths given on stdin are likewise relative to the cwd. So
+        # we invoke this with an explicit cwd, like the other commands here
+        # that take paths. Original bug report:
         # https://github.com/buildinspace/peru/issues/210
-        await self.git('checkout-index', '--all', cwd=self.working_copy)
+        args = ['checkout-index']
+        if force:
+            args.append('--force')
+        if paths is None:
+            await self.git(*args, '--all', cwd=self.working_copy)
+        elif paths:
+            await self.git(
+                *args,
+                '--stdin',
+                '-z',
+                input='\x00'.join(paths),
+                cwd=self.working_copy)
+
+    async def get_working_copy_changes(self):
+        '''Returns a dictionary of {path: status} for every file in the index
+        that differs in the working copy. The status is 'D' for deleted files,
+        and usually 'M' otherwise.'''
+        diff_output = await self.git(
+            'diff-files', '-z', '--name-status', output_mode=BINARY_MODE)
+        fields = diff_output.decode().split('\x00')
+        return dict(zip(fields[1::2], fields[0::2]))
 
     async def get_info_for_path(self, tree, path):
         # --full-tree makes ls-tree ignore the cwd. As in list_tree_entries,
@@ -245,23 +345,238 @@ class GitSession:
         tree = await self.git('mktree', '-z', input=input)
         return tree
 
+    async def list_tree_objects(self, trees):
+        '''Returns the hashes of the trees and everything in them.'''
+        objects = await self.git(
+            'rev-list', '--objects', '--stdin', input=''.join(
+                tree + '\n' for tree in trees))
+        # Each line is a hash, followed by a path for everything but the roots.
+        return [line[:40] for line in objects.splitlines()]
+
+    async def pack_tree(self, tree):
+        '''Returns the bytes of a git pack holding the tree and everything in
+        it, for another cache to read with index_pack().'''
+        hashes = await self.list_tree_objects([tree])
+        return (await self.git(
+            'pack-objects', '--stdout', '--quiet',
+            input='\n'.join(hashes) + '\n', output_mode=BINARY_MODE))
+
+    async def write_pack(self, trees, base_name):
+        '''Like pack_tree(), but for many trees, and written straight to a
+        file rather than kept in memory. Returns the path of the pack, which is
+        `<base_name>-<hash>.pack`, next to its .idx file.'''
+        hashes = await self.list_tree_objects(trees)
+        pack_hash = await self.git(
+            'pack-objects', '--quiet', base_name,
+            input='\n'.join(hashes) + '\n')
+        return '{}-{}.pack'.format(base_name, pack_hash)
+
+    async def index_pack(self, pack):
+        await self.git('index-pack', '--stdin', '--strict', input=pack)
+
+    async def index_pack_file(self, path):
+        '''Checks a pack file and writes its .idx file next to it. Returns
+        the pack's hash.'''
+        return (await self.git('index-pack', '--strict', path))
+
+    async def has_object(self, sha1):
+        try:
+            await self.git('cat-file', '-e', sha1)
+        except GitError:
+            return False
+        return True
+
+    async def get_object_type(self, sha1):
+        '''Returns 'blob', 'tree', etc., or None if there's no such object.'''
+        try:
+            return (await self.git('cat-file', '-t', sha1))
+        except GitError:
+            return None
+
+
+def _git_call_site(frame):
+    '''Name the peru function that asked for a git command, along with the
+    GitSession method it went through, like "export_tree/read_tree".'''
+    method = None
+    while frame is not None:
+        name = frame.f_code.co_name
+        if not isinstance(frame.f_locals.get('self'), GitSession):
+            if method is None:
+                return name
+            return '{}/{}'.format(name, method)
+        method = name
+        frame = frame.f_back
+    return method
+
+
+class GitProfiler:
+    '''Collects the count, wall time, bytes in and out, and call sites of
+    every git command, grouped by subcommand. Set cache.GIT_PROFILER to an
+    instance to turn it on. This is what `peru --profile-git` reports.'''
+
+    def __init__(self):
+        self._commands = collections.defaultdict(
+            lambda: {'times': [], 'bytes_in': 0, 'bytes_out': 0,
+                     'sites': collections.Counter()})
+
+    def record(self, subcommand, seconds, bytes_in, bytes_out, site):
+        stats = self._commands[subcommand]
+        stats['times'].append(seconds)
+        stats['bytes_in'] += bytes_in
+        stats['bytes_out'] += bytes_out
+        stats['sites'][site] += 1
+
+    def summary(self):
+        '''A JSON-friendly dict of statistics for each subcommand. Times are
+        in seconds.'''
+        summary = {}
+        for subcommand, stats in self._commands.items():
+            times = sorted(stats['times'])
+            summary[subcommand] = {
+                'count': len(times),
+                'total': sum(times),
+                'p50': _percentile(times, 50),
+                'p90': _percentile(times, 90),
+                'p99': _percentile(times, 99),
+                'max': times[-1],
+                'bytes_in': stats['bytes_in'],
+                'bytes_out': stats['bytes_out'],
+                'sites': dict(stats['sites']),
+            }
+        return summary
+
+    def format_summary(self):
+        summary = self.summary()
+        total_count = sum(stats['count'] for stats in summary.values())
+        total_time = sum(stats['total'] for stats in summary.values())
+        lines = [
+            'git commands: {} in {:.3f}s'.format(total_count, total_time),
+            '{:<16} {:>6} {:>9} {:>8} {:>8} {:>8} {:>10} {:>10}'.format(
+                'command', 'count', 'total', 'p50', 'p90', 'max', 'bytes in',
+                'bytes out'),
+        ]
+        ordered = sorted(
+            summary.items(), key=lambda item: item[1]['total'], reverse=True)
+        for subcommand, stats in ordered:
+            lines.append(
+                '{:<16} {:>6} {:>8.3f}s {:>6.1f}ms {:>6.1f}ms {:>6.1f}ms '
+                '{:>10} {:>10}'.format(
+                    subcommand, stats['count'], stats['total'],
+                    stats['p50'] * 1000, stats['p90'] * 1000,
+                    stats['max'] * 1000, stats['bytes_in'],
+                    stats['bytes_out']))
+            sites = sorted(stats['sites'].items(), key=lambda s: (-s[1], s[0]))
+            for site, count in sites:
+                lines.append('    {:>6} {}'.format(count, site))
+        return '\n'.join(lines)
+
+
+class CacheStats:
+    '''Counts hits and misses for each layer of caching: module fetches,
+    rules, merges, the peru files of recursive modules, plugin cache dirs
+    (like the git plugin's clones) that were already there, lookups in the
+    remote cache after a local miss, and trees from peru.lock that were
+    already in the cache. Every _Cache has one, and `peru sync -v` prints a
+    summary.
+
+    Lookups with a key are only counted the first time in a run, so that
+    targets that share a module or a rule don't make one fetch look like
+    several cache hits. Plugin cache dirs are counted on every job, since
+    different revs of the same repo share one.'''
+
+    LAYERS = [
+        'modules', 'rules', 'merges', 'peru files', 'plugin cache dirs',
+        'remote', 'lock file'
+    ]
+
+    def __init__(self):
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self._seen = set()
+
+    def record(self, layer, hit, key=None):
+        assert layer in self.LAYERS, 'unknown cache layer ' + layer
+        if key is not None:
+            if (layer, key) in self._seen:
+                return
+            self._seen.add((layer, key))
+        if hit:
+            self.hits[layer] += 1
+        else:
+            self.misses[layer] += 1
+
+    def as_dict(self):
+        return {
+            layer: {
+                'hits': self.hits[layer],
+                'misses': self.misses[layer]
+            }
+            for layer in self.LAYERS
+        }
+
+    def format_summary(self):
+        counts = [
+            '{} {}/{}'.format(layer, self.hits[layer],
+                              self.hits[layer] + self.misses[layer])
+            for layer in self.LAYERS if self.hits[layer] + self.misses[layer]
+        ]
+        return 'cache hits: ' + (', '.join(counts) or 'no lookups')
 
-async def Cache(root):
+
+def _percentile(sorted_values, percent):
+    # Nearest rank.
+    index = max(0, -(-len(sorted_values) * percent // 100) - 1)
+    return sorted_values[index]
+
+
+async def Cache(root, split_index=False, lower_roots=()):
     'This is the async constructor for the _Cache class.'
-    cache = _Cache(root)
+    cache = _Cache(root, split_index, lower_roots)
     await cache._init_trees()
     return cache
 
 
 class _Cache:
-    def __init__(self, root):
+    '''The cache lives in a writable root dir. It can also have read-only
+    `lower_roots`, like a prewarmed cache on a network drive or in a container
+    image, which are other peru cache dirs. Lookups fall through them in
+    order: keyval entries through KeyVal, git objects through the trees
+    repo's alternates, and plugin cache dirs (like the git plugin's clones)
+    get copied up to the root the first time a plugin uses them. Everything
+    new is written only to the root.'''
+
+    def __init__(self, root, split_index=False, lower_roots=()):
         "Don't instantiate this class directly. Use the Cache() constructor."
         self.root = root
+        self.lower_roots = [os.path.abspath(path) for path in lower_roots]
+        # Settings for the long-lived index files that callers pass to
+        # export_tree(). Version 4 compresses the paths, which makes a big
+        # index noticeably smaller. A split index keeps most entries in a
+        # sharedindex.* file in the trees repo, so that small updates only
+        # rewrite a small file. Git expires shared files that no index has
+        # used for a couple of weeks.
+        self.saved_index_config = [
+            'index.version=4',
+            'core.splitIndex=' + ('true' if split_index else 'false'),
+        ]
         self.plugins_root = os.path.join(root, "plugins")
         makedirs(self.plugins_root)
+        self.lower_plugins_roots = [
+            os.path.join(lower_root, 'plugins')
+            for lower_root in self.lower_roots
+        ]
         self.tmp_path = os.path.join(root, "tmp")
         makedirs(self.tmp_path)
-        self.keyval = KeyVal(os.path.join(root, 'keyval'), self.tmp_path)
+        self.keyval = KeyVal(
+            os.path.join(root, 'keyval'),
+            self.tmp_path,
+            lower_roots=[
+                os.path.join(lower_root, 'keyval')
+                for lower_root in self.lower_roots
+            ])
+        self.stats = CacheStats()
+        # Recent plugin failures, see plugin.FailureCache.
+        self.failures = KeyVal(os.path.join(root, 'failures'), self.tmp_path)
         self.trees_path = os.path.join(root, "trees")
         self._empty_tree = None
 
@@ -282,6 +597,80 @@ class _Cache:
             with open(attributes_path, 'w') as attributes:
                 # Disable the 'text' attribute for all files.
                 attributes.write('* -text')
+        await self._set_alternates()
+
+    async def _set_alternates(self):
+        '''Point the trees repo at the object dirs of the lower layers. Git
+        skips writing any object that an alternate already has, so before a
+        layer is dropped, copy its objects into the root. If a dropped layer
+        is already gone, check that every tree in the keyval is still whole
+        without it.'''
+        alternates_path = os.path.join(self.trees_path, 'objects', 'info',
+                                       'alternates')
+        alternates = [
+            os.path.join(lower_root, 'trees', 'objects')
+            for lower_root in self.lower_roots
+        ]
+        old_alternates = []
+        if os.path.exists(alternates_path):
+            with open(alternates_path) as f:
+                old_alternates = f.read().splitlines()
+        if old_alternates == alternates:
+            return
+        missing_layers = []
+        for old_alternate in old_alternates:
+            if old_alternate in alternates:
+                continue
+            if os.path.isdir(old_alternate):
+                await self._copy_all_objects(os.path.dirname(old_alternate))
+            else:
+                missing_layers.append(
+                    os.path.dirname(os.path.dirname(old_alternate)))
+        self._write_alternates(alternates_path, alternates)
+        if missing_layers and not await self._keyval_trees_are_complete():
+            # Put the old list back, so that the next run checks again.
+            self._write_alternates(alternates_path, old_alternates)
+            raise CacheLayerError(
+                'The cache at {} needs objects from cache layers that no '
+                'longer exist:\n\n{}\n\nRestore them, or delete the cache '
+                'dir to start over.', self.root,
+                '\n'.join('  ' + layer for layer in missing_layers))
+
+    @staticmethod
+    def _write_alternates(alternates_path, alternates):
+        if alternates:
+            makedirs(os.path.dirname(alternates_path))
+            with open(alternates_path, 'w') as f:
+                f.write(''.join(path + '\n' for path in alternates))
+        elif os.path.exists(alternates_path):
+            os.remove(alternates_path)
+
+    async def _keyval_trees_are_complete(self):
+        trees = set(
+            val for val in (self.keyval[key] for key in self.keyval)
+            if HASH_RE.match(val))
+        if not trees:
+            return True
+        session = GitSession(self.trees_path, os.devnull, os.devnull)
+        try:
+            objects = await session.git(
+                'rev-list', '--objects', '--missing=print', '--stdin',
+                input=''.join(tree + '\n' for tree in sorted(trees)))
+        except GitError:
+            # One of the trees themselves is missing.
+            return False
+        return not any(line.startswith('?') for line in objects.splitlines())
+
+    async def _copy_all_objects(self, git_dir):
+        session = GitSession(git_dir, os.devnull, os.devnull)
+        objects = await session.git('cat-file', '--batch-all-objects',
+                                    '--batch-check=%(objectname)')
+        if objects:
+            # Write the pack and its index straight into the root's repo.
+            await session.git(
+                'pack-objects', '-q',
+                os.path.join(self.trees_path, 'objects', 'pack', 'pack'),
+                input=objects + '\n')
 
     @contextlib.contextmanager
     def clean_git_session(self, working_copy=None):
@@ -303,7 +692,8 @@ class _Cache:
     async def import_tree(self, src, *, picks=None, excludes=None):
         if not os.path.exists(src):
             raise RuntimeError('import tree called on nonexistent path ' + src)
-        with self.clean_git_session(src) as session:
+        with trace.span('import tree', src=src), \
+                self.clean_git_session(src) as session:
             await session.read_working_copy_into_index(picks)
 
             # We want to avoid ever importing a .peru directory. This is a
@@ -320,7 +710,8 @@ class _Cache:
             return tree
 
     async def merge_trees(self, base_tree, merge_tree, merge_path='.'):
-        with self.clean_git_session() as session:
+        with trace.span('merge tree', path=merge_path), \
+                self.clean_git_session() as session:
             if base_tree:
                 await session.read_tree_into_index(base_tree)
             try:
@@ -336,7 +727,8 @@ class _Cache:
                           previous_tree=None,
                           *,
                           force=False,
-                          previous_index_file=None):
+                          previous_index_file=None,
+                          fsmonitor=None):
         '''This method is the core of `peru sync`. If the contents of "dest"
         match "previous_tree", then export_tree() updates them to match "tree".
         If not, it raises an error and doesn't touch any files.
@@ -346,7 +738,12 @@ class _Cache:
         index file used during the last sync, which should already reflect
         "previous_tree". That allows us to skip the read-tree and update-index
         calls, so all we have to do is a single diff-files operation to check
-        for cleanliness.
+        for cleanliness. When there are changes, the same index file spares us
+        from rehashing every file, and it also lets us update from
+        "previous_tree" to a different "tree" by looking only at the files that
+        differ between them. If the caller also passes in an FSMonitor (see
+        peru/fsmonitor.py) watching "dest", even the diff-files operation only
+        needs to look at files that changed since the last sync.
 
         It's difficult to predict all the different states the index file might
         end up in under different error conditions, not only now but also in
@@ -360,6 +757,14 @@ class _Cache:
 
         makedirs(dest)
 
+        # Ask the filesystem monitor what's changed since the working copy was
+        # last known to be clean. This has to happen before we look at any
+        # files, so that anything that changes while we work shows up next
+        # time.
+        fsmonitor_token = changed_files = None
+        if fsmonitor is not None and previous_index_file:
+            fsmonitor_token, changed_files = fsmonitor.get_changes()
+
         with contextlib.ExitStack() as stack:
 
             # If the caller gave us an index file, create a git session around
@@ -370,10 +775,12 @@ class _Cache:
             did_refresh = False
             if previous_index_file:
                 session = GitSession(self.trees_path, previous_index_file,
-                                     dest)
+                                     dest, self.saved_index_config)
                 stack.enter_context(delete_if_error(previous_index_file))
                 if not os.path.exists(previous_index_file):
                     did_refresh = True
+                    # The monitor's answer is relative to the old index.
+                    changed_files = None
                     await session.read_tree_and_stats_into_index(previous_tree)
             else:
                 session = stack.enter_context(self.clean_git_session(dest))
@@ -381,24 +788,76 @@ class _Cache:
                 await session.read_tree_and_stats_into_index(previous_tree)
 
             # The fast path. If the previous tree is the same as the current
-            # one, and no files have changed at all, short-circuit.
+            # one, and no files have changed at all, short-circuit. Files that
+            # the monitor says haven't changed don't need to be checked.
             if previous_tree == tree:
-                if (await session.working_copy_matches_index()):
+                try:
+                    matches = await session.working_copy_matches_index(
+                        changed_files)
+                except GitError:
+                    if did_refresh:
+                        raise
+                    # The saved index is unreadable, for example a split index
+                    # whose shared file was deleted. The slow path below will
+                    # notice and rebuild it.
+                    matches = False
+                if matches:
+                    if fsmonitor_token:
+                        fsmonitor.save_token(fsmonitor_token)
                     return
 
             # Everything below is the slow path. Some files have changed, or
-            # the tree has changed, or both. If we didn't refresh the index
-            # file above, we must do so now.
+            # the tree has changed, or both. How much work that takes depends
+            # on whether we have a saved index that really does reflect
+            # `previous_tree`.
+            changed_paths = None
+            index_tree = None
             if not did_refresh:
-                await session.read_tree_and_stats_into_index(previous_tree)
-            modified = await session.get_modified_files_skipping_deletes()
-            if modified and not force:
-                raise DirtyWorkingCopyError(
-                    'Imported files have been modified ' +
-                    '(use --force to overwrite):\n\n' +
-                    _format_file_lines(modified))
+                index_tree = await session.get_tree_of_index()
+            if index_tree == previous_tree == tree:
+                # Only the working copy has changed, and the index is still
+                # good. Put back the files that are missing (and with --force,
+                # the modified ones) without touching anything else.
+                await session.refresh_stats_in_index()
+                changes = await session.get_working_copy_changes()
+                _check_modified_files(
+                    [path for path, status in changes.items()
+                     if status != 'D'], force)
+                await session.checkout_files_from_index(
+                    list(changes), force=True)
+                if fsmonitor_token:
+                    fsmonitor.save_token(fsmonitor_token)
+                return
+            # If the tree has changed, we only need to look at the files that
+            # differ between the two trees. That keeps a sync that changes one
+            # small module proportional to the change rather than to the whole
+            # sync dir. Note that this means we don't notice modified or
+            # deleted files outside of the change. That's safe, because we
+            # don't touch them either, and the next sync will notice them as
+            # usual.
+            if index_tree == previous_tree and previous_tree != tree:
+                changed_paths = await session.get_changed_paths(
+                    previous_tree, tree)
+            if changed_paths is None:
+                # If we didn't refresh the index file above, we must do so now.
+                # The saved index doesn't match `previous_tree`, or it can't be
+                # read at all, so rebuild it from scratch.
+                if not did_refresh:
+                    os.remove(previous_index_file)
+                    await session.read_tree_and_stats_into_index(previous_tree)
+                modified = await session.get_modified_files_skipping_deletes()
+            else:
+                previous_paths = [
+                    path for path, status in changed_paths.items()
+                    if status != 'A'
+                ]
+                await session.refresh_stats_in_index(previous_paths)
+                modified = await session.get_modified_files_skipping_deletes(
+                    previous_paths)
+            _check_modified_files(modified, force)
 
             # Do all the file updates and deletions needed to produce `tree`.
+            # With an up-to-date index, this only touches the changed files.
             try:
                 await session.read_tree_updating_working_copy(tree, force)
             except GitError:
@@ -421,8 +880,15 @@ class _Cache:
                     # keep going.
                     raise
 
-            # Recreate any missing files.
-            await session.checkout_files_from_index()
+            # Recreate any missing files. In the incremental case, read-tree
+            # has already written every changed file. Only a full update
+            # guarantees the whole working copy is clean. (After an incremental
+            # one, the previous token remains valid, because everything it
+            # touched shows up as changed.)
+            if changed_paths is None:
+                await session.checkout_files_from_index()
+                if fsmonitor_token:
+                    fsmonitor.save_token(fsmonitor_token)
 
     async def read_file(self, tree, path):
         # TODO: Make this handle symlinks in the tree.
@@ -439,6 +905,66 @@ class _Cache:
         session = self.no_index_git_session()
         return (await session.list_tree_entries(tree, path, recursive))
 
+    async def export_pack(self, tree):
+        '''Returns a git pack of the tree, see import_pack().'''
+        return (await self.no_index_git_session().pack_tree(tree))
+
+    async def has_tree(self, tree):
+        session = self.no_index_git_session()
+        return (await session.get_object_type(tree)) == 'tree'
+
+    async def missing_trees(self, trees):
+        '''Returns the ones of the given trees that aren't in the cache, in
+        sorted order, with one git command for all of them.'''
+        trees = sorted(set(trees))
+        if not trees:
+            return []
+        output = await self.no_index_git_session().git(
+            'cat-file', '--batch-check=%(objectname) %(objecttype)',
+            input=''.join(tree + '\n' for tree in trees))
+        found = set(
+            line.split()[0] for line in output.splitlines()
+            if line.endswith(' tree'))
+        return [tree for tree in trees if tree not in found]
+
+    async def write_pack(self, trees, dir):
+        '''Writes a pack of the trees into dir, see import_pack_file(), and
+        returns its path.'''
+        return (await self.no_index_git_session().write_pack(
+            trees, os.path.join(dir, 'pack')))
+
+    async def import_pack_file(self, path):
+        '''Moves a pack file from write_pack() into the cache. Raises GitError
+        if the pack is bad.'''
+        pack_dir = os.path.join(self.trees_path, 'objects', 'pack')
+        fd, tmp_pack = tempfile.mkstemp(
+            dir=pack_dir, prefix='tmp_pack_', suffix='.pack')
+        os.close(fd)
+        tmp_idx = tmp_pack[:-len('.pack')] + '.idx'
+        shutil.move(path, tmp_pack)
+        try:
+            pack_hash = await self.no_index_git_session().index_pack_file(
+                tmp_pack)
+        except GitError:
+            for tmp_path in (tmp_pack, tmp_idx):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+        # Git finds packs through their .idx files, so that goes last.
+        pack_base = os.path.join(pack_dir, 'pack-' + pack_hash)
+        os.replace(tmp_pack, pack_base + '.pack')
+        os.replace(tmp_idx, pack_base + '.idx')
+
+    async def import_pack(self, pack, tree):
+        '''Adds the objects in a pack from export_pack() to the cache, and
+        checks that the tree arrived. Raises GitError if the pack is bad or
+        doesn't have the tree.'''
+        session = self.no_index_git_session()
+        await session.index_pack(pack)
+        if not await session.has_object(tree):
+            raise GitError(['git', 'index-pack'], 1, '',
+                           'tree {} is not in the pack'.format(tree))
+
     async def modify_tree(self, tree, modifications):
         '''The modifications are a map of the form, {path: TreeEntry}. The tree
         can be None to indicate an empty starting tree. The entries can be
@@ -526,6 +1052,29 @@ def delete_if_error(path):
         raise
 
 
+def _check_modified_files(modified, force):
+    if modified and not force:
+        raise DirtyWorkingCopyError(
+            'Imported files have been modified ' +
+            '(use --force to overwrite):\n\n' + _format_file_lines(modified))
+
+
+def _pathspec_batches(paths, max_chars=8000):
+    '''Split a list of paths into chunks that are safe to pass on the command
+    line, even on Windows, where the limit is about 32k characters.'''
+    batch = []
+    batch_chars = 0
+    for path in paths:
+        if batch and batch_chars + len(path) + 1 > max_chars:
+            yield batch
+            batch = []
+            batch_chars = 0
+        batch.append(path)
+        batch_chars += len(path) + 1
+    if batch:
+        yield batch
+
+
 def _format_file_lines(files):
     '''Given a list of filenames that we're about to print, limit it to a
     reasonable number of lines.'''
@@ -551,6 +1100,10 @@ class GitError(Exception):
         Exception.__init__(self, message)
 
 
+class CacheLayerError(PrintableError):
+    pass
+
+
 class ModifyTreeError(PrintableError):
     pass
 
@@ -572,6 +1125,9 @@ NONEXECUTABLE_FILE_MODE = '100644'
 EXECUTABLE_FILE_MODE = '100755'
 TREE_MODE = '040000'
 
+# Keyval entries that hold trees, rather than something like a peru file.
+HASH_RE = re.compile('^[0-9a-f]{40}$')
+
 # All possible ways to capitalize ".peru", to exclude from imported trees.
 DOTPERU_CAPITALIZATIONS = [
     '.peru',
@@ -0,0 +1,212 @@
+'''Cache bundles, for `peru cache export` and `peru cache import`. A bundle is
+a gzipped tar file with everything from the cache that a sync of one project
+needs, so that a fresh cache (like in a CI container, or on a machine with no
+network) can be filled with one read instead of a fetch for every module:
+
+    peru-cache.json     the format version, and the keyval entries that the
+                        sync used: modules, rules, merges and peru files
+    objects.pack        a git pack of every tree in those entries
+    plugins/...         optionally, the plugin cache dirs of the project's
+                        modules, like the git plugin's clones, which reup and
+                        changed revs can fetch into
+
+Bundles only add to a cache. Entries and plugin cache dirs that the cache
+already has are left alone.'''
+
+import collections
+import copy
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+
+from .cache import GitError
+from .compat import makedirs
+from .error import PrintableError
+from .imports import get_imports_tree
+from . import plugin
+
+BUNDLE_VERSION = 1
+MANIFEST_NAME = 'peru-cache.json'
+PACK_NAME = 'objects.pack'
+PLUGINS_DIR = 'plugins'
+
+HASH_RE = re.compile('^[0-9a-f]{40}$')
+
+# Newer Pythons can sanitize what they extract. We check the paths ourselves
+# too, for older ones.
+_EXTRACT_ARGS = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+
+async def export_bundle(runtime, scope, imports, path, *,
+                        plugin_caches=False):
+    # Resolve every import, fetching whatever isn't cached yet, and note the
+    # keyval entries that took.
+    keyval = runtime.cache.keyval
+    keyval.used_keys = set()
+    try:
+        await get_imports_tree(runtime, scope, imports)
+        used_keys = keyval.used_keys
+    finally:
+        keyval.used_keys = None
+    entries = {key: keyval[key] for key in sorted(used_keys)}
+    # Most values are trees. The rest are peru files, serialized as JSON.
+    trees = sorted(set(val for val in entries.values() if HASH_RE.match(val)))
+
+    manifest = json.dumps({
+        'version': BUNDLE_VERSION,
+        'keyval': entries,
+    }, indent=4, sort_keys=True).encode()
+    with runtime.tmp_dir() as tmp_dir:
+        tmp_bundle = os.path.join(tmp_dir, 'bundle.tar.gz')
+        with tarfile.open(tmp_bundle, 'w:gz') as bundle:
+            _add_bytes(bundle, MANIFEST_NAME, manifest)
+            if trees:
+                pack_path = await runtime.cache.write_pack(trees, tmp_dir)
+                bundle.add(pack_path, PACK_NAME)
+            if plugin_caches:
+                for cache_dir in _plugin_cache_dirs(runtime, scope):
+                    name = os.path.relpath(cache_dir,
+                                           runtime.cache.plugins_root)
+                    bundle.add(
+                        cache_dir,
+                        PLUGINS_DIR + '/' + name.replace(os.sep, '/'))
+        # Don't leave half a bundle behind if something goes wrong.
+        shutil.move(tmp_bundle, path)
+
+
+def _add_bytes(bundle, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    with tempfile.TemporaryFile() as f:
+        f.write(data)
+        f.seek(0)
+        bundle.addfile(info, f)
+
+
+def _plugin_cache_dirs(runtime, scope):
+    '''The existing plugin cache dirs of every module in the project, including
+    the modules of recursive projects that the export parsed.'''
+    scopes = [scope] + [
+        parsed_scope for parsed_scope, _ in runtime.parsed_scopes.values()
+        if parsed_scope is not None
+    ]
+    plugin_context = runtime.get_plugin_context()
+    cache_dirs = set()
+    for each_scope in scopes:
+        for module in each_scope.modules.values():
+            cache_dir = plugin.get_plugin_cache_dir(
+                plugin_context, module.type, module.plugin_fields)
+            if cache_dir is not None and os.path.isdir(cache_dir) and \
+                    os.listdir(cache_dir):
+                cache_dirs.add(cache_dir)
+    return sorted(cache_dirs)
+
+
+async def import_bundle(runtime, path):
+    cache = runtime.cache
+    try:
+        bundle = tarfile.open(path, 'r:*')
+    except (OSError, tarfile.TarError) as e:
+        raise PrintableError('Cannot read cache bundle {}: {}', path, e)
+    with bundle, runtime.tmp_dir() as tmp_dir:
+        entries = _read_manifest(bundle, path)
+        # Add the trees before the entries that point to them.
+        try:
+            pack_member = bundle.getmember(PACK_NAME)
+        except KeyError:
+            pack_member = None
+        if pack_member is not None:
+            pack_path = os.path.join(tmp_dir, PACK_NAME)
+            with bundle.extractfile(pack_member) as src, \
+                    open(pack_path, 'wb') as dest:
+                shutil.copyfileobj(src, dest)
+            try:
+                await cache.import_pack_file(pack_path)
+            except GitError as e:
+                raise PrintableError('Cache bundle {} has a bad pack:\n{}',
+                                     path, e.stderr)
+        # Don't add entries for trees that the pack didn't bring along.
+        missing = await cache.missing_trees(
+            val for val in entries.values() if HASH_RE.match(val))
+        if missing:
+            raise PrintableError(
+                'Cache bundle {} is missing trees for its entries:\n{}', path,
+                '\n'.join('  ' + tree for tree in missing))
+        for key, val in entries.items():
+            if key not in cache.keyval:
+                cache.keyval[key] = val
+        _extract_plugin_caches(bundle, path, cache.plugins_root)
+
+
+def _read_manifest(bundle, path):
+    try:
+        with bundle.extractfile(MANIFEST_NAME) as f:
+            manifest = json.loads(f.read().decode())
+    except (KeyError, ValueError, tarfile.TarError):
+        raise PrintableError('{} is not a peru cache bundle.', path)
+    if not isinstance(manifest, dict):
+        raise PrintableError('{} is not a peru cache bundle.', path)
+    if manifest.get('version') != BUNDLE_VERSION:
+        raise PrintableError(
+            'Cache bundle {} has version {}, but this peru reads version {}.',
+            path, manifest.get('version'), BUNDLE_VERSION)
+    entries = manifest.get('keyval', {})
+    for key, val in entries.items():
+        if not HASH_RE.match(key) or not isinstance(val, str):
+            raise PrintableError('Cache bundle {} has a bad entry: {}', path,
+                                 key)
+    return entries
+
+
+def _extract_plugin_caches(bundle, path, plugins_root):
+    '''Each plugin cache dir is extracted next to where it goes and then
+    renamed into place, unless the cache already has that dir.'''
+    cache_dirs = collections.defaultdict(list)
+    for member in bundle.getmembers():
+        parts = member.name.split('/')
+        if parts[0] != PLUGINS_DIR:
+            continue
+        if not _is_safe_member(member, parts):
+            raise PrintableError('Cache bundle {} has an unsafe path: {}',
+                                 path, member.name)
+        cache_dirs[tuple(parts[1:3])].append(member)
+    for (plugin_type, key), members in sorted(cache_dirs.items()):
+        cache_dir = os.path.join(plugins_root, plugin_type, key)
+        if os.path.isdir(cache_dir) and os.listdir(cache_dir):
+            continue
+        makedirs(os.path.dirname(cache_dir))
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_dir))
+        try:
+            for member in members:
+                relative = member.name.split('/', 3)[3:]
+                if not relative:
+                    # The cache dir itself.
+                    continue
+                member = copy.copy(member)
+                member.name = relative[0]
+                # Keep the permissions, like executable bits, but not the
+                # owner or the times.
+                bundle.extract(
+                    member, tmp_dir, set_attrs=False, **_EXTRACT_ARGS)
+                if member.isfile():
+                    os.chmod(os.path.join(tmp_dir, member.name),
+                             member.mode & 0o755)
+            if os.path.isdir(cache_dir):
+                os.rmdir(cache_dir)
+            os.rename(tmp_dir, cache_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+
+def _is_safe_member(member, parts):
+    if len(parts) < 3 or '' in parts or '.' in parts or '..' in parts:
+        return False
+    if member.isfile() or member.isdir():
+        return True
+    # Symlinks have to stay inside the plugin cache dir.
+    return (member.issym() and not os.path.isabs(member.linkname)
+            and '..' not in member.linkname.split('/'))
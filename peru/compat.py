@@ -8,6 +8,26 @@ import sys
 MODULE_ROOT = os.path.abspath(os.path.dirname(__file__))
 
 
+def yaml_loader():
+    '''PyYAML's pure-Python loader is several times slower than the LibYAML
+    one, which a big peru.yaml makes noticeable. LibYAML is optional, so fall
+    back if PyYAML was built without it. The two report the same marks, which
+    edit_yaml.py relies on. PyYAML is imported here rather than at the top, so
+    that commands that don't parse any YAML never load it.'''
+    import yaml
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def yaml_safe_load(stream):
+    import yaml
+    return yaml.load(stream, Loader=yaml_loader())
+
+
+def yaml_parse(stream):
+    import yaml
+    return yaml.parse(stream, Loader=yaml_loader())
+
+
 def makedirs(path):
     '''os.makedirs() has an exist_ok param, but it still throws errors when the
     path exists with non-default permissions. This isn't fixed until 3.4.
@@ -1,6 +1,7 @@
 import io
-import re
+import json
 import sys
+import time
 
 from . import async_helpers
 
@@ -8,7 +9,8 @@ from . import async_helpers
 # gives a multi-line, real-time view of each running process that looks nice in
 # the terminal. The VerboseDisplay collects output from each job and prints it
 # all when the job is finished, in a way that's suitable for logs. The
-# QuietDisplay prints nothing.
+# QuietDisplay prints nothing. The JsonDisplay writes a JSON object per line
+# for each event, for CI systems and other programs to read.
 #
 # All of the display types inherit from BaseDisplay and provide the same
 # interface. Callers use get_handle() to get a display handle for each
@@ -17,7 +19,10 @@ from . import async_helpers
 # and all of the output from the subprocess is passed to the handle's write()
 # method. There is also a print() method on the display, for output that's not
 # tied to a particular job, which prints to the terminal in a way that won't
-# get stomped on by FancyDisplay's redrawing.
+# get stomped on by FancyDisplay's redrawing. Handles also have a report()
+# method, for facts about the job that aren't output, like its plugin type. And
+# the display has an event() method, for things like modules being resolved
+# from cache, but only the JsonDisplay shows those.
 #
 # Like other errors, we handle job errors by throwing a PrintableError, which
 # get caught in main. So the displays don't need to do anything special to show
@@ -30,11 +35,16 @@ ANSI_ENABLE_LINE_WRAP = '\x1b[?7h'
 
 
 class BaseDisplay:
+    keeps_buffers = False
+    # Callers can skip collecting details that only go into events.
+    emits_events = False
+
     def __init__(self, output=None):
         self.output = output or sys.stdout
         # Every job/handle gets a unique id.
         self._next_job_id = 0
-        # Output from each job is buffered.
+        # Output from each job is buffered, for displays that print it all at
+        # the end. The others don't keep it, because it can be huge.
         self.buffers = {}
         # Each job has a title, like the name of the module being fetched.
         self.titles = {}
@@ -46,7 +56,8 @@ class BaseDisplay:
         job_id = self._next_job_id
         self._next_job_id += 1
         self.titles[job_id] = title
-        self.buffers[job_id] = io.StringIO()
+        if self.keeps_buffers:
+            self.buffers[job_id] = io.StringIO()
         self.outstanding_jobs.add(job_id)
         return _DisplayHandle(self, job_id)
 
@@ -54,6 +65,9 @@ class BaseDisplay:
     def print(self, *args, **kwargs):
         print(*args, file=self.output, **kwargs)
 
+    def event(self, name, **fields):
+        pass
+
     # Callbacks that get overridden by subclasses.
 
     def _job_started(self, job_id):
@@ -62,6 +76,9 @@ class BaseDisplay:
     def _job_written(self, job_id, string):
         pass
 
+    def _job_reported(self, job_id, fields):
+        pass
+
     def _job_finished(self, job_id):
         pass
 
@@ -71,9 +88,13 @@ class BaseDisplay:
         self._job_started(job_id)
 
     def _handle_write(self, job_id, string):
-        self.buffers[job_id].write(string)
+        if self.keeps_buffers:
+            self.buffers[job_id].write(string)
         self._job_written(job_id, string)
 
+    def _handle_report(self, job_id, fields):
+        self._job_reported(job_id, fields)
+
     def _handle_finish(self, job_id):
         self.outstanding_jobs.remove(job_id)
         self._job_finished(job_id)
@@ -89,6 +110,8 @@ class VerboseDisplay(BaseDisplay):
     once, to make sure jobs don't get interleaved. We use '===' as a delimiter
     to try to separate jobs from one another, and from other output.'''
 
+    keeps_buffers = True
+
     def _job_started(self, job_id):
         print('===', 'started', self.titles[job_id], '===', file=self.output)
 
@@ -102,15 +125,23 @@ class VerboseDisplay(BaseDisplay):
 
 class FancyDisplay(BaseDisplay):
     '''Prints a multi-line, real-time display of all the latest output lines
-    from each job.'''
+    from each job.
+
+    Chatty jobs (git progress, curl downloads) can write many times per
+    millisecond, and drawing every one of those would make the terminal the
+    bottleneck. So the display draws at most once per FRAME_INTERVAL, only
+    keeps the one line from each write that could ever be shown, rewrites
+    only the lines that changed since the last frame, and sends each frame to
+    the terminal in a single write.'''
+
+    FRAME_INTERVAL = 0.1
 
     def __init__(self, *args):
         super().__init__(*args)
-        # Every time we draw we need to erase the lines that were printed
-        # before. This keeps track of that number. Note that we split output on
-        # newlines and use no-wrap control codes in the terminal, so we only
-        # need to count the number of jobs drawn.
-        self._lines_printed = 0
+        # The lines currently on the screen, just above the cursor. Note that
+        # we split output on newlines and use no-wrap control codes in the
+        # terminal, so each of these takes exactly one row.
+        self._drawn_lines = []
         # This is the list of all active jobs. There's no guarantee that jobs
         # start in any particular order, so this list also helps us keep the
         # order stable.
@@ -124,6 +155,7 @@ class FancyDisplay(BaseDisplay):
         # receive output. When this asyncio handle is set, it means a draw is
         # already pending.
         self._draw_later_handle = None
+        self._last_draw_time = None
 
     def print(self, *args, **kwargs):
         output = io.StringIO()
@@ -133,52 +165,80 @@ class FancyDisplay(BaseDisplay):
         # fires. Drawing right now ensures that output never gets dropped.
         self._draw()
 
-    def _draw(self):
-        self._cancel_draw_later()
-
-        # Erase everything we printed before.
-        for i in range(self._lines_printed):
-            self.output.write(ANSI_CURSOR_UP_ONE_LINE)
-            self.output.write(ANSI_CLEAR_LINE)
-        self._lines_printed = 0
-
-        # If we have any lines from print(), print them now. They will end up
-        # above the display like regular output.
-        for string in self._to_print:
-            self.output.write(string)
-        self._to_print.clear()
-
-        # Redraw all the jobs.
-        self.output.write(ANSI_DISABLE_LINE_WRAP)
+    def _render_lines(self):
+        lines = []
         for slot, job_id in enumerate(self._job_slots):
             # Fancy unicode box characters in the left column.
             if slot == 0:
-                self.output.write('┌' if len(self._job_slots) > 1 else '╶')
+                corner = '┌' if len(self._job_slots) > 1 else '╶'
             elif slot < len(self._job_slots) - 1:
-                self.output.write('├')
+                corner = '├'
             else:
-                self.output.write('└')
-            self.output.write(' ')
-            self.output.write(self.titles[job_id])
-            self.output.write(': ')
-            self.output.write(self._output_lines[job_id])
+                corner = '└'
             # Some terminals keep overwriting the last character in no-wrap
             # mode. Make the trailing character a space.
-            self.output.write(' ')
-            self.output.write('\n')
-            self._lines_printed += 1
-        self.output.write(ANSI_ENABLE_LINE_WRAP)
+            lines.append('{} {}: {} '.format(corner, self.titles[job_id],
+                                             self._output_lines[job_id]))
+        return lines
 
-        # Finally, flush output to the terminal. Hopefully everything gets
-        # painted in one frame.
-        self.output.flush()
+    def _draw(self):
+        self._cancel_draw_later()
+        self._last_draw_time = time.monotonic()
+        old_lines = self._drawn_lines
+        new_lines = self._render_lines()
+        frame = []
+
+        if self._to_print:
+            # Printed lines go above the display, so everything below them
+            # has to be redrawn.
+            frame.append(
+                (ANSI_CURSOR_UP_ONE_LINE + ANSI_CLEAR_LINE) * len(old_lines))
+            frame.extend(self._to_print)
+            self._to_print.clear()
+            old_lines = []
+
+        # Skip over the lines at the top that haven't changed.
+        unchanged = 0
+        while (unchanged < min(len(old_lines), len(new_lines))
+               and old_lines[unchanged] == new_lines[unchanged]):
+            unchanged += 1
+        if unchanged < max(len(old_lines), len(new_lines)):
+            frame.append(ANSI_CURSOR_UP_ONE_LINE *
+                         (len(old_lines) - unchanged))
+            frame.append(ANSI_DISABLE_LINE_WRAP)
+            for i in range(unchanged, len(new_lines)):
+                if i < len(old_lines) and old_lines[i] == new_lines[i]:
+                    # Just step over lines that are already right.
+                    frame.append('\n')
+                else:
+                    frame.append(ANSI_CLEAR_LINE + new_lines[i] + '\n')
+            # If there are fewer jobs than before, clear the leftover lines and
+            # come back up to the end of the display.
+            leftover = len(old_lines) - len(new_lines)
+            if leftover > 0:
+                frame.append((ANSI_CLEAR_LINE + '\n') * leftover)
+                frame.append(ANSI_CURSOR_UP_ONE_LINE * leftover)
+            frame.append(ANSI_ENABLE_LINE_WRAP)
+        self._drawn_lines = new_lines
+
+        # Finally, send the whole frame to the terminal at once. Hopefully
+        # everything gets painted in one frame.
+        if frame:
+            self.output.write(''.join(frame))
+            self.output.flush()
 
     def _draw_later(self):
         if self._draw_later_handle:
             # There is already a draw pending.
             return
-        self._draw_later_handle = async_helpers.EVENT_LOOP.call_later(
-            0.1, self._draw)
+        # Draw right away if the last frame was long enough ago, and otherwise
+        # wait until the next frame is due.
+        delay = self.FRAME_INTERVAL
+        if self._last_draw_time is not None:
+            elapsed = time.monotonic() - self._last_draw_time
+            delay = max(0, self.FRAME_INTERVAL - elapsed)
+        self._draw_later_handle = async_helpers.get_event_loop().call_later(
+            delay, self._draw)
 
     def _cancel_draw_later(self):
         if self._draw_later_handle:
@@ -191,19 +251,12 @@ class FancyDisplay(BaseDisplay):
         self._draw_later()
 
     def _job_written(self, job_id, string):
-        # We need to split output on newlines. Some programs (git) also use
-        # carriage return to redraw a line, so we split on that too.
-        any_newlines = '(?:\n|\r)+'  # (?: is non-capturing, for split()
-        lines = [line.strip() for line in re.split(any_newlines, string)]
-
-        # NB: We don't make any attempt here to join lines that might span
-        # multiple write() calls. `create_subprocess_with_handle()` reads
-        # output in 4096 byte chunks, so this isn't likely, but it's possible.
-        for line in lines:
-            # Ignore empty lines, both from the job and from re.split().
-            if line:
-                self._output_lines[job_id] = line
-        self._draw_later()
+        # Only the last line of output can ever be drawn, so don't bother
+        # splitting the rest.
+        line = _last_nonempty_line(string)
+        if line is not None:
+            self._output_lines[job_id] = line
+            self._draw_later()
 
     def _job_finished(self, job_id):
         self._job_slots.remove(job_id)
@@ -219,6 +272,91 @@ class FancyDisplay(BaseDisplay):
             self._draw_later()
 
 
+class JsonDisplay(BaseDisplay):
+    '''Writes one JSON object per line for each event: jobs starting and
+    finishing (with whatever the job reported about itself), modules being
+    resolved, and anything printed. Every event has an "event" name and a
+    "time" in seconds since the display was created. If `wrapped` is given,
+    jobs and printed output are passed through to that display too, so that
+    the JSON can go to a file while the terminal looks the same as usual.'''
+
+    emits_events = True
+
+    def __init__(self, output=None, wrapped=None):
+        super().__init__(output)
+        self._wrapped = wrapped
+        self._wrapped_handles = {}
+        self._start_times = {}
+        self._reports = {}
+        self._clock_start = time.monotonic()
+
+    def get_handle(self, title):
+        handle = super().get_handle(title)
+        if self._wrapped is not None:
+            self._wrapped_handles[handle._job_id] = self._wrapped.get_handle(
+                title)
+        return handle
+
+    def print(self, *args, **kwargs):
+        if self._wrapped is not None:
+            self._wrapped.print(*args, **kwargs)
+        output = io.StringIO()
+        print(*args, file=output, **kwargs)
+        self.event('message', text=output.getvalue())
+
+    def event(self, name, **fields):
+        record = {
+            'event': name,
+            'time': round(time.monotonic() - self._clock_start, 6),
+        }
+        record.update(fields)
+        self.output.write(json.dumps(record) + '\n')
+        self.output.flush()
+
+    def _job_started(self, job_id):
+        self._start_times[job_id] = time.monotonic()
+        self.event('job_started', job=job_id, module=self.titles[job_id])
+        if self._wrapped is not None:
+            self._wrapped_handles[job_id].__enter__()
+
+    def _job_written(self, job_id, string):
+        if self._wrapped is not None:
+            self._wrapped_handles[job_id].write(string)
+
+    def _job_reported(self, job_id, fields):
+        self._reports.setdefault(job_id, {}).update(fields)
+
+    def _job_finished(self, job_id):
+        duration = time.monotonic() - self._start_times.pop(job_id)
+        self.event(
+            'job_finished',
+            job=job_id,
+            module=self.titles[job_id],
+            duration=round(duration, 6),
+            **self._reports.pop(job_id, {}))
+        if self._wrapped is not None:
+            self._wrapped_handles.pop(job_id).__exit__(None, None, None)
+
+
+def _last_nonempty_line(string):
+    '''Returns the last line of the string with any surrounding whitespace
+    stripped, skipping lines that are empty, or None if there aren't any.
+    Some programs (git) use carriage returns to redraw a line, so those count
+    as line breaks too.
+
+    NB: We don't make any attempt here to join lines that might span multiple
+    write() calls. create_subprocess_with_handle() reads output in big
+    chunks, so this isn't likely, but it's possible.'''
+    end = len(string)
+    while end > 0:
+        start = max(string.rfind('\n', 0, end), string.rfind('\r', 0, end))
+        line = string[start + 1:end].strip()
+        if line:
+            return line
+        end = max(start, 0)
+    return None
+
+
 class _DisplayHandle:
     def __init__(self, display, job_id):
         self._display = display
@@ -230,6 +368,12 @@ class _DisplayHandle:
         assert self._opened and not self._closed
         self._display._handle_write(self._job_id, string)
 
+    def report(self, **fields):
+        '''Attach facts about the job, like how long it waited to start, to
+        the event for when it finishes.'''
+        assert not self._closed
+        self._display._handle_report(self._job_id, fields)
+
     # Context manager interface. We're extra careful to make sure that the
     # handle is only written to inside a with statment, and only used once.
     def __enter__(self):
@@ -1,26 +1,79 @@
+import os
+import shutil
+import tempfile
+
 import yaml
 
+from . import compat
+
 
 def set_module_field_in_file(yaml_file_path, module_name, field_name, new_val):
+    set_module_fields_in_file(yaml_file_path,
+                              [(module_name, field_name, new_val)])
+
+
+def set_module_fields_in_file(yaml_file_path, updates):
+    '''Apply a batch of (module_name, field_name, new_val) updates to a file,
+    with one parse and one write. The write is atomic, so a concurrent reader
+    never sees a half-written file. If there are no updates, the file isn't
+    touched at all.'''
+    if not updates:
+        return
     with open(yaml_file_path) as f:
         yaml_text = f.read()
-    new_yaml_text = set_module_field(yaml_text, module_name, field_name,
-                                     new_val)
-    with open(yaml_file_path, "w") as f:
-        f.write(new_yaml_text)
+    new_yaml_text = set_module_fields(yaml_text, updates)
+    if new_yaml_text == yaml_text:
+        return
+    # Replace the file that a symlink points to, rather than the symlink.
+    real_path = os.path.realpath(yaml_file_path)
+    dir_name, base_name = os.path.split(real_path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix=base_name + '.')
+    try:
+        with open(fd, 'w') as f:
+            f.write(new_yaml_text)
+        shutil.copymode(real_path, tmp_path)
+        os.replace(tmp_path, real_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 
 def set_module_field(yaml_text, module_name, field_name, new_val):
+    return set_module_fields(yaml_text, [(module_name, field_name, new_val)])
+
+
+def set_module_fields(yaml_text, updates):
+    '''Apply a batch of (module_name, field_name, new_val) updates to some
+    YAML text. All the edits are located in a single parse of the original
+    text, and then spliced in from the end backwards, so that no edit moves
+    the position of another one that's still to come. Setting the same field
+    twice keeps the last value.'''
     yaml_dict = _parse_yaml_text(yaml_text)
-    bounds = _get_module_field_bounds(yaml_dict, module_name, field_name)
-    quoted_val = _maybe_quote(new_val)
-    if bounds:
-        # field exists, modify it
-        return yaml_text[:bounds[0]] + quoted_val + yaml_text[bounds[1]:]
-    else:
-        # field is new, hack it in
-        return _append_module_field(yaml_text, yaml_dict, module_name,
-                                    field_name, quoted_val)
+    # Dicts keep insertion order, so new fields for the same module are
+    # appended in the order they were given.
+    latest = {}
+    for module_name, field_name, new_val in updates:
+        latest.pop((module_name, field_name), None)
+        latest[(module_name, field_name)] = new_val
+    yaml_lines = yaml_text.split("\n")
+    edits = []
+    for (module_name, field_name), new_val in latest.items():
+        bounds = _get_module_field_bounds(yaml_dict, module_name, field_name)
+        quoted_val = _maybe_quote(new_val)
+        if bounds:
+            # field exists, modify it
+            edits.append((bounds[0], bounds[1], quoted_val))
+        else:
+            # field is new, hack it in
+            edits.append(
+                _append_module_field_edit(yaml_lines, yaml_dict, module_name,
+                                          field_name, quoted_val))
+    # Sort by position, keeping the given order for insertions at the same
+    # spot, and then apply from the end.
+    ordered = sorted(enumerate(edits), key=lambda item: (item[1][0], item[0]))
+    for _, (start, end, text) in reversed(ordered):
+        yaml_text = yaml_text[:start] + text + yaml_text[end:]
+    return yaml_text
 
 
 def _maybe_quote(val):
@@ -45,15 +98,16 @@ def _maybe_quote(val):
         return val
 
 
-def _append_module_field(yaml_text, yaml_dict, module_name, field_name,
-                         new_val):
+def _append_module_field_edit(yaml_lines, yaml_dict, module_name, field_name,
+                              new_val):
+    '''Returns a (start, end, text) edit that inserts a new field as the last
+    line of a module.'''
     module_fields = yaml_dict[module_name]
     # use the last field to determine position and indentation
     assert len(module_fields) > 0, "There aren't any fields here!"
     last_key = module_fields.keys[-1]
     last_val = module_fields.vals[-1]
     indentation = " " * last_key.start_mark.column
-    yaml_lines = yaml_text.split("\n")
 
     # We want to append the new field at the end of the module. Unfortunately,
     # the end_mark of a multi-line field is actually the first line of the next
@@ -68,9 +122,14 @@ def _append_module_field(yaml_text, yaml_dict, module_name, field_name,
             new_line_number -= 1
 
     new_line = "{}{}: {}".format(indentation, field_name, new_val)
-    new_yaml_lines = (yaml_lines[:new_line_number] + [new_line] +
-                      yaml_lines[new_line_number:])
-    return "\n".join(new_yaml_lines)
+    if new_line_number >= len(yaml_lines):
+        # The text doesn't end with a newline, so the new line goes after it.
+        end = len("\n".join(yaml_lines))
+        return (end, end, "\n" + new_line)
+    # The start of the line, counting the newline at the end of each line
+    # before it.
+    start = sum(len(line) + 1 for line in yaml_lines[:new_line_number])
+    return (start, start, new_line + "\n")
 
 
 def _get_module_field_bounds(yaml_dict, module_name, field_name):
@@ -82,7 +141,7 @@ def _get_module_field_bounds(yaml_dict, module_name, field_name):
 
 
 def _parse_yaml_text(yaml_text):
-    events_list = list(yaml.parse(yaml_text))
+    events_list = list(compat.yaml_parse(yaml_text))
     return _parse_events_list(events_list)
 
 
@@ -0,0 +1,360 @@
+'''An optional filesystem monitor for the sync dir. The no-op `peru sync` has
+to check that none of the imported files have been modified, and normally that
+means `git diff-files`, which stats every one of them. With PERU_FSMONITOR set
+(Linux only), peru instead starts a small background process that watches the
+sync dir with inotify and keeps a journal of changed paths. Each sync asks it
+which paths have changed since the last time the working copy was known to be
+clean, and only checks those.
+
+The journal is handed out in terms of tokens. A token names a point in the
+watcher's history, and a query with a token returns every path that changed
+after that point, along with a new token for the present. If the watcher
+can't answer precisely (because it was restarted, the kernel queue overflowed,
+or it ran out of inotify watches), it returns None for the paths, and the
+caller falls back to a full scan. Over-reporting paths is always safe.
+Under-reporting is not, so every uncertain case resets the history.
+
+The watcher listens on a Linux abstract socket, which disappears with the
+process, so there's never a stale socket to clean up. It exits by itself after
+a long idle period, or if the sync dir goes away. This module only imports from
+the standard library, to keep the watcher process small.'''
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import os
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import time
+import uuid
+
+# The watcher exits if nobody queries it for this long.
+IDLE_TIMEOUT = 8 * 60 * 60
+
+# If this many distinct paths change, stop tracking them and reset the history.
+# The caller's next diff-files would be nearly a full scan anyway.
+MAX_CHANGED_PATHS = 100000
+
+QUERY_TIMEOUT = 2
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+              | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def is_supported():
+    return sys.platform.startswith('linux')
+
+
+class FSMonitor:
+    '''The client side. `root` is the sync dir. Tokens are saved in the state
+    dir, and any `ignore` dirs (like the state dir itself) that are inside the
+    root are left out of the watch.'''
+
+    def __init__(self, root, state_dir, ignore=()):
+        self.root = os.path.abspath(root)
+        self.state_dir = os.path.abspath(state_dir)
+        self.token_path = os.path.join(self.state_dir, 'fsmonitor_token')
+        self.ignore = []
+        for path in ignore:
+            relpath = os.path.relpath(os.path.abspath(path), self.root)
+            if relpath != os.curdir and not relpath.startswith(os.pardir):
+                self.ignore.append(relpath)
+        self.address = _address(self.root, self.state_dir)
+
+    def get_changes(self):
+        '''Returns a (token, paths) pair, where paths is a list of every path
+        under the root that has changed since the last call to save_token(),
+        or None if we can't know. If the watcher isn't running yet, this
+        starts it and returns (None, None).'''
+        try:
+            with open(self.token_path) as f:
+                saved_token = f.read() or None
+        except FileNotFoundError:
+            saved_token = None
+        try:
+            response = self._request({'since': saved_token})
+        except ConnectionRefusedError:
+            self._start_watcher()
+            return None, None
+        except (OSError, ValueError):
+            return None, None
+        return response['token'], response['paths']
+
+    def save_token(self, token):
+        '''Record that the working copy was clean as of `token`.'''
+        if token is None:
+            return
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.token_path, 'w') as f:
+            f.write(token)
+
+    def stop(self):
+        try:
+            self._request({'stop': True})
+        except OSError:
+            pass
+
+    def _request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(QUERY_TIMEOUT)
+            sock.connect(self.address)
+            # Anyone can bind an abstract socket name. Only trust our own.
+            _check_peer_uid(sock)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            response = _read_line(sock)
+        return json.loads(response.decode())
+
+    def _start_watcher(self):
+        # Make sure the watcher can import this module, even if peru isn't
+        # installed where the interpreter would find it by default.
+        env = dict(os.environ)
+        package_parent = os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [package_parent] + [p for p in [env.get('PYTHONPATH')] if p])
+        subprocess.Popen(
+            [sys.executable, '-m', 'peru.fsmonitor', self.root,
+             self.state_dir] + self.ignore,
+            cwd='/',
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True)
+
+
+def _address(root, state_dir):
+    digest = hashlib.sha1('{}\0{}'.format(root, state_dir).encode(
+        errors='surrogateescape')).hexdigest()
+    return '\0peru-fsmonitor-' + digest
+
+
+def _check_peer_uid(sock):
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    if uid != os.getuid():
+        raise PermissionError(
+            'fsmonitor socket is owned by uid {}'.format(uid))
+
+
+def _read_line(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    return b''.join(chunks)
+
+
+class _Inotify:
+    def __init__(self):
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                          WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self):
+        '''Yields (wd, mask, name) for every event that's already queued.'''
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(
+                    data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                yield wd, mask, os.fsdecode(name)
+
+
+class _Watcher:
+    '''Keeps the journal of changed paths, relative to the root.'''
+
+    def __init__(self, root, ignore):
+        self.root = root
+        self.ignore = ignore
+        self.inotify = _Inotify()
+        self.dirs = {}
+        self.changes = {}
+        self.generation = 0
+        self.usable = True
+        self.root_gone = False
+        self._reset()
+        self._watch_tree('')
+
+    def query(self, since):
+        self.drain()
+        if not self.usable:
+            return {'token': None, 'paths': None}
+        token = '{}:{}'.format(self.epoch, self.generation)
+        paths = None
+        if since is not None:
+            epoch, _, generation = since.partition(':')
+            if epoch == self.epoch and generation.isdigit():
+                generation = int(generation)
+                paths = sorted(path for path, changed in self.changes.items()
+                               if changed > generation)
+        return {'token': token, 'paths': paths}
+
+    def drain(self):
+        # Anything that was written before a query arrived is already in the
+        # kernel's queue, so reading it all here means the answer is never
+        # stale.
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self._reset()
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            dir = self.dirs.get(wd)
+            if dir is None:
+                continue
+            if not name:
+                # Events on a subdir itself are also reported by its parent,
+                # with a name. Only the root has no parent watching it.
+                if dir == '' and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    self.root_gone = True
+                continue
+            path = os.path.join(dir, name)
+            if self._is_ignored(path):
+                continue
+            self._record(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # A dir that was created or moved in needs watches of its own.
+                # Anything written inside it before those were added is still
+                # covered, because the dir's own path is in the journal.
+                self._watch_tree(path)
+
+    def _record(self, path):
+        self.generation += 1
+        self.changes[path] = self.generation
+        if len(self.changes) > MAX_CHANGED_PATHS:
+            self._reset()
+
+    def _reset(self):
+        # A new epoch invalidates every token handed out so far.
+        self.epoch = uuid.uuid4().hex
+        self.changes.clear()
+
+    def _is_ignored(self, path):
+        return any(path == ignored or path.startswith(ignored + os.sep)
+                   for ignored in self.ignore)
+
+    def _watch_tree(self, relpath):
+        # Add the watch on each dir before listing it, so that nothing created
+        # in between can slip through.
+        stack = [relpath]
+        while stack:
+            dir = stack.pop()
+            try:
+                wd = self.inotify.add_watch(os.path.join(self.root, dir))
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    # Already gone. Its parent will have reported that.
+                    continue
+                # Most likely ENOSPC, out of watches. We can't answer
+                # precisely from now on.
+                self.usable = False
+                return
+            # Moving a dir keeps its watch (and its wd), so always update the
+            # path here.
+            self.dirs[wd] = dir
+            try:
+                entries = list(os.scandir(os.path.join(self.root, dir)))
+            except OSError:
+                continue
+            for entry in entries:
+                child = os.path.join(dir, entry.name)
+                if (entry.is_dir(follow_symlinks=False)
+                        and not self._is_ignored(child)):
+                    stack.append(child)
+
+
+def serve(root, state_dir, ignore):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(_address(root, state_dir))
+    except OSError:
+        # Another watcher already has this root.
+        return
+    listener.listen()
+    # Connections that arrive during the initial scan wait in the backlog.
+    watcher = _Watcher(root, ignore)
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(watcher.inotify.fd, selectors.EVENT_READ)
+    last_query = time.monotonic()
+    while not watcher.root_gone:
+        for key, _ in selector.select(timeout=60):
+            if key.fileobj is listener:
+                last_query = time.monotonic()
+                conn, _ = listener.accept()
+                with conn:
+                    if not _handle_connection(conn, watcher):
+                        return
+            else:
+                watcher.drain()
+        if time.monotonic() - last_query > IDLE_TIMEOUT:
+            return
+
+
+def _handle_connection(conn, watcher):
+    '''Returns False if the watcher should stop.'''
+    try:
+        conn.settimeout(QUERY_TIMEOUT)
+        _check_peer_uid(conn)
+        request = json.loads(_read_line(conn).decode())
+        if request.get('stop'):
+            conn.sendall(b'{}\n')
+            return False
+        response = watcher.query(request.get('since'))
+        conn.sendall(json.dumps(response).encode() + b'\n')
+    except (OSError, ValueError):
+        pass
+    return True
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1], sys.argv[2], sys.argv[3:])
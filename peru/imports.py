@@ -1,23 +1,129 @@
+import fnmatch
+import json
 import os
+import posixpath
 from pathlib import Path
 
 from .async_helpers import gather_coalescing_exceptions
 from . import compat
-from .error import error_context
+from .error import error_context, PrintableError
 from .merge import merge_imports_tree
+from . import trace
+
+
+async def checkout(runtime, scope, imports, sync_dirs, selection=None):
+    '''Export the imports to each of the given sync dirs. The target trees are
+    only resolved once, and then the exports all run at the same time. Each
+    sync dir has its own saved tree and index (see
+    Runtime.get_sync_state_dir), so switching between them stays on the fast
+    path.
+
+    If `selection` is given, it's a list of targets or path patterns (see
+    select_imports), and this is a sparse sync. Only the selected imports are
+    fetched and rewritten. Every other import stays exactly the way it was
+    last synced, using the target trees recorded in lastimports.targets.'''
+    state_dirs = [runtime.get_sync_state_dir(path) for path in sync_dirs]
+    if selection is None or any(
+            _get_last_targets(state_dir) is None
+            and _get_last_imports(state_dir) is not None
+            for state_dir in state_dirs):
+        # A sync dir that was synced before we started recording target trees
+        # can't be updated sparsely, because we don't know which parts of it
+        # belong to which import. Fall back to a full sync this once.
+        selected = list(imports)
+        sparse = False
+    else:
+        selected = select_imports(imports, selection)
+        sparse = True
+    target_trees = await get_trees(runtime, scope, selected)
+    if len(sync_dirs) == 1:
+        await _export_imports(runtime, imports, target_trees, sync_dirs[0],
+                              state_dirs[0], sparse)
+        return
+    futures = []
+    for path, state_dir in zip(sync_dirs, state_dirs):
+        futures.append(
+            _export_imports(runtime, imports, target_trees, path, state_dir,
+                            sparse))
+    await gather_coalescing_exceptions(
+        futures, runtime.display, verbose=runtime.verbose)
 
 
-async def checkout(runtime, scope, imports, path):
-    imports_tree = await get_imports_tree(runtime, scope, imports)
-    last_imports_tree = _get_last_imports(runtime)
-    index = _last_imports_index(runtime)
-    await runtime.cache.export_tree(
+async def _export_imports(runtime, imports, target_trees, path, state_dir,
+                          sparse):
+    # Start from the current imports that we just resolved, and then for a
+    # sparse sync, add back everything else just as it was last time.
+    synced_imports = {}
+    synced_trees = {}
+    for target, import_paths in imports.items():
+        if target in target_trees:
+            synced_imports[target] = import_paths
+            synced_trees[target] = target_trees[target]
+    last_targets = (_get_last_targets(state_dir) or {}) if sparse else {}
+    for target, record in last_targets.items():
+        if target not in synced_imports and target not in target_trees:
+            synced_imports[target] = tuple(record['paths'])
+            synced_trees[target] = record['tree']
+    imports_tree = await merge_imports_tree(runtime.cache, synced_imports,
+                                            synced_trees)
+    is_main_sync_dir = state_dir == runtime.state_dir
+    export = runtime.cache.export_tree(
         imports_tree,
         path,
-        last_imports_tree,
+        _get_last_imports(state_dir),
         force=runtime.force,
-        previous_index_file=index)
-    _set_last_imports(runtime, imports_tree)
+        previous_index_file=_last_imports_index(state_dir),
+        # The filesystem monitor only watches the main sync dir.
+        fsmonitor=runtime.fsmonitor if is_main_sync_dir else None)
+    with trace.span('export', dest=path):
+        if is_main_sync_dir:
+            await export
+        else:
+            with error_context('sync dir "{}"'.format(path)):
+                await export
+    _set_last_targets(state_dir, {
+        target: {'tree': synced_trees[target], 'paths': list(import_paths)}
+        for target, import_paths in synced_imports.items()
+    })
+    _set_last_imports(state_dir, imports_tree)
+
+
+def select_imports(imports, selection):
+    '''Return the targets of the imports picked out by `selection`. Each item
+    in the selection can be an import target exactly as it's written in
+    peru.yaml ("foo|bar"), a module name ("foo"), or a glob that matches one
+    of the paths an import is synced to ("third_party/*"). A path inside an
+    import's directory picks that import too.'''
+    selected = []
+    for item in selection:
+        pattern = _normalize_import_path(item)
+        matches = [
+            target for target, paths in imports.items()
+            if item in (target, _module_name(target))
+            or any(_path_matches(pattern, path) for path in paths)
+        ]
+        if not matches:
+            raise PrintableError('No imports match "{}".', item)
+        selected.extend(target for target in matches
+                        if target not in selected)
+    return selected
+
+
+def _module_name(target):
+    return target.split('|')[0].strip()
+
+
+def _normalize_import_path(path):
+    return posixpath.normpath(path.replace(os.sep, '/')).lstrip('/')
+
+
+def _path_matches(pattern, import_path):
+    import_path = _normalize_import_path(import_path)
+    if import_path == '.':
+        # An import at the root of the sync dir contains every path.
+        return True
+    return (fnmatch.fnmatchcase(import_path, pattern)
+            or pattern.startswith(import_path + '/'))
 
 
 async def get_imports_tree(runtime, scope, imports, base_tree=None):
@@ -37,7 +143,7 @@ async def get_trees(runtime, scope, targets):
 async def get_tree(runtime, scope, target_str):
     module, rules = await scope.parse_target(runtime, target_str)
     context = 'target "{}"'.format(target_str)
-    with error_context(context):
+    with error_context(context), trace.span('target', target=target_str):
         tree = await module.get_tree(runtime)
         if module.default_rule:
             tree = await module.default_rule.get_tree(runtime, tree)
@@ -46,27 +152,50 @@ async def get_tree(runtime, scope, target_str):
     return tree
 
 
-def _last_imports_path(runtime):
-    return Path(runtime.state_dir) / 'lastimports'
+def _last_imports_path(state_dir):
+    return Path(state_dir) / 'lastimports'
 
 
-def _get_last_imports(runtime):
+def _get_last_imports(state_dir):
     last_imports_tree = None
-    if _last_imports_path(runtime).exists():
-        with _last_imports_path(runtime).open() as f:
+    if _last_imports_path(state_dir).exists():
+        with _last_imports_path(state_dir).open() as f:
             last_imports_tree = f.read()
     return last_imports_tree
 
 
-def _set_last_imports(runtime, tree):
-    if tree == _get_last_imports(runtime):
+def _set_last_imports(state_dir, tree):
+    if tree == _get_last_imports(state_dir):
         # Don't modify the lastimports file if the imports haven't changed.
         # This lets you use it as a build stamp for Make.
         return
-    compat.makedirs(_last_imports_path(runtime).parent)
-    with _last_imports_path(runtime).open('w') as f:
+    compat.makedirs(_last_imports_path(state_dir).parent)
+    with _last_imports_path(state_dir).open('w') as f:
         f.write(tree)
 
 
-def _last_imports_index(runtime):
-    return os.path.join(runtime.state_dir, 'lastimports.index')
+def _last_targets_path(state_dir):
+    return Path(state_dir) / 'lastimports.targets'
+
+
+def _get_last_targets(state_dir):
+    '''The tree and paths of every import in the last sync, or None if there's
+    no record.'''
+    try:
+        with _last_targets_path(state_dir).open() as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _set_last_targets(state_dir, targets):
+    if targets == _get_last_targets(state_dir):
+        return
+    compat.makedirs(_last_targets_path(state_dir).parent)
+    with _last_targets_path(state_dir).open('w') as f:
+        json.dump(targets, f, indent=4, sort_keys=True)
+
+
+def _last_imports_index(state_dir):
+    compat.makedirs(state_dir)
+    return os.path.join(state_dir, 'lastimports.index')
@@ -4,45 +4,83 @@ import shutil
 import tempfile
 
 from . import compat
+from . import trace
 
 
 class KeyVal:
     '''A generic way to store key-value pairs on disk. Just creates files in a
-    folder whose names are the keys and whose contents are the values.'''
+    folder whose names are the keys and whose contents are the values.
 
-    def __init__(self, root, tmp_dir):
+    Reads fall through to the folders in `lower_roots`, in order, for keys
+    that aren't in `root`. Those folders are never written to, and a key
+    can't be deleted from them. See cache._Cache.'''
+
+    def __init__(self, root, tmp_dir, lower_roots=()):
         self._root = root
         self._tmp_dir = tmp_dir
+        self._lower_roots = list(lower_roots)
+        # Set this to a set to record every key that's read or written. See
+        # `peru cache export`.
+        self.used_keys = None
         compat.makedirs(root)
         compat.makedirs(tmp_dir)
 
     def __getitem__(self, key):
-        with open(self._path(key)) as f:
-            return f.read()
+        with trace.span('keyval get', key=key):
+            with open(self._find(key)) as f:
+                val = f.read()
+            self._record(key)
+            return val
 
     def __setitem__(self, key, val):
-        # Write to a tmp file first, to avoid partial reads.
-        tmp_path = self._tmp_file()
-        with open(tmp_path, "w") as f:
-            f.write(val)
-        shutil.move(tmp_path, self._path(key))
+        with trace.span('keyval set', key=key):
+            # Write to a tmp file first, to avoid partial reads.
+            tmp_path = self._tmp_file()
+            with open(tmp_path, "w") as f:
+                f.write(val)
+            shutil.move(tmp_path, self._path(key))
+            self._record(key)
 
     def __delitem__(self, key):
         if os.path.exists(self._path(key)):
             os.remove(self._path(key))
 
     def __contains__(self, key):
-        return os.path.isfile(self._path(key))
+        with trace.span('keyval lookup', key=key) as span:
+            found = os.path.isfile(self._find(key))
+            span.set(found=found)
+            if found:
+                self._record(key)
+            return found
 
     def __iter__(self):
-        return iter(os.listdir(self._root))
+        keys = dict.fromkeys(os.listdir(self._root))
+        for root in self._lower_roots:
+            if os.path.isdir(root):
+                keys.update(dict.fromkeys(os.listdir(root)))
+        return iter(keys)
 
     def __len__(self):
-        return len(os.listdir(self._root))
+        return sum(1 for _ in self)
+
+    def _record(self, key):
+        if self.used_keys is not None:
+            self.used_keys.add(key)
 
     def _path(self, key):
         return os.path.join(self._root, key)
 
+    def _find(self, key):
+        '''The path to read a key from: the first layer that has it, or the
+        top layer if none do.'''
+        path = self._path(key)
+        if self._lower_roots and not os.path.isfile(path):
+            for root in self._lower_roots:
+                lower_path = os.path.join(root, key)
+                if os.path.isfile(lower_path):
+                    return lower_path
+        return path
+
     def _tmp_file(self):
         fd, path = tempfile.mkstemp(dir=self._tmp_dir)
         os.close(fd)
@@ -0,0 +1,136 @@
+'''peru.lock records the tree that each module and rule of a project resolved
+to, keyed on the same cache keys as the keyval. `peru lock` writes it, next to
+peru.yaml.
+
+When a project has a lock file, a module that isn't in the local keyval, but
+whose locked tree is already in the cache's git objects (from `peru cache
+import`, a read-only cache layer, or the remote cache's packs), is used
+directly, without running its plugin. And whenever a module is fetched or a
+rule runs, the result has to match the lock. That catches upstreams that
+change what a pinned rev or URL means, and lets unpinned modules stay on the
+locked tree as long as it's available.'''
+
+import json
+import os
+import re
+
+from .error import PrintableError
+from .imports import get_imports_tree
+
+LOCK_VERSION = 1
+KINDS = ('modules', 'rules')
+
+HASH_RE = re.compile('^[0-9a-f]{40}$')
+
+
+class LockMismatchError(PrintableError):
+    pass
+
+
+class Lockfile:
+    def __init__(self, entries=None):
+        # {kind: {key: {'name': name, 'tree': tree}}}
+        self.entries = entries or {kind: {} for kind in KINDS}
+
+    def get(self, kind, key):
+        entry = self.entries[kind].get(key)
+        return entry['tree'] if entry is not None else None
+
+    def record(self, kind, key, name, tree):
+        self.entries[kind][key] = {'name': name, 'tree': tree}
+
+    def write(self, path):
+        data = dict(self.entries, version=LOCK_VERSION)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=4, sort_keys=True)
+            f.write('\n')
+        os.replace(tmp_path, path)
+
+
+def lock_path(peru_file):
+    '''peru.yaml gets peru.lock, and so on for other peru file names.'''
+    return os.path.splitext(peru_file)[0] + '.lock'
+
+
+def load(path):
+    '''Returns the Lockfile at the path, or None if there isn't one.'''
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        raise PrintableError('{} is not valid JSON: {}', path, e)
+    if not isinstance(data, dict) or data.get('version') != LOCK_VERSION:
+        raise PrintableError('{} is not a version {} peru lock file.', path,
+                             LOCK_VERSION)
+    entries = {}
+    for kind in KINDS:
+        entries[kind] = data.get(kind, {})
+        for key, entry in entries[kind].items():
+            if not (HASH_RE.match(key) and isinstance(entry, dict)
+                    and HASH_RE.match(str(entry.get('tree')))):
+                raise PrintableError('{} has a bad entry: {}', path, key)
+    return Lockfile(entries)
+
+
+def agrees(runtime, kind, key, tree):
+    '''Whether a tree from the keyval or the remote cache is the one that
+    peru.lock has for the key, or the lock doesn't say.'''
+    if runtime.lock is None:
+        return True
+    locked = runtime.lock.get(kind, key)
+    return locked is None or locked == tree
+
+
+async def get_locked_tree(runtime, kind, key):
+    '''If peru.lock has a tree for the key, and the cache has it or can get it
+    from the remote cache, add it to the keyval and return it. Otherwise
+    return None. Git objects are named by their contents, so having the tree
+    is all the verification it needs.'''
+    if runtime.lock is None:
+        return None
+    tree = runtime.lock.get(kind, key)
+    if tree is None:
+        return None
+    found = await runtime.cache.has_tree(tree)
+    if not found and runtime.remote_cache is not None:
+        found = await runtime.remote_cache.get_tree(tree)
+    runtime.cache.stats.record('lock file', found, key)
+    if not found:
+        return None
+    runtime.cache.keyval[key] = tree
+    return tree
+
+
+def check(runtime, kind, key, name, tree):
+    '''Raise an error if a tree that was just fetched or computed isn't the
+    one in peru.lock.'''
+    if agrees(runtime, kind, key, tree):
+        return
+    raise LockMismatchError(
+        '{} "{}" resolved to tree {}, but {} has {}.\n'
+        'If the change is expected, run `peru lock` to update it.',
+        'Module' if kind == 'modules' else 'Rule', name, tree,
+        os.path.basename(runtime.lock_path), runtime.lock.get(kind, key))
+
+
+def record(runtime, kind, key, name, tree):
+    '''Note what a module or rule resolved to, when `peru lock` is running.'''
+    if runtime.new_lock is not None:
+        runtime.new_lock.record(kind, key, name, tree)
+
+
+async def write_lock(runtime, scope, imports):
+    '''Resolve every import, fetching whatever isn't cached yet, and write
+    the modules and rules they used to the lock file. The old lock file
+    isn't consulted, so that a lock that no longer matches can be
+    replaced.'''
+    runtime.lock = None
+    runtime.new_lock = Lockfile()
+    try:
+        await get_imports_tree(runtime, scope, imports)
+        runtime.new_lock.write(runtime.lock_path)
+    finally:
+        runtime.new_lock = None
@@ -4,25 +4,20 @@ import collections
 import json
 import os
 import sys
-import tempfile
-
-# vendored
-from . import docopt
-
-# Unfortunately we need to make sure to keep this import above the others,
-# because async_helpers needs to set the global event loop at import time.
-from .async_helpers import gather_coalescing_exceptions, run_task
 
+# Everything else is imported inside the functions that need it. Tools may run
+# peru hundreds of times per build, and `peru --version`, `peru help` or a
+# no-op sync shouldn't pay for loading asyncio, YAML, the cache and the plugin
+# machinery unless they use them.
 from . import compat
 from .error import PrintableError
-from . import imports
-from . import parser
-from .runtime import Runtime
 
 __doc__ = '''\
 Usage:
     peru [-hqv] [--file=<file>] [--sync-dir=<dir>] [--state-dir=<dir>]
-         [--cache-dir=<dir>] [--file-basename=<name>] <command> [<args>...]
+         [--cache-dir=<dir>] [--file-basename=<name>] [--trace-file=<file>]
+         [--profile-git] [--profile-git-json=<file>] [--progress=<format>]
+         [--progress-file=<file>] <command> [<args>...]
     peru [--help|--version]
 
 Commands:
@@ -31,7 +26,10 @@ Commands:
     clean     delete imports from your project
     copy      copy files directly from a module to somewhere else
     override  substitute a local directory for the contents of a module
+    dest      sync to other named directories besides your project
     module    get information about the modules in your project
+    cache     export or import the cached files your project needs
+    lock      record the trees of your modules in peru.lock
     help      show help for subcommands, same as -h/--help
 
 Options:
@@ -55,6 +53,22 @@ Options:
         An alternative filename (not a path) for 'peru.yaml'. As usual, peru
         will search the current dir and its parents for this file, and import
         paths will be relative to it. Incompatible with --file.
+    --trace-file=<file>
+        Record how long each part of the command takes, and write it to this
+        file as Chrome trace events. Open it in https://ui.perfetto.dev.
+    --profile-git
+        When the command is done, print statistics about every git command
+        peru ran: how many of each, how long they took, how much data they
+        read and wrote, and which parts of peru ran them.
+    --profile-git-json=<file>
+        Write the same statistics to this file as JSON.
+    --progress=<format>
+        How to show progress, either 'text' (the default) or 'json'. With
+        'json', peru prints one JSON object per line for each event, like a
+        module being fetched or found in cache, and errors go to stderr.
+    --progress-file=<file>
+        Also write the JSON progress events to this file, like /dev/fd/3,
+        without changing what's printed.
 '''
 
 
@@ -73,13 +87,21 @@ COMMAND_DOCS = {}
 
 @peru_command('sync', '''\
 Usage:
-    peru sync [-fhqv] [-j N] [--no-cache] [--no-overrides]
+    peru sync [<targets>...] [-fhqv] [-j N] [--no-cache] [--no-overrides]
+              [--dest=<name> | --all-dests]
 
 Writes your imports to the sync directory. By default, this is the
 directory that contains your peru.yaml file. Peru is normally careful
 not to overwrite pre-existing or modified files, and if it detects any
 then it writes nothing and reports an error. Use the --force flag if you
-want sync to overwrite existing files.
+want sync to overwrite existing files. To write your imports somewhere
+else, see `peru dest`.
+
+To sync just some of your imports, pass them as positional arguments.
+Each one can be a module name, an import target like "foo|bar", or a
+glob matching the paths you import to, like "third_party/*". Only the
+selected modules are fetched, and the rest of your imports are left the
+way they were last synced.
 
 Options:
     -f --force      overwrite existing or changed files
@@ -89,12 +111,33 @@ Options:
     --no-overrides  suppress any `peru override` settings
     -q --quiet      don't print anything
     -v --verbose    print everything
+    --dest=<name>   sync to a destination from `peru dest` instead
+    --all-dests     sync to every destination from `peru dest` at once
 ''')
 async def do_sync(params):
+    from . import imports
     params.runtime.print_overrides()
     await imports.checkout(params.runtime, params.scope, params.imports,
-                           params.runtime.sync_dir)
+                           get_sync_dirs(params),
+                           params.args.get('<targets>') or None)
     params.runtime.warn_unused_overrides()
+    if params.runtime.verbose:
+        params.runtime.display.print(
+            params.runtime.cache.stats.format_summary())
+
+
+def get_sync_dirs(params):
+    runtime = params.runtime
+    if params.args.get('--all-dests'):
+        names = sorted(runtime.dests)
+        if not names:
+            raise PrintableError(
+                'There are no destinations. See `peru dest add`.')
+    elif params.args.get('--dest'):
+        names = [params.args['--dest']]
+    else:
+        return [runtime.sync_dir]
+    return [os.path.abspath(runtime.get_dest(name)) for name in names]
 
 
 @peru_command('reup', '''\
@@ -121,14 +164,29 @@ Options:
     -v --verbose    print everything
 ''')
 async def do_reup(params):
+    from .async_helpers import gather_coalescing_exceptions
+    from . import edit_yaml
+    from . import parser
     names = params.args['<modules>']
     if not names:
         modules = params.scope.modules.values()
     else:
         modules = params.scope.get_modules_for_reup(names)
-    futures = [module.reup(params.runtime) for module in modules]
-    await gather_coalescing_exceptions(
-        futures, params.runtime.display, verbose=params.runtime.verbose)
+    # Collect every module's changes and write them all at once at the end,
+    # including the ones that succeeded if others failed.
+    updates = []
+
+    async def reup_module(module):
+        changed_fields = await module.reup(params.runtime)
+        updates.extend((module.yaml_name, field, val)
+                       for field, val in changed_fields.items())
+
+    futures = [reup_module(module) for module in modules]
+    try:
+        await gather_coalescing_exceptions(
+            futures, params.runtime.display, verbose=params.runtime.verbose)
+    finally:
+        edit_yaml.set_module_fields_in_file(params.runtime.peru_file, updates)
     if not params.args['--no-sync']:
         # Do an automatic sync. Reparse peru.yaml to get the new revs.
         new_scope, new_imports = parser.parse_file(params.runtime.peru_file)
@@ -138,7 +196,7 @@ async def do_reup(params):
 
 @peru_command('clean', '''\
 Usage:
-    peru clean [-fhqv]
+    peru clean [-fhqv] [--dest=<name> | --all-dests]
 
 Removes any files previously written by sync. As with sync, peru is
 cautious about removing files that you have changed. Use --force to
@@ -149,10 +207,13 @@ Options:
     -h --help      what were they thinking?
     -q --quiet     don't print anything
     -v --verbose   print everything
+    --dest=<name>  clean a destination from `peru dest` instead
+    --all-dests    clean every destination from `peru dest`
 ''')
 async def do_clean(params):
+    from . import imports
     await imports.checkout(params.runtime, params.scope, {},
-                           params.runtime.sync_dir)
+                           get_sync_dirs(params))
 
 
 @peru_command('copy', '''\
@@ -175,6 +236,8 @@ Options:
     -v --verbose    print everything
 ''')
 async def do_copy(params):
+    from . import imports
+    import tempfile
     params.runtime.print_overrides()
     if not params.args['<dest>']:
         dest = tempfile.mkdtemp(prefix='peru_copy_')
@@ -234,6 +297,46 @@ async def do_override(params):
                                       params.runtime.get_override(module)))
 
 
+@peru_command('dest', '''\
+Usage:
+    peru dest [list] [--json]
+    peru dest add <name> <path>
+    peru dest delete <name>
+    peru dest --help
+
+Destinations are other directories that you can sync your imports to,
+besides your project. For example, you might keep a separate build tree
+for each configuration of your project. Each destination remembers what
+was last synced to it, just like the project itself, so switching back
+and forth doesn't slow down your syncs. Use `peru sync --dest=<name>` to
+sync to one destination, or `peru sync --all-dests` to sync to all of
+them at once. A relative <path> is interpreted from the current
+directory, like any other command line path, but it's saved relative to
+the project root, so that moving the project and its destinations
+together keeps them working.
+
+Options:
+    -h --help  are we there yet?
+    --json     print output as JSON
+''')
+async def do_dest(params):
+    runtime = params.runtime
+    if params.args['add']:
+        runtime.set_dest(params.args['<name>'], params.args['<path>'])
+    elif params.args['delete']:
+        runtime.delete_dest(params.args['<name>'])
+    else:
+        if params.args['--json']:
+            print(
+                json.dumps({
+                    name: os.path.abspath(runtime.get_dest(name))
+                    for name in runtime.dests
+                }))
+        else:
+            for name in sorted(runtime.dests):
+                print('{}: {}'.format(name, runtime.get_dest(name)))
+
+
 @peru_command('module', '''\
 Usage:
     peru module [list] [-h] [--json]
@@ -253,18 +356,90 @@ async def do_list(params):
             print(module)
 
 
+@peru_command('cache', '''\
+Usage:
+    peru cache export <file> [-hqv] [-j N] [--plugin-caches]
+    peru cache import <file> [-hqv]
+    peru cache --help
+
+Export writes a bundle file with everything from the cache that syncing
+your project needs: the trees of your modules, the results of your rules,
+and the merged imports. It fetches anything that isn't cached yet, like
+sync would, but it doesn't touch your imports. Overrides are ignored.
+With --plugin-caches, it also includes the plugin cache dirs of your
+modules, like the git plugin's clones, so that fetching new revs later
+is faster. Those can be big.
+
+Import adds the contents of a bundle to the cache, so that the next sync
+doesn't need to fetch. Use it to prewarm a fresh cache, like in a CI
+container, or to sync on a machine without network access. Anything
+that's already in the cache is left alone.
+
+Options:
+    -h --help          reduce, reuse, recycle
+    -j N --jobs N      max number of parallel fetches
+    --plugin-caches    include plugin cache dirs in the bundle
+    -q --quiet         don't print anything
+    -v --verbose       print everything
+''')
+async def do_cache(params):
+    from . import cache_bundle
+    if params.args['export']:
+        params.runtime.no_overrides = True
+        await cache_bundle.export_bundle(
+            params.runtime,
+            params.scope,
+            params.imports,
+            params.args['<file>'],
+            plugin_caches=params.args['--plugin-caches'])
+    else:
+        await cache_bundle.import_bundle(params.runtime, params.args['<file>'])
+
+
+@peru_command('lock', '''\
+Usage:
+    peru lock [-hqv] [-j N] [--no-cache]
+
+Writes peru.lock next to peru.yaml, with the git tree that each of your
+modules and rules resolved to, fetching whatever isn't cached yet. It
+doesn't touch your imports. Overrides are ignored. Commit the lock file
+along with peru.yaml.
+
+After that, a module whose locked tree is already in the cache (from
+`peru cache import`, a read-only cache layer or a remote cache) is used
+without running its plugin. And when peru does fetch a module or run a
+rule, the result has to match the lock, or the command fails. That
+includes modules without a pinned rev, which stay on their locked trees.
+Run `peru lock` again to accept a change. Use --no-cache to refetch
+modules without pinned revs first.
+
+Options:
+    -h --help      locked and loaded
+    -j N --jobs N  max number of parallel fetches
+    --no-cache     force modules without exact revs to refetch
+    -q --quiet     don't print anything
+    -v --verbose   print everything
+''')
+async def do_lock(params):
+    from . import lockfile
+    params.runtime.no_overrides = True
+    await lockfile.write_lock(params.runtime, params.scope, params.imports)
+
+
 def get_version():
     version_file = os.path.join(compat.MODULE_ROOT, 'VERSION')
     with open(version_file) as f:
         return f.read().strip()
 
 
-def print_red(*args, **kwargs):
-    if compat.is_fancy_terminal():
-        sys.stdout.write('\x1b[31m')
-    print(*args, **kwargs)
-    if compat.is_fancy_terminal():
-        sys.stdout.write('\x1b[39m')
+def print_red(*args, file=None, **kwargs):
+    file = file or sys.stdout
+    fancy = file is sys.stdout and compat.is_fancy_terminal()
+    if fancy:
+        file.write('\x1b[31m')
+    print(*args, file=file, **kwargs)
+    if fancy:
+        file.write('\x1b[39m')
 
 
 def maybe_print_help_and_return(args):
@@ -317,6 +492,7 @@ def merged_args_dicts(global_args, subcommand_args):
 
 
 def docopt_parse_args(argv):
+    from . import docopt  # vendored
     args = docopt.docopt(__doc__, argv, default_help=False, options_first=True)
     command = args['<command>']
     # Skip further parsing for cases like `peru badcommand` (because there is
@@ -351,6 +527,14 @@ def force_utf8_in_ascii_mode_hack():
             sys.stderr.fileno(), mode='w', encoding='utf8', buffering=1)
 
 
+def write_git_profile(profiler, args):
+    if args['--profile-git']:
+        print(profiler.format_summary(), file=sys.stderr)
+    if args['--profile-git-json']:
+        with open(args['--profile-git-json'], 'w') as f:
+            json.dump(profiler.summary(), f, indent=4, sort_keys=True)
+
+
 # Called as a setup.py entry point, or from __main__.py (`python3 -m peru`).
 def main(*, argv=None, env=None, nocatch=False):
     force_utf8_in_ascii_mode_hack()
@@ -367,17 +551,62 @@ def main(*, argv=None, env=None, nocatch=False):
     if ret is not None:
         return ret
 
+    import time
+    from .async_helpers import run_task
+    from . import cache
+    from . import parser
+    from .runtime import Runtime
+    from . import trace
+
+    if args['--trace-file']:
+        trace.start()
+    if args['--profile-git'] or args['--profile-git-json']:
+        cache.GIT_PROFILER = cache.GitProfiler()
+
+    runtime = None
+    succeeded = False
+    error = None
     try:
         runtime = run_task(Runtime(args, env))
-        if not args['--quiet']:
-            parser.warn_duplicate_keys(runtime.peru_file)
-        scope, imports = parser.parse_file(runtime.peru_file)
+        runtime.display.event(
+            'started',
+            command=command,
+            version=get_version(),
+            timestamp=time.time())
+        with trace.span('parse', file=runtime.peru_file):
+            blob, duplicates = parser.load_file(
+                runtime.peru_file,
+                cache_path=os.path.join(runtime.state_dir, 'peru_file_cache'))
+            if not args['--quiet']:
+                parser.warn_duplicate_keys(runtime.peru_file, duplicates)
+            scope, imports = parser.parse_blob(blob)
         params = CommandParams(args, runtime, scope, imports)
         command_fn = COMMAND_FNS[command]
-        run_task(command_fn(params))
+        with trace.span(command):
+            run_task(command_fn(params))
+        succeeded = True
     except PrintableError as e:
+        error = e.message
         if args['--verbose'] or nocatch:
             # Just allow the stacktrace to print if verbose, or in testing.
             raise
-        print_red(e.message, end='' if e.message.endswith('\n') else '\n')
+        # Keep stdout parseable for --progress=json.
+        print_red(
+            e.message,
+            end='' if e.message.endswith('\n') else '\n',
+            file=sys.stderr if args['--progress'] == 'json' else None)
         return 1
+    finally:
+        if runtime is not None:
+            runtime.display.event(
+                'finished',
+                ok=succeeded,
+                error=error,
+                cache=runtime.cache.stats.as_dict())
+            run_task(runtime.close())
+        tracer = trace.stop()
+        if tracer is not None:
+            tracer.write(args['--trace-file'])
+        profiler, cache.GIT_PROFILER = cache.GIT_PROFILER, None
+        if profiler is not None:
+            write_git_profile(profiler, args)
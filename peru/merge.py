@@ -1,6 +1,7 @@
 import textwrap
 
 from .cache import compute_key, MergeConflictError
+from . import trace
 
 
 async def merge_imports_tree(cache, imports, target_trees, base_tree=None):
@@ -14,8 +15,16 @@ async def merge_imports_tree(cache, imports, target_trees, base_tree=None):
         - We need to use this for both toplevel imports and recursive module
           imports.
     '''
+    with trace.span('merge imports', targets=len(imports)):
+        return await _merge_imports_tree(cache, imports, target_trees,
+                                         base_tree)
+
+
+async def _merge_imports_tree(cache, imports, target_trees, base_tree):
     key = _cache_key(imports, target_trees, base_tree)
-    if key in cache.keyval:
+    hit = key in cache.keyval
+    cache.stats.record('merges', hit, key)
+    if hit:
         return cache.keyval[key]
     # We always want to merge imports in the same order, so that any conflicts
     # we run into will be deterministic. Sort the imports alphabetically by
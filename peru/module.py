@@ -1,13 +1,16 @@
+import asyncio
 import json
 import os
 import textwrap
+import time
 
 from .cache import compute_key
 from .error import PrintableError, error_context
-from .edit_yaml import set_module_field_in_file
 from . import imports
+from . import lockfile
 from .plugin import plugin_fetch, plugin_get_reup_fields
 from . import scope
+from . import trace
 
 recursion_warning = '''\
 WARNING: The peru module '{}' doesn't specify the 'recursive' field,
@@ -33,7 +36,41 @@ class Module:
         self.recursive = bool(recursive)
         self.recursion_specified = recursive is not None
 
+    def _cache_key(self):
+        return compute_key({
+            'type': self.type,
+            'plugin_fields': self.plugin_fields,
+            'peru_file': self.peru_file,
+        })
+
     async def _get_base_tree(self, runtime):
+        # Every target that imports this module asks for its tree, and so do
+        # nested targets inside it. Resolve it once per run, so that the
+        # display gets one pair of events for it.
+        memo_key = (self.name, self._cache_key())
+        if memo_key not in runtime.module_trees:
+            runtime.module_trees[memo_key] = asyncio.ensure_future(
+                self._get_base_tree_once(runtime))
+        return await runtime.module_trees[memo_key]
+
+    async def _get_base_tree_once(self, runtime):
+        start = time.monotonic()
+        runtime.display.event(
+            'module_started', module=self.name, type=self.type)
+        details = {}
+        tree = await self._resolve_base_tree(runtime, details)
+        runtime.display.event(
+            'module_finished',
+            module=self.name,
+            type=self.type,
+            tree=tree,
+            duration=round(time.monotonic() - start, 6),
+            **details)
+        return tree
+
+    async def _resolve_base_tree(self, runtime, details):
+        '''Returns the module's tree, and fills in `details` with where it
+        came from, for the display's events.'''
         override_path = runtime.get_override(self.name)
         if override_path is not None:
             # Marking overrides as used lets us print a warning when an
@@ -41,13 +78,15 @@ class Module:
             runtime.mark_override_used(self.name)
             override_tree = await self._get_override_tree(
                 runtime, override_path)
+            details['cache'] = 'override'
             return override_tree
 
-        key = compute_key({
-            'type': self.type,
-            'plugin_fields': self.plugin_fields,
-            'peru_file': self.peru_file,
-        })
+        key = self._cache_key()
+        tree = await self._get_tree_for_key(runtime, key, details)
+        lockfile.record(runtime, 'modules', key, self.name, tree)
+        return tree
+
+    async def _get_tree_for_key(self, runtime, key, details):
         # Use a lock to prevent the same module from being double fetched. The
         # lock is taken on the cache key, not the module itself, so two
         # different modules with identical fields will take the same lock and
@@ -58,16 +97,44 @@ class Module:
             # place in the code we check that flag. Deterministic operations
             # like tree merging still get read from cache, because there's no
             # reason to redo them.
+            tree = None
             if key in runtime.cache.keyval and not runtime.no_cache:
-                return runtime.cache.keyval[key]
+                tree = runtime.cache.keyval[key]
+                # An entry that disagrees with peru.lock doesn't count.
+                if not lockfile.agrees(runtime, 'modules', key, tree):
+                    tree = None
+            runtime.cache.stats.record('modules', tree is not None, key)
+            if tree is not None:
+                details['cache'] = 'hit'
+                return tree
+            if not runtime.no_cache:
+                tree = await lockfile.get_locked_tree(runtime, 'modules', key)
+                if tree is not None:
+                    details['cache'] = 'lock'
+                    return tree
+            if runtime.remote_cache is not None and not runtime.no_cache:
+                tree = await runtime.remote_cache.get(key)
+                if not lockfile.agrees(runtime, 'modules', key, tree):
+                    tree = None
+                runtime.cache.stats.record('remote', tree is not None, key)
+                if tree is not None:
+                    runtime.cache.keyval[key] = tree
+                    details['cache'] = 'remote'
+                    return tree
+            details['cache'] = 'miss'
             with runtime.tmp_dir() as tmp_dir:
                 await plugin_fetch(runtime.get_plugin_context(), self.type,
                                    self.plugin_fields, tmp_dir,
                                    runtime.display.get_handle(self.name))
+                if runtime.display.emits_events:
+                    details['bytes'] = _dir_size(tmp_dir)
                 tree = await runtime.cache.import_tree(tmp_dir)
+            lockfile.check(runtime, 'modules', key, self.name, tree)
             # Note that we still *write* to cache even when --no-cache is True.
             # That way we avoid confusing results on subsequent syncs.
             runtime.cache.keyval[key] = tree
+            if runtime.remote_cache is not None:
+                await runtime.remote_cache.put(key, tree)
         return tree
 
     async def get_tree(self, runtime):
@@ -78,7 +145,11 @@ class Module:
         # It's the possible+unspecified state that we're interested in for
         # printing the warning.
         base_tree = await self._get_base_tree(runtime)
-        scope, _imports = await self.parse_peru_file(runtime)
+        if self.recursion_specified and not self.recursive:
+            # Don't even look at the peru file. Its scope only gets parsed if
+            # some target refers to a module inside it.
+            return base_tree
+        scope, _imports = await self.parse_peru_file(runtime, base_tree)
         recursion_possible = scope is not None
         if not recursion_possible:
             return base_tree
@@ -92,47 +163,71 @@ class Module:
             runtime, scope, _imports, base_tree=base_tree)
         return recursive_tree
 
-    async def parse_peru_file(self, runtime):
+    async def parse_peru_file(self, runtime, tree=None):
+        '''Returns the (scope, imports) pair from this module's peru file, or
+        (None, None) if it doesn't have one. Nested targets can ask for this
+        many times, so the result is memoized in the runtime for the rest of
+        the run. Callers that already have the module's tree can pass it in.'''
+        from . import parser  # avoid circular imports
+        if tree is None:
+            tree = await self._get_base_tree(runtime)
+        memo_key = (tree, self.peru_file, self.name)
+        if memo_key not in runtime.parsed_scopes:
+            blob = await self._load_peru_file(runtime, tree)
+            if blob is None:
+                # This module is not a peru project.
+                result = (None, None)
+            else:
+                prefix = self.name + scope.SCOPE_SEPARATOR
+                with trace.span('parse', module=self.name):
+                    result = parser.parse_blob(blob, name_prefix=prefix)
+            runtime.parsed_scopes[memo_key] = result
+        return runtime.parsed_scopes[memo_key]
+
+    async def _load_peru_file(self, runtime, tree):
+        '''Returns the loaded YAML of the peru file, or None if there isn't
+        one. Loading YAML is slow compared to loading JSON, so the result is
+        cached as JSON in the keyval, keyed on the module's tree.'''
         from . import parser  # avoid circular imports
-        tree = await self._get_base_tree(runtime)
         cache_key = compute_key({
-            'key_type': 'module_peru_file',
+            'key_type': 'module_peru_file_blob',
             'input_tree': tree,
             'file_name': self.peru_file,
         })
-        if cache_key in runtime.cache.keyval:
-            yaml = json.loads(runtime.cache.keyval[cache_key])
+        hit = cache_key in runtime.cache.keyval
+        runtime.cache.stats.record('peru files', hit, cache_key)
+        if hit:
+            return json.loads(runtime.cache.keyval[cache_key])
+        try:
+            yaml_bytes = await runtime.cache.read_file(tree, self.peru_file)
+        except FileNotFoundError:
+            blob = None
         else:
-            try:
-                yaml_bytes = await runtime.cache.read_file(
-                    tree, self.peru_file)
-                yaml = yaml_bytes.decode('utf8')
-            except FileNotFoundError:
-                yaml = None
-            runtime.cache.keyval[cache_key] = json.dumps(yaml)
-        if yaml is None:
-            # This module is not a peru project.
-            return (None, None)
-        prefix = self.name + scope.SCOPE_SEPARATOR
-        return parser.parse_string(yaml, name_prefix=prefix)
+            blob = parser.load_yaml(yaml_bytes.decode('utf8'))
+        serialized = parser.serialize_blob(blob)
+        if serialized is not None:
+            runtime.cache.keyval[cache_key] = serialized
+        return blob
 
     async def reup(self, runtime):
+        '''Returns a dict of the fields that have changed. The caller writes
+        them to peru.yaml, so that reupping many modules at once only rewrites
+        the file once.'''
         context = 'module "{}"'.format(self.name)
         with error_context(context):
             reup_fields = await plugin_get_reup_fields(
                 runtime.get_plugin_context(), self.type, self.plugin_fields,
                 runtime.display.get_handle(self.name))
-            output_lines = []
+            changed_fields = {}
             for field, val in reup_fields.items():
                 if (field not in self.plugin_fields
                         or val != self.plugin_fields[field]):
-                    output_lines.append('  {}: {}'.format(field, val))
-                    set_module_field_in_file(runtime.peru_file, self.yaml_name,
-                                             field, val)
-            if output_lines and not runtime.quiet:
+                    changed_fields[field] = val
+            if changed_fields and not runtime.quiet:
                 runtime.display.print('reup ' + self.name)
-                for line in output_lines:
-                    runtime.display.print(line)
+                for field, val in changed_fields.items():
+                    runtime.display.print('  {}: {}'.format(field, val))
+            return changed_fields
 
     async def _get_override_tree(self, runtime, path):
         if not os.path.exists(path):
@@ -145,3 +240,11 @@ class Module:
                     self.name, path))
         tree = await runtime.cache.import_tree(path)
         return tree
+
+
+def _dir_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
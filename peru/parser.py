@@ -1,9 +1,12 @@
 import collections
+import json
+import os
 import re
 import sys
 import textwrap
-import yaml
+import time
 
+from . import compat
 from .error import PrintableError
 from .module import Module
 from .rule import Rule
@@ -16,21 +19,88 @@ class ParserError(PrintableError):
     pass
 
 
+# Don't cache a file that was modified this recently. Another edit within the
+# filesystem's timestamp granularity could leave the mtime and size unchanged.
+RACY_MTIME_WINDOW = 2
+
+
 def parse_file(file_path, name_prefix=""):
     with open(file_path) as f:
         return parse_string(f.read(), name_prefix)
 
 
+def load_file(file_path, cache_path=None):
+    '''Returns the loaded YAML of a peru file, along with a list of any
+    duplicate keys in it (see warn_duplicate_keys). If cache_path is given,
+    both are saved there as JSON, and as long as the file's mtime and size
+    haven't changed, later calls read that instead of parsing the YAML
+    again.'''
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    stamp = [file_path, stat.st_mtime_ns, stat.st_size]
+    if cache_path is not None:
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached['stamp'] == stamp:
+                return (cached['blob'],
+                        [DuplicatedKey(*d) for d in cached['duplicates']])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    with open(file_path) as f:
+        text = f.read()
+    blob = load_yaml(text)
+    duplicates = _get_duplicate_keys_approximate(text)
+    if (cache_path is not None
+            and time.time() - stat.st_mtime > RACY_MTIME_WINDOW
+            and serialize_blob(blob) is not None):
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'stamp': stamp,
+                'duplicates': duplicates,
+                'blob': blob,
+            }, f)
+        os.replace(tmp_path, cache_path)
+    return blob, duplicates
+
+
 def parse_string(yaml_str, name_prefix=""):
+    return parse_blob(load_yaml(yaml_str), name_prefix)
+
+
+def load_yaml(yaml_str):
+    '''Load the raw YAML of a peru file, without validating it. An empty file
+    gives an empty dict.'''
+    import yaml  # only needed when the cache misses
     try:
-        blob = yaml.safe_load(yaml_str)
+        blob = compat.yaml_safe_load(yaml_str)
     except yaml.scanner.ScannerError as e:
         raise PrintableError("YAML parser error:\n\n" + str(e)) from e
     if blob is None:
         blob = {}
+    return blob
+
+
+def parse_blob(blob, name_prefix=""):
+    '''Build a Scope and imports from YAML that's already been loaded. Note
+    that this consumes the blob.'''
     return _parse_toplevel(blob, name_prefix)
 
 
+def serialize_blob(blob):
+    '''Returns loaded YAML as JSON, which is much faster to load again. YAML
+    can express things that JSON can't, like non-string keys and dates, and
+    for those this returns None.'''
+    try:
+        serialized = json.dumps(blob)
+    except (TypeError, ValueError):
+        return None
+    if json.loads(serialized) != blob:
+        return None
+    return serialized
+
+
 def _parse_toplevel(blob, name_prefix):
     modules = _extract_modules(blob, name_prefix)
     rules = _extract_named_rules(blob, name_prefix)
@@ -244,10 +314,11 @@ def _warn(s, *args, **kwargs):
     print(s.format(*args, **kwargs), file=sys.stderr)
 
 
-def warn_duplicate_keys(file_path):
-    with open(file_path) as f:
-        text = f.read()
-    duplicates = _get_duplicate_keys_approximate(text)
+def warn_duplicate_keys(file_path, duplicates=None):
+    if duplicates is None:
+        with open(file_path) as f:
+            text = f.read()
+        duplicates = _get_duplicate_keys_approximate(text)
     if not duplicates:
         return
     _warn(
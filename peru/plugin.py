@@ -1,18 +1,23 @@
+import asyncio
+import collections
 from collections import namedtuple
 import contextlib
+import json
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
+import time
 
-import yaml
-
-from .async_helpers import create_subprocess_with_handle
+from .async_helpers import create_subprocess_with_handle, \
+    run_worker_job_with_handle
 from .async_exit_stack import AsyncExitStack
 from . import cache
 from . import compat
 from .compat import makedirs
 from .error import PrintableError
+from . import trace
 
 DEFAULT_PARALLEL_FETCH_LIMIT = 10
 
@@ -20,14 +25,18 @@ DEBUG_PARALLEL_COUNT = 0
 DEBUG_PARALLEL_MAX = 0
 
 PluginDefinition = namedtuple('PluginDefinition', [
-    'type', 'sync_exe', 'reup_exe', 'fields', 'required_fields',
+    'type', 'sync_exe', 'reup_exe', 'worker_exe', 'fields', 'required_fields',
     'optional_fields', 'cache_fields'
 ])
 
+# Fields after tmp_root are optional, so that callers (mostly tests) that don't
+# care about them can leave them out.
 PluginContext = namedtuple('PluginContext', [
     'cwd', 'plugin_cache_root', 'parallelism_semaphore', 'plugin_cache_locks',
-    'tmp_root'
-])
+    'tmp_root', 'plugin_registry', 'worker_pool', 'job_timeout',
+    'failure_cache', 'retry_policy', 'log_dir', 'cache_stats',
+    'lower_plugin_cache_roots'
+], defaults=[None, None, None, None, None, None, None, ()])
 
 
 async def plugin_fetch(plugin_context, module_type, module_fields, dest,
@@ -45,7 +54,7 @@ async def plugin_get_reup_fields(plugin_context, module_type, module_fields,
         await _plugin_job(plugin_context, module_type, module_fields, 'reup',
                           env, display_handle)
         with open(output_path) as output_file:
-            fields = yaml.safe_load(output_file) or {}
+            fields = compat.yaml_safe_load(output_file) or {}
 
     for key, value in fields.items():
         if not isinstance(key, str):
@@ -107,13 +116,32 @@ async def _plugin_job(plugin_context, module_type, module_fields, command, env,
     # We take several locks and other context managers in here. Using an
     # AsyncExitStack saves us from indentation hell.
     async with AsyncExitStack() as stack:
-        definition = _get_plugin_definition(module_type, module_fields,
-                                            command)
-        plugin_exe = _get_plugin_exe(definition, command)
+        stack.enter_context(
+            trace.span('plugin job', type=module_type, command=command))
+        registry = plugin_context.plugin_registry or PluginRegistry()
+        definition = registry.get_definition(module_type)
+        _validate_plugin_definition(definition, module_fields)
+        plugin_exe = registry.get_exe(definition, command)
 
         # The PERU_REEXEC_PYTHON heuristic happens here.
         plugin_command, is_shell_mode = _plugin_command(plugin_exe)
 
+        # Plugins that speak the worker protocol get their jobs run by a warm
+        # process from the pool instead. Shell mode (Windows, non-.py exes)
+        # always gets a fresh process.
+        worker_command = None
+        if plugin_context.worker_pool is not None and definition.worker_exe:
+            worker_exe = registry.get_exe(definition, 'worker')
+            worker_command, worker_shell_mode = _plugin_command(worker_exe)
+            if worker_shell_mode:
+                worker_command = None
+
+        # If this plugin recently failed for the same module, don't make the
+        # user wait for it to fail again.
+        failure_key = _plugin_failure_key(definition, module_fields, command)
+        if plugin_context.failure_cache is not None:
+            plugin_context.failure_cache.raise_if_failed(failure_key)
+
         complete_env = _plugin_env(plugin_context, definition, module_fields,
                                    command, stack)
         complete_env.update(env)
@@ -126,31 +154,316 @@ async def _plugin_job(plugin_context, module_type, module_fields, command, env,
         # the cache lock is a no-op.
         await stack.enter_async_context(
             _plugin_cache_lock(plugin_context, definition, module_fields))
-
-        # Use a semaphore to limit the number of jobs that can run in parallel.
-        # Most plugin fetches hit the network, and for performance reasons we
-        # don't want to fire off too many network requests at once. See
-        # DEFAULT_PARALLEL_FETCH_LIMIT. This also lets the user control
-        # parallelism with the --jobs flag. It's important that this is the
-        # last lock taken before starting a job, otherwise we might waste a job
-        # slot just waiting on other locks.
-        await stack.enter_async_context(plugin_context.parallelism_semaphore)
-
+        await _prepare_plugin_cache(plugin_context,
+                                    complete_env['PERU_PLUGIN_CACHE'])
+
+        # Retried attempts all report to the same display handle, which can
+        # only be entered and exited once.
+        handle = _SharedHandle(display_handle)
+        stack.callback(handle.finish)
+        retry_policy = plugin_context.retry_policy or NO_RETRY
+
+        # Tell the display about the job just before it finishes. Exit
+        # callbacks run in reverse order.
+        attempt = 0
+        stats = {'queue_wait': 0.0, 'ok': False}
+        stack.callback(lambda: handle.report(
+            type=module_type, command=command, attempts=attempt,
+            queue_wait=round(stats['queue_wait'], 6), ok=stats['ok']))
+
+        # Only the end of a job's output is kept in memory. With a log dir,
+        # the whole thing is written to a file too, one per attempt.
+        log_name = None
+        if plugin_context.log_dir is not None:
+            log_name = '{}-{}-{}'.format(
+                module_type, command, cache.compute_key(module_fields)[:12])
+
+        while True:
+            attempt += 1
+            log_path = None
+            if log_name is not None:
+                log_path = os.path.join(
+                    plugin_context.log_dir,
+                    log_name + ('.log' if attempt == 1 else
+                                '-attempt{}.log'.format(attempt)))
+            if worker_command:
+                job = plugin_context.worker_pool.run(
+                    worker_command,
+                    handle,
+                    cwd=plugin_context.cwd,
+                    env=complete_env,
+                    log_path=log_path)
+            else:
+                job = create_subprocess_with_handle(
+                    plugin_command,
+                    handle,
+                    cwd=plugin_context.cwd,
+                    env=complete_env,
+                    shell=is_shell_mode,
+                    log_path=log_path)
+            try:
+                await _run_plugin_attempt(plugin_context, job, stats)
+            except subprocess.CalledProcessError as e:
+                retryable = retry_policy.should_retry(e.returncode, e.output)
+                error = PluginRuntimeError(module_type, module_fields,
+                                           e.returncode, e.output, attempt)
+            except asyncio.TimeoutError:
+                # A hung upstream is the canonical transient failure.
+                retryable = True
+                error = PluginTimeoutError(
+                    'Plugin job for {} module timed out after {:g} seconds{}.',
+                    module_type, plugin_context.job_timeout,
+                    _attempts_suffix(attempt))
+            else:
+                stats['ok'] = True
+                if plugin_context.failure_cache is not None:
+                    plugin_context.failure_cache.clear(failure_key)
+                return
+            if not retryable or attempt >= retry_policy.max_attempts:
+                break
+            # Back off without holding a job slot, so that other jobs keep
+            # running while this one waits.
+            delay = retry_policy.delay(attempt)
+            handle.write('peru: attempt {} of {} failed, retrying in {:g}s\n'
+                         .format(attempt, retry_policy.max_attempts, delay))
+            await asyncio.sleep(delay)
+            # A failed attempt can leave partial files behind, and the retry
+            # should start from the same empty dirs that the first one did.
+            for var in ('PERU_SYNC_DEST', 'PERU_PLUGIN_TMP'):
+                if var in complete_env:
+                    _empty_dir(complete_env[var])
+
+        if plugin_context.failure_cache is not None:
+            plugin_context.failure_cache.record(failure_key, error.message)
+        raise error
+
+
+async def _run_plugin_attempt(plugin_context, job, stats):
+    # Use a semaphore to limit the number of jobs that can run in parallel.
+    # Most plugin fetches hit the network, and for performance reasons we
+    # don't want to fire off too many network requests at once. See
+    # DEFAULT_PARALLEL_FETCH_LIMIT. This also lets the user control
+    # parallelism with the --jobs flag. It's important that this is the last
+    # lock taken before starting a job, otherwise we might waste a job slot
+    # just waiting on other locks. It's taken separately for each attempt.
+    # Tracing and the display's stats tell the time spent waiting for it apart
+    # from the job itself.
+    wait_start = time.monotonic()
+    with trace.span('plugin job wait'):
+        await plugin_context.parallelism_semaphore.acquire()
+    stats['queue_wait'] += time.monotonic() - wait_start
+    try:
         # We use this debug counter for our parallelism tests. It's important
         # that it comes after all locks have been taken (so the job it's
         # counting is actually running).
-        stack.enter_context(debug_parallel_count_context())
-
+        with debug_parallel_count_context(), trace.span('plugin job run'):
+            # Cancelling the job on timeout kills the plugin process.
+            await asyncio.wait_for(job, plugin_context.job_timeout)
+    finally:
+        plugin_context.parallelism_semaphore.release()
+
+
+def _empty_dir(path):
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+
+
+class RetryPolicy(
+        namedtuple('RetryPolicy',
+                   ['max_attempts', 'backoff', 'exit_codes',
+                    'output_pattern'])):
+    '''How many times to try a failing plugin job, and which failures are
+    worth trying again. `backoff` is the delay in seconds after the first
+    failure, doubling after each one after that. If neither `exit_codes` nor
+    `output_pattern` (a compiled regex) is given, every failure is retried.
+    Otherwise a failure is retried if it matches either one.'''
+
+    def should_retry(self, returncode, output):
+        if self.exit_codes is None and self.output_pattern is None:
+            return True
+        if self.exit_codes is not None and returncode in self.exit_codes:
+            return True
+        if (self.output_pattern is not None
+                and self.output_pattern.search(output)):
+            return True
+        return False
+
+    def delay(self, attempt):
+        return self.backoff * 2**(attempt - 1)
+
+
+NO_RETRY = RetryPolicy(
+    max_attempts=1, backoff=0, exit_codes=None, output_pattern=None)
+
+
+def _attempts_suffix(attempts):
+    if attempts == 1:
+        return ''
+    return ' (after {} attempts)'.format(attempts)
+
+
+class _SharedHandle:
+    '''Wraps a display handle so that several attempts at the same job can
+    each use it in a with statement. The real handle is entered the first
+    time, and only exited by finish().'''
+
+    def __init__(self, display_handle):
+        self._handle = display_handle
+        self._entered = False
+
+    def write(self, string):
+        self._handle.write(string)
+
+    def report(self, **fields):
+        self._handle.report(**fields)
+
+    def __enter__(self):
+        if not self._entered:
+            self._handle.__enter__()
+            self._entered = True
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def finish(self):
+        if self._entered:
+            self._handle.__exit__(None, None, None)
+
+
+class PluginWorkerPool:
+    '''Keeps warm processes around for plugins that declare a `worker exe`.
+    Starting a new interpreter (plus whatever the plugin imports) for every
+    job adds up across hundreds of modules, so instead each worker runs many
+    jobs, one at a time, sent to it as JSON lines. See peru/plugin_worker.py
+    for the other end of the protocol. The fetch semaphore still bounds how
+    many jobs run at once, so the pool never grows beyond that many workers
+    per plugin.'''
+
+    def __init__(self):
+        self._idle = collections.defaultdict(list)
+
+    async def run(self, command, display_handle, *, cwd, env, log_path=None):
+        idle = self._idle[tuple(command)]
+        if idle:
+            proc = idle.pop()
+        else:
+            proc = await self._start_worker(command, cwd)
+        request = {'env': env, 'cwd': cwd}
+        try:
+            returncode, output = await run_worker_job_with_handle(
+                proc, request, display_handle, log_path=log_path)
+        except BaseException:
+            # We were interrupted in the middle of a job (a timeout, say), so
+            # there's no telling what state the worker is in. Don't reuse it.
+            await _kill_worker(proc)
+            raise
+        if returncode is None:
+            await _kill_worker(proc)
+            returncode = proc.returncode or 1
+            output += '\nplugin worker exited unexpectedly'
+        else:
+            idle.append(proc)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, output)
+        return output
+
+    async def close(self):
+        workers = [proc for idle in self._idle.values() for proc in idle]
+        self._idle.clear()
+        # Closing stdin is the signal for a worker to exit.
+        for proc in workers:
+            proc.stdin.close()
+        for proc in workers:
+            await proc.wait()
+
+    async def _start_worker(self, command, cwd):
+        # Each request carries the job's complete environment, so this only
+        # needs to be good enough to start the interpreter.
+        env = os.environ.copy()
+        env['PYTHONUNBUFFERED'] = 'true'
+        env['PERU_PLUGIN_WORKER'] = '1'
+        # Workers import peru.plugin_worker. An installed peru is already on
+        # their path, but one running straight from a checkout isn't. Don't
+        # put all of site-packages in front of the plugins' own paths.
+        checkout_root = os.path.dirname(compat.MODULE_ROOT)
+        if os.path.isfile(os.path.join(checkout_root, 'peru.py')):
+            env['PYTHONPATH'] = os.pathsep.join(
+                [checkout_root] +
+                [path for path in [env.get('PYTHONPATH')] if path])
+        return (await asyncio.create_subprocess_exec(
+            *command,
+            cwd=cwd,
+            env=env,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            limit=WORKER_LINE_LIMIT))
+
+
+# Output messages from workers are small, but tracebacks from a worker that
+# fails to start come through as raw lines.
+WORKER_LINE_LIMIT = 2**20
+
+
+async def _kill_worker(proc):
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+    await proc.wait()
+
+
+class FailureCache:
+    '''Remembers recent plugin failures on disk, keyed on the module's fields
+    and the plugin command, so that when an upstream host is down, repeated
+    syncs (say, every stage of a CI pipeline) fail fast instead of each
+    waiting on it again. Entries expire after `ttl` seconds, and any
+    successful job for the same key clears its entry early.'''
+
+    def __init__(self, keyval, ttl):
+        self._keyval = keyval
+        self._ttl = ttl
+
+    def raise_if_failed(self, key):
+        if key not in self._keyval:
+            return
         try:
-            await create_subprocess_with_handle(
-                plugin_command,
-                display_handle,
-                cwd=plugin_context.cwd,
-                env=complete_env,
-                shell=is_shell_mode)
-        except subprocess.CalledProcessError as e:
-            raise PluginRuntimeError(module_type, module_fields, e.returncode,
-                                     e.output)
+            entry = json.loads(self._keyval[key])
+            age = time.time() - entry['time']
+        except (OSError, ValueError, KeyError, TypeError):
+            # A concurrent peru might have just cleared it, or it's garbage.
+            return
+        if not 0 <= age < self._ttl:
+            del self._keyval[key]
+            return
+        raise PluginRecentFailureError(
+            'This plugin failed {:.0f} seconds ago, and that failure is '
+            'cached for {:g} seconds:\n\n{}', age, self._ttl,
+            entry['message'])
+
+    def record(self, key, message):
+        self._keyval[key] = json.dumps({
+            'time': time.time(),
+            'message': message,
+        })
+
+    def clear(self, key):
+        del self._keyval[key]
+
+
+def _plugin_failure_key(definition, module_fields, command):
+    # Key on every field, not just the cache fields, so that a bad rev of a
+    # repo doesn't block fetching a good one, or reup of the same module.
+    return cache.compute_key({
+        'type': definition.type,
+        'fields': module_fields,
+        'command': command,
+    })
 
 
 def _get_plugin_exe(definition, command):
@@ -158,6 +471,8 @@ def _get_plugin_exe(definition, command):
         exe = definition.sync_exe
     elif command == 'reup':
         exe = definition.reup_exe
+    elif command == 'worker':
+        exe = definition.worker_exe
     else:
         raise RuntimeError('Unrecognized command name: ' + repr(command))
 
@@ -255,6 +570,52 @@ def _plugin_cache_path(plugin_context, definition, module_fields):
     return plugin_cache
 
 
+async def _prepare_plugin_cache(plugin_context, plugin_cache):
+    '''If the plugin's cache dir is empty, but a read-only cache layer has one
+    for the same fields, copy it up, so that the plugin can update it in
+    place. The caller holds the lock for the dir.'''
+    if plugin_cache == os.devnull:
+        return
+    found = bool(os.listdir(plugin_cache))
+    if not found:
+        relative_path = os.path.relpath(plugin_cache,
+                                        plugin_context.plugin_cache_root)
+        for lower_root in plugin_context.lower_plugin_cache_roots:
+            lower_cache = os.path.join(lower_root, relative_path)
+            if os.path.isdir(lower_cache) and os.listdir(lower_cache):
+                with trace.span('copy plugin cache', src=lower_cache):
+                    await asyncio.get_event_loop().run_in_executor(
+                        None, _copy_plugin_cache, lower_cache, plugin_cache)
+                found = True
+                break
+    if plugin_context.cache_stats is not None:
+        plugin_context.cache_stats.record('plugin cache dirs', found)
+
+
+def _copy_plugin_cache(src, dest):
+    # Copy into a tmp dir next to the destination and then rename it, so that
+    # an interrupted copy never leaves a partial clone behind.
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(dest))
+    try:
+        shutil.copytree(src, tmp, symlinks=True, dirs_exist_ok=True)
+        os.rmdir(dest)
+        os.rename(tmp, dest)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def get_plugin_cache_dir(plugin_context, module_type, module_fields):
+    '''Returns the path of a module's plugin cache dir, whether or not it
+    exists yet, or None if its plugin doesn't keep one.'''
+    registry = plugin_context.plugin_registry or PluginRegistry()
+    definition = registry.get_definition(module_type)
+    if not definition.cache_fields:
+        return None
+    return os.path.join(plugin_context.plugin_cache_root, definition.type,
+                        _plugin_cache_key(definition, module_fields))
+
+
 def _plugin_cache_key(definition, module_fields):
     assert definition.cache_fields, "Can't compute key for uncacheable type."
     return cache.compute_key({
@@ -266,19 +627,54 @@ def _plugin_cache_key(definition, module_fields):
     })
 
 
-def _get_plugin_definition(module_type, module_fields, command):
-    root = _find_plugin_dir(module_type)
-    metadata_path = os.path.join(root, 'plugin.yaml')
-    if not os.path.isfile(metadata_path):
-        raise PluginMetadataMissingError(
-            'No metadata file found for plugin at path: {}'.format(root))
-
+class PluginRegistry:
+    '''Memoizes plugin lookups for the lifetime of a Runtime. Finding a plugin
+    means probing every install dir and parsing its plugin.yaml, and a project
+    with hundreds of modules would otherwise repeat that for every job. A
+    definition is reloaded if its plugin.yaml changes on disk.'''
+
+    def __init__(self):
+        self._plugin_dirs = {}
+        # module_type -> (plugin.yaml mtime, PluginDefinition)
+        self._definitions = {}
+        # (PluginDefinition, command) -> checked exe path
+        self._exes = {}
+
+    def get_definition(self, module_type):
+        root = self._plugin_dirs.get(module_type)
+        if root is None:
+            root = _find_plugin_dir(module_type)
+            self._plugin_dirs[module_type] = root
+        metadata_path = os.path.join(root, 'plugin.yaml')
+        try:
+            mtime = os.stat(metadata_path).st_mtime_ns
+        except FileNotFoundError:
+            raise PluginMetadataMissingError(
+                'No metadata file found for plugin at path: {}'.format(root))
+        cached = self._definitions.get(module_type)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        definition = _read_plugin_definition(module_type, root,
+                                             metadata_path)
+        self._definitions[module_type] = (mtime, definition)
+        return definition
+
+    def get_exe(self, definition, command):
+        key = (definition, command)
+        if key not in self._exes:
+            self._exes[key] = _get_plugin_exe(definition, command)
+        return self._exes[key]
+
+
+def _read_plugin_definition(module_type, root, metadata_path):
     # Read the metadata document.
     with open(metadata_path) as metafile:
-        metadoc = yaml.safe_load(metafile) or {}
+        metadoc = compat.yaml_safe_load(metafile) or {}
     sync_exe = os.path.join(root, metadoc.pop('sync exe'))
     reup_exe = (None if 'reup exe' not in metadoc else os.path.join(
         root, metadoc.pop('reup exe')))
+    worker_exe = (None if 'worker exe' not in metadoc else os.path.join(
+        root, metadoc.pop('worker exe')))
     required_fields = frozenset(metadoc.pop('required fields'))
     optional_fields = frozenset(metadoc.pop('optional fields', []))
     cache_fields = frozenset(metadoc.pop('cache fields', []))
@@ -298,11 +694,9 @@ def _get_plugin_definition(module_type, module_fields, command):
             '"cache fields" must also be either required or optional: ' +
             str(invalid))
 
-    definition = PluginDefinition(module_type, sync_exe, reup_exe, fields,
-                                  required_fields, optional_fields,
-                                  cache_fields)
-    _validate_plugin_definition(definition, module_fields)
-    return definition
+    return PluginDefinition(module_type, sync_exe, reup_exe, worker_exe,
+                            fields, required_fields, optional_fields,
+                            cache_fields)
 
 
 def _find_plugin_dir(module_type):
@@ -387,8 +781,20 @@ class PluginPermissionsError(PrintableError):
     pass
 
 
+class PluginTimeoutError(PrintableError):
+    pass
+
+
+class PluginRecentFailureError(PrintableError):
+    pass
+
+
 class PluginRuntimeError(PrintableError):
-    def __init__(self, type, fields, errorcode, output):
+    def __init__(self, type, fields, errorcode, output, attempts=1):
         # Don't depend on plugins using terminating newlines.
         stripped_output = output.strip('\n')
+        if attempts > 1:
+            stripped_output += '\n\n{} plugin failed{}.'.format(
+                type, _attempts_suffix(attempts))
         super().__init__(stripped_output)
+        self.attempts = attempts
@@ -0,0 +1,116 @@
+'''The plugin side of the worker protocol. A plugin that declares a `worker
+exe` in its plugin.yaml may be started once and then handed many jobs, instead
+of being started fresh for every job. Peru sets PERU_PLUGIN_WORKER=1 in the
+worker's environment, and a Python plugin can support this just by passing its
+usual entry point to serve():
+
+    if os.environ.get('PERU_PLUGIN_WORKER'):
+        from peru import plugin_worker
+        plugin_worker.serve(main)
+    else:
+        main()
+
+The protocol is JSON lines. Each request on stdin looks like
+
+    {"env": {...}, "cwd": "..."}
+
+where `env` is the complete environment the job would have been started with.
+The worker answers with any number of {"output": "..."} lines, carrying
+whatever the job printed, followed by exactly one {"returncode": N} line.
+
+This module deliberately imports nothing from the rest of peru, so that it's
+cheap to load inside a plugin.'''
+
+import codecs
+import json
+import os
+import sys
+import threading
+import traceback
+
+
+def serve(job_fn):
+    '''Run job_fn once per request, with os.environ and the working directory
+    set up the way they would be in a freshly started plugin. Everything the
+    job writes to stdout or stderr, including the output of its child
+    processes, is forwarded to peru. A SystemExit from the job sets its
+    return code, like it would for a standalone plugin.'''
+    # Take private copies of the protocol pipes, and point the standard fds
+    # somewhere harmless between jobs. Child processes started by a job must
+    # never be able to read our requests or write into the protocol stream.
+    requests = os.fdopen(os.dup(0), 'r', encoding='utf8')
+    responses = os.fdopen(os.dup(1), 'w', encoding='utf8')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    lock = threading.Lock()
+
+    for line in requests:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        returncode = _run_job(job_fn, request, responses, lock, devnull)
+        _send(responses, lock, {'returncode': returncode})
+
+
+def _run_job(job_fn, request, responses, lock, devnull):
+    read_fd, write_fd = os.pipe()
+    os.dup2(write_fd, 1)
+    os.dup2(write_fd, 2)
+    os.close(write_fd)
+    forwarder = threading.Thread(
+        target=_forward_output, args=(read_fd, responses, lock))
+    forwarder.start()
+
+    old_environ = dict(os.environ)
+    old_cwd = os.getcwd()
+    os.environ.clear()
+    os.environ.update(request['env'])
+    try:
+        os.chdir(request['cwd'])
+        returncode = _exit_code(job_fn())
+    except SystemExit as e:
+        returncode = _exit_code(e.code)
+    except Exception:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Closing our copies of the pipe's write end lets the forwarder see
+        # EOF, once any children that inherited it have exited too.
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        forwarder.join()
+        os.chdir(old_cwd)
+        os.environ.clear()
+        os.environ.update(old_environ)
+    return returncode
+
+
+def _exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    # sys.exit("message") prints the message and exits with 1.
+    print(code, file=sys.stderr)
+    return 1
+
+
+def _forward_output(read_fd, responses, lock):
+    decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+    with os.fdopen(read_fd, 'rb', buffering=0) as pipe:
+        while True:
+            outputbytes = pipe.read(4096)
+            text = decoder.decode(outputbytes, final=not outputbytes)
+            if text:
+                _send(responses, lock, {'output': text})
+            if not outputbytes:
+                break
+
+
+def _send(responses, lock, message):
+    with lock:
+        responses.write(json.dumps(message) + '\n')
+        responses.flush()
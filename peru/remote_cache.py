@@ -0,0 +1,278 @@
+'''An optional cache shared between machines, like a team's build agents. With
+PERU_REMOTE_CACHE set to an http(s) URL or to a directory (say, on a network
+drive), a module or rule whose key misses in the local cache is looked up
+there before peru fetches it, and new results are uploaded after a successful
+fetch.
+
+The remote cache stores two kinds of files:
+
+    keyval/<key>        the hash of the tree for a cache key, like the local
+                        keyval dir
+    packs/<tree>.pack   a git pack of that tree and everything in it
+
+Packs are written before keyval entries, so a reader that finds an entry can
+count on its pack being there. Anything that goes wrong with the remote cache
+(a server that's down, a corrupt pack) is treated as a miss, with a warning,
+and the remote cache is turned off for the rest of the command.
+
+An HTTP server is just a place to GET and PUT those paths. For testing, or
+for a small team, this module can serve a directory over HTTP:
+
+    python -m peru.remote_cache serve <dir> [--port=<port>]'''
+
+import asyncio
+import http.server
+import os
+import re
+import sys
+import tempfile
+import urllib.error
+import urllib.request
+
+from . import trace
+
+HASH_RE = re.compile('^[0-9a-f]{40}$')
+
+# How long to wait on an HTTP server before giving up on it.
+HTTP_TIMEOUT = 30
+
+
+class RemoteCacheError(Exception):
+    pass
+
+
+def get_backend(location):
+    if re.match('^https?://', location):
+        return HttpBackend(location)
+    return DirectoryBackend(location)
+
+
+class DirectoryBackend:
+    def __init__(self, root):
+        self.root = root
+
+    def read(self, path):
+        '''Returns the bytes at the path, or None if there's nothing there.'''
+        try:
+            with open(os.path.join(self.root, path), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            raise RemoteCacheError(e)
+
+    def write(self, path, data):
+        full_path = os.path.join(self.root, path)
+        try:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            # Write to a tmp file first, so that readers on other machines
+            # never see part of a file.
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, full_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        except OSError as e:
+            raise RemoteCacheError(e)
+
+
+class HttpBackend:
+    def __init__(self, url):
+        self.url = url.rstrip('/') + '/'
+
+    def read(self, path):
+        try:
+            with urllib.request.urlopen(
+                    self.url + path, timeout=HTTP_TIMEOUT) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise RemoteCacheError('GET {}: {}'.format(path, e))
+        except OSError as e:
+            raise RemoteCacheError('GET {}: {}'.format(path, e))
+
+    def write(self, path, data):
+        request = urllib.request.Request(
+            self.url + path, data=data, method='PUT')
+        try:
+            with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT):
+                pass
+        except OSError as e:
+            raise RemoteCacheError('PUT {}: {}'.format(path, e))
+
+
+class RemoteCache:
+    def __init__(self, cache, backend, display=None):
+        self.cache = cache
+        self.backend = backend
+        self.display = display
+        self.enabled = True
+
+    async def get(self, key):
+        '''Returns the tree for the key, or None if the remote cache doesn't
+        have it. A tree that's found is added to the local cache's git
+        objects, but not to its keyval. That's up to the caller, once it's
+        checked the tree against anything else it knows, like peru.lock.'''
+        if not self.enabled:
+            return None
+        with trace.span('remote cache get', key=key) as span:
+            try:
+                tree = await self._read(_keyval_path(key))
+                if tree is None:
+                    span.set(found=False)
+                    return None
+                tree = tree.decode().strip()
+                if not HASH_RE.match(tree):
+                    raise RemoteCacheError(
+                        'bad keyval entry for {}'.format(key))
+                if not await self._import_tree(tree):
+                    raise RemoteCacheError('missing pack for ' + tree)
+            except Exception as e:
+                self._disable(e)
+                return None
+            span.set(found=True)
+        return tree
+
+    async def get_tree(self, tree):
+        '''Adds a tree to the local cache, if the remote cache has its pack,
+        and returns whether it did. Callers that already know the tree they
+        want, like from peru.lock, don't need a keyval entry.'''
+        if not self.enabled:
+            return False
+        with trace.span('remote cache get tree', tree=tree) as span:
+            try:
+                found = await self._import_tree(tree)
+            except Exception as e:
+                self._disable(e)
+                return False
+            span.set(found=found)
+        return found
+
+    async def _import_tree(self, tree):
+        pack = await self._read(_pack_path(tree))
+        if pack is None:
+            return False
+        await self.cache.import_pack(pack, tree)
+        return True
+
+    async def put(self, key, tree):
+        '''Uploads the tree for the key.'''
+        if not self.enabled:
+            return
+        with trace.span('remote cache put', key=key):
+            try:
+                pack = await self.cache.export_pack(tree)
+                await self._write(_pack_path(tree), pack)
+                await self._write(_keyval_path(key), tree.encode())
+            except Exception as e:
+                self._disable(e)
+
+    async def _read(self, path):
+        loop = asyncio.get_event_loop()
+        return (await loop.run_in_executor(None, self.backend.read, path))
+
+    async def _write(self, path, data):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.backend.write, path, data)
+
+    def _disable(self, error):
+        # Don't make every module wait on a server that's down.
+        self.enabled = False
+        if self.display is not None:
+            self.display.print(
+                'Remote cache disabled after an error: {}'.format(error))
+
+
+def _keyval_path(key):
+    assert HASH_RE.match(key), 'bad cache key ' + repr(key)
+    return 'keyval/' + key
+
+
+def _pack_path(tree):
+    assert HASH_RE.match(tree), 'bad tree ' + repr(tree)
+    return 'packs/{}.pack'.format(tree)
+
+
+def _is_valid_path(path):
+    parts = path.split('/')
+    if len(parts) != 2:
+        return False
+    dir, name = parts
+    if dir == 'keyval':
+        return bool(HASH_RE.match(name))
+    if dir == 'packs':
+        return name.endswith('.pack') and bool(HASH_RE.match(name[:-5]))
+    return False
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    # Set by make_server().
+    backend = None
+
+    def do_GET(self):
+        path = self._cache_path()
+        if path is None:
+            return
+        data = self.backend.read(path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        path = self._cache_path()
+        if path is None:
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        self.backend.write(path, self.rfile.read(length))
+        self.send_response(204)
+        self.end_headers()
+
+    def _cache_path(self):
+        path = self.path.lstrip('/')
+        if not _is_valid_path(path):
+            self.send_error(400)
+            return None
+        return path
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(root, port=0, host='127.0.0.1'):
+    '''Returns an HTTP server for a directory backend at root. Port 0 picks a
+    free port, see `server.server_address`.'''
+    handler = type('RequestHandler', (_RequestHandler, ),
+                   {'backend': DirectoryBackend(root)})
+    return http.server.ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv):
+    import argparse
+    argparser = argparse.ArgumentParser(
+        prog='python -m peru.remote_cache',
+        description='Serve a directory as a peru remote cache.')
+    argparser.add_argument('command', choices=['serve'])
+    argparser.add_argument('dir')
+    argparser.add_argument('--port', type=int, default=8000)
+    argparser.add_argument('--host', default='127.0.0.1')
+    args = argparser.parse_args(argv)
+    server = make_server(args.dir, args.port, args.host)
+    host, port = server.server_address[:2]
+    print('Serving {} on http://{}:{}/'.format(args.dir, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
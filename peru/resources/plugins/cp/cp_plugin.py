@@ -3,9 +3,19 @@
 import os
 import shutil
 
-shutil.copytree(
-    os.environ['PERU_MODULE_PATH'],
-    os.environ['PERU_SYNC_DEST'],
-    symlinks=True,
-    dirs_exist_ok=True,
-)
+
+def main():
+    shutil.copytree(
+        os.environ['PERU_MODULE_PATH'],
+        os.environ['PERU_SYNC_DEST'],
+        symlinks=True,
+        dirs_exist_ok=True,
+    )
+
+
+if __name__ == '__main__':
+    if os.environ.get('PERU_PLUGIN_WORKER'):
+        from peru import plugin_worker
+        plugin_worker.serve(main)
+    else:
+        main()
@@ -4,6 +4,7 @@ import hashlib
 import os
 import pathlib
 import re
+import shutil
 import stat
 import sys
 import tarfile
@@ -61,10 +62,26 @@ def format_bytes(num_bytes):
     return '{}B'.format(num_bytes)
 
 
+def print_progress(bytes_read, file_size, stdout=sys.stdout):
+    percentage = ''
+    kb_downloaded = format_bytes(bytes_read)
+    total_kb = ''
+    if file_size:
+        percentage = ' {}%'.format(round(100 * bytes_read / file_size))
+        total_kb = '/' + format_bytes(file_size)
+    print(
+        'downloaded{} {}{}'.format(percentage, kb_downloaded, total_kb),
+        file=stdout)
+
+
+def get_file_size(request):
+    file_size_str = request.info().get('Content-Length')
+    return int(file_size_str) if file_size_str is not None else None
+
+
 def download_file(request, output_file, stdout=sys.stdout):
     digest = hashlib.sha1()
-    file_size_str = request.info().get('Content-Length')
-    file_size = int(file_size_str) if file_size_str is not None else None
+    file_size = get_file_size(request)
     bytes_read = 0
     while True:
         buf = request.read(4096)
@@ -74,21 +91,74 @@ def download_file(request, output_file, stdout=sys.stdout):
         if output_file:
             output_file.write(buf)
         bytes_read += len(buf)
-        percentage = ''
-        kb_downloaded = format_bytes(bytes_read)
-        total_kb = ''
-        if file_size:
-            percentage = ' {}%'.format(round(100 * bytes_read / file_size))
-            total_kb = '/' + format_bytes(file_size)
-        print(
-            'downloaded{} {}{}'.format(percentage, kb_downloaded, total_kb),
-            file=stdout)
+        print_progress(bytes_read, file_size, stdout)
     return digest.hexdigest()
 
 
+class HashingReader:
+    '''A read-only file object that hashes and reports progress on every byte
+    that passes through it. This lets tarfile consume an archive straight from
+    the network, while we still get the same SHA1 that download_file() would
+    have computed.'''
+
+    def __init__(self, request, stdout=sys.stdout):
+        self._request = request
+        self._stdout = stdout
+        self._file_size = get_file_size(request)
+        self._bytes_read = 0
+        self._pushback = b''
+        self._digest = hashlib.sha1()
+
+    def read(self, size=-1):
+        if self._pushback:
+            if size < 0 or size >= len(self._pushback):
+                buf = self._pushback + self._request_read(
+                    size - len(self._pushback) if size >= 0 else -1)
+                self._pushback = b''
+            else:
+                buf = self._pushback[:size]
+                self._pushback = self._pushback[size:]
+            return buf
+        return self._request_read(size)
+
+    def peek(self, size):
+        '''Return up to `size` bytes without consuming them.'''
+        while len(self._pushback) < size:
+            buf = self._request_read(size - len(self._pushback))
+            if not buf:
+                break
+            self._pushback += buf
+        return self._pushback[:size]
+
+    def drain(self):
+        '''Consume whatever the archive reader left unread (end-of-archive
+        padding, trailing compressed blocks), so that the digest covers the
+        whole download.'''
+        self._pushback = b''
+        while self._request_read(65536):
+            pass
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def _request_read(self, size):
+        if size == 0:
+            return b''
+        buf = self._request.read(size) if size > 0 else self._request.read()
+        if buf:
+            self._digest.update(buf)
+            self._bytes_read += len(buf)
+            print_progress(self._bytes_read, self._file_size, self._stdout)
+        return buf
+
+
 def plugin_sync(url, sha1):
     unpack = os.environ['PERU_MODULE_UNPACK']
     dest = os.environ['PERU_SYNC_DEST']
+    if unpack == 'tar':
+        # Tarballs are unpacked as they arrive, without a temporary copy.
+        plugin_sync_tar_stream(url, sha1, dest)
+        return
     if unpack:
         # Download to the tmp dir for later unpacking.
         download_dir = os.environ['PERU_PLUGIN_TMP']
@@ -104,17 +174,10 @@ def plugin_sync(url, sha1):
         with open(full_filepath, 'wb') as output_file:
             digest = download_file(request, output_file)
 
-    if sha1 and digest != sha1:
-        print(
-            'Bad checksum!\n     url: {}\nexpected: {}\n  actual: {}'.format(
-                url, sha1, digest),
-            file=sys.stderr)
-        sys.exit(1)
+    check_digest(url, sha1, digest)
 
     try:
-        if unpack == 'tar':
-            extract_tar(full_filepath, dest)
-        elif unpack == 'zip':
+        if unpack == 'zip':
             extract_zip(full_filepath, dest)
         elif unpack:
             print('Unknown value for "unpack":', unpack, file=sys.stderr)
@@ -124,22 +187,104 @@ def plugin_sync(url, sha1):
         sys.exit(1)
 
 
+def plugin_sync_tar_stream(url, sha1, dest):
+    preexisting = set(os.listdir(dest))
+    try:
+        with urllib.request.urlopen(build_request(url)) as request:
+            reader = HashingReader(request)
+            try:
+                extract_tar_stream(reader, dest)
+            except tarfile.TarError as e:
+                # Often this is something like an HTML error page. If there's
+                # a checksum, a mismatch is the clearer error.
+                reader.drain()
+                check_digest(url, sha1, reader.hexdigest())
+                print('Not a tar archive: {}\n{}'.format(url, e),
+                      file=sys.stderr)
+                sys.exit(1)
+            reader.drain()
+        check_digest(url, sha1, reader.hexdigest())
+    except EvilArchiveError as e:
+        rollback_extraction(dest, preexisting)
+        print(e.message, file=sys.stderr)
+        sys.exit(1)
+    except BaseException:
+        # Including the SystemExit from a bad checksum. Nothing from an
+        # unverified archive should survive.
+        rollback_extraction(dest, preexisting)
+        raise
+
+
+def check_digest(url, sha1, digest):
+    if sha1 and digest != sha1:
+        print(
+            'Bad checksum!\n     url: {}\nexpected: {}\n  actual: {}'.format(
+                url, sha1, digest),
+            file=sys.stderr)
+        sys.exit(1)
+
+
+def rollback_extraction(dest, preexisting):
+    '''Delete everything that showed up in dest since `preexisting` was
+    listed.'''
+    for name in set(os.listdir(dest)) - preexisting:
+        path = os.path.join(dest, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def open_tar_stream(fileobj):
+    # Stream mode ("r|*") detects gzip, bzip2 and xz itself, and zstd too as
+    # of Python 3.14. On older Pythons, fall back to the zstandard package for
+    # zstd, if it's installed.
+    magic = fileobj.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)]
+    if magic == ZSTD_MAGIC and not hasattr(tarfile.TarFile, 'zstopen'):
+        try:
+            import zstandard
+        except ImportError:
+            raise EvilArchiveError(
+                'Unpacking zstd tarballs requires Python 3.14 or the '
+                '"zstandard" package.')
+        decompressed = zstandard.ZstdDecompressor().stream_reader(fileobj)
+        return tarfile.open(fileobj=decompressed, mode='r|')
+    return tarfile.open(fileobj=fileobj, mode='r|*')
+
+
 def extract_tar(archive_path, dest):
-    with tarfile.open(archive_path) as t:
-        for info in t.getmembers():
+    preexisting = set(os.listdir(dest))
+    with open(archive_path, 'rb') as f:
+        try:
+            extract_tar_stream(f, dest)
+        except EvilArchiveError:
+            rollback_extraction(dest, preexisting)
+            raise
+
+
+def extract_tar_stream(fileobj, dest):
+    '''Extract members one at a time, in archive order, as they're read from
+    fileobj. Each member is validated before it's written, but an evil member
+    can show up after good ones have already been extracted, so callers need to
+    roll back dest if this raises.'''
+    # Python 3.12 added the `filter` kwarg, which should make our
+    # validation redundant. (It was also added to patch releases of earlier
+    # Python versions.) Python 3.13 made it a warning to omit this
+    # argument, because Python 3.14 will change the default to "data".
+    # That's the behavior we want, and specifying it here lets us get it on
+    # Python 3.12/3.13 and silences the warning.
+    kwargs = {}
+    if sys.version_info >= (3, 12):
+        kwargs["filter"] = "data"
+    with open_tar_stream(fileobj) as t:
+        for info in t:
             validate_filename(info.path)
             if info.issym():
                 validate_symlink(info.path, info.linkname)
-        # Python 3.12 added the `filter` kwarg, which should make our
-        # validation redundant. (It was also added to patch releases of earlier
-        # Python versions.) Python 3.13 made it a warning to omit this
-        # argument, because Python 3.14 will change the default to "data".
-        # That's the behavior we want, and specifying it here lets us get it on
-        # Python 3.12/3.13 and silences the warning.
-        kwargs = {}
-        if sys.version_info >= (3, 12):
-            kwargs["filter"] = "data"
-        t.extractall(dest, **kwargs)
+            t.extract(info, dest, **kwargs)
 
 
 def extract_zip(archive_path, dest):
@@ -223,4 +368,8 @@ def main():
 
 
 if __name__ == '__main__':
-    sys.exit(main())
+    if os.environ.get('PERU_PLUGIN_WORKER'):
+        from peru import plugin_worker
+        plugin_worker.serve(main)
+    else:
+        sys.exit(main())
@@ -199,4 +199,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if os.environ.get('PERU_PLUGIN_WORKER'):
+        from peru import plugin_worker
+        plugin_worker.serve(main)
+    else:
+        main()
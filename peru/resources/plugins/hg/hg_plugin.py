@@ -6,11 +6,6 @@ import subprocess
 import sys
 import textwrap
 
-CACHE_PATH = os.environ['PERU_PLUGIN_CACHE']
-URL = os.environ['PERU_MODULE_URL']
-REV = os.environ['PERU_MODULE_REV'] or 'default'
-REUP = os.environ['PERU_MODULE_REUP'] or 'default'
-
 Result = namedtuple("Result", ["returncode", "output"])
 
 
@@ -38,12 +33,12 @@ def hg(*args, hg_dir=None, capture_output=False, checked=True):
     return Result(process.returncode, output)
 
 
-def clone_if_needed(url, verbose=False):
-    if not os.path.exists(os.path.join(CACHE_PATH, '.hg')):
+def clone_if_needed(url, cache_path, verbose=False):
+    if not os.path.exists(os.path.join(cache_path, '.hg')):
         if verbose:
             print('hg clone', url)
-        hg('clone', '--noupdate', url, CACHE_PATH)
-        configure(CACHE_PATH)
+        hg('clone', '--noupdate', url, cache_path)
+        configure(cache_path)
 
 
 def configure(repo_path):
@@ -83,36 +78,50 @@ def already_has_rev(repo, rev):
     return res.output.split()[0] == rev
 
 
-def plugin_sync():
+def plugin_sync(url, rev, cache_path):
     dest = os.environ['PERU_SYNC_DEST']
-    clone_if_needed(URL, verbose=True)
-    if not already_has_rev(CACHE_PATH, REV):
-        hg_pull(URL, CACHE_PATH)
+    clone_if_needed(url, cache_path, verbose=True)
+    if not already_has_rev(cache_path, rev):
+        hg_pull(url, cache_path)
     # TODO: Should this handle subrepos?
-    hg('archive', '--type', 'files', '--rev', REV, dest, hg_dir=CACHE_PATH)
+    hg('archive', '--type', 'files', '--rev', rev, dest, hg_dir=cache_path)
 
 
-def plugin_reup():
+def plugin_reup(url, reup, cache_path):
     reup_output = os.environ['PERU_REUP_OUTPUT']
 
-    clone_if_needed(URL, CACHE_PATH)
-    hg_pull(URL, CACHE_PATH)
+    clone_if_needed(url, cache_path, verbose=True)
+    hg_pull(url, cache_path)
     output = hg(
         'identify',
         '--debug',
         '--rev',
-        REUP,
-        hg_dir=CACHE_PATH,
+        reup,
+        hg_dir=cache_path,
         capture_output=True).output
 
     with open(reup_output, 'w') as output_file:
         print('rev:', output.split()[0], file=output_file)
 
 
-command = os.environ['PERU_PLUGIN_COMMAND']
-if command == 'sync':
-    plugin_sync()
-elif command == 'reup':
-    plugin_reup()
-else:
-    raise RuntimeError('Unknown command: ' + repr(command))
+def main():
+    cache_path = os.environ['PERU_PLUGIN_CACHE']
+    url = os.environ['PERU_MODULE_URL']
+    rev = os.environ['PERU_MODULE_REV'] or 'default'
+    reup = os.environ['PERU_MODULE_REUP'] or 'default'
+
+    command = os.environ['PERU_PLUGIN_COMMAND']
+    if command == 'sync':
+        plugin_sync(url, rev, cache_path)
+    elif command == 'reup':
+        plugin_reup(url, reup, cache_path)
+    else:
+        raise RuntimeError('Unknown command: ' + repr(command))
+
+
+if __name__ == '__main__':
+    if os.environ.get('PERU_PLUGIN_WORKER'):
+        from peru import plugin_worker
+        plugin_worker.serve(main)
+    else:
+        main()
@@ -54,10 +54,19 @@ def plugin_reup():
         print('rev:', '"{}"'.format(rev), file=f)
 
 
-command = os.environ['PERU_PLUGIN_COMMAND']
-if command == 'sync':
-    plugin_sync()
-elif command == 'reup':
-    plugin_reup()
-else:
-    raise RuntimeError('Unknown command: ' + repr(command))
+def main():
+    command = os.environ['PERU_PLUGIN_COMMAND']
+    if command == 'sync':
+        plugin_sync()
+    elif command == 'reup':
+        plugin_reup()
+    else:
+        raise RuntimeError('Unknown command: ' + repr(command))
+
+
+if __name__ == '__main__':
+    if os.environ.get('PERU_PLUGIN_WORKER'):
+        from peru import plugin_worker
+        plugin_worker.serve(main)
+    else:
+        main()
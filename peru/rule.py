@@ -4,6 +4,8 @@ import re
 from . import cache
 from .error import PrintableError
 from . import glob
+from . import lockfile
+from . import trace
 
 
 class Rule:
@@ -27,6 +29,9 @@ class Rule:
             'export': self.export,
         })
 
+    def _stage_span(self, stage):
+        return trace.span('rule ' + stage, rule=self.name)
+
     async def get_tree(self, runtime, input_tree):
         key = self._cache_key(input_tree)
 
@@ -34,26 +39,52 @@ class Rule:
         # same rule (or identical rules) twice with the same input.
         cache_lock = runtime.cache_key_locks[key]
         async with cache_lock:
+            tree = None
             if key in runtime.cache.keyval:
-                return runtime.cache.keyval[key]
+                tree = runtime.cache.keyval[key]
+                if not lockfile.agrees(runtime, 'rules', key, tree):
+                    tree = None
+            runtime.cache.stats.record('rules', tree is not None, key)
+            if tree is None:
+                tree = await lockfile.get_locked_tree(runtime, 'rules', key)
+            if tree is None and runtime.remote_cache is not None:
+                tree = await runtime.remote_cache.get(key)
+                if not lockfile.agrees(runtime, 'rules', key, tree):
+                    tree = None
+                runtime.cache.stats.record('remote', tree is not None, key)
+                if tree is not None:
+                    runtime.cache.keyval[key] = tree
+            if tree is None:
+                tree = await self._apply(runtime, input_tree)
+                lockfile.check(runtime, 'rules', key, self.name, tree)
+                runtime.cache.keyval[key] = tree
+                if runtime.remote_cache is not None:
+                    await runtime.remote_cache.put(key, tree)
+
+        lockfile.record(runtime, 'rules', key, self.name, tree)
+        return tree
 
-            tree = input_tree
-            if self.copy:
+    async def _apply(self, runtime, input_tree):
+        tree = input_tree
+        if self.copy:
+            with self._stage_span('copy'):
                 tree = await copy_files(runtime.cache, tree, self.copy)
-            if self.move:
+        if self.move:
+            with self._stage_span('move'):
                 tree = await move_files(runtime.cache, tree, self.move)
-            if self.drop:
+        if self.drop:
+            with self._stage_span('drop'):
                 tree = await drop_files(runtime.cache, tree, self.drop)
-            if self.pick:
+        if self.pick:
+            with self._stage_span('pick'):
                 tree = await pick_files(runtime.cache, tree, self.pick)
-            if self.executable:
+        if self.executable:
+            with self._stage_span('executable'):
                 tree = await make_files_executable(runtime.cache, tree,
                                                    self.executable)
-            if self.export:
+        if self.export:
+            with self._stage_span('export'):
                 tree = await get_export_tree(runtime.cache, tree, self.export)
-
-            runtime.cache.keyval[key] = tree
-
         return tree
 
 
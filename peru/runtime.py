@@ -2,6 +2,8 @@ import asyncio
 import collections
 import os
 from pathlib import Path
+import re
+import shutil
 import tempfile
 
 from . import cache
@@ -9,6 +11,7 @@ from . import compat
 from .error import PrintableError
 from . import display
 from .keyval import KeyVal
+from . import lockfile
 from . import parser
 from . import plugin
 
@@ -34,6 +37,10 @@ class _Runtime:
             os.path.join(self.state_dir, 'overrides'), self._tmp_root)
         self._used_overrides = set()
 
+        # Named sync dirs, see `peru dest`.
+        self.dests = KeyVal(
+            os.path.join(self.state_dir, 'dests'), self._tmp_root)
+
         self.force = args.get('--force', False)
         if args['--quiet'] and args['--verbose']:
             raise PrintableError(
@@ -55,10 +62,92 @@ class _Runtime:
         # only used by one job at a time.
         self.plugin_cache_locks = collections.defaultdict(asyncio.Lock)
 
+        # Parsed peru files of recursive modules, so that nested targets don't
+        # parse the same file over and over. See Module.parse_peru_file.
+        self.parsed_scopes = {}
+
+        # Base trees of modules, as futures, so that a module that several
+        # targets import is only resolved once. See Module._get_base_tree.
+        self.module_trees = {}
+
+        # Plugin definitions are looked up once per run, not once per job.
+        self.plugin_registry = plugin.PluginRegistry()
+
+        # Warm processes for plugins that support the worker protocol. Setting
+        # PERU_PLUGIN_WORKERS=never starts a new process for every job.
+        self.worker_pool = None
+        if env.get('PERU_PLUGIN_WORKERS', 'default') != 'never':
+            self.worker_pool = plugin.PluginWorkerPool()
+
         self.display = get_display(args)
+        # --progress-file sends JSON events to a file, on top of the usual
+        # output.
+        self._progress_file = None
+        if args.get('--progress-file'):
+            self._progress_file = open(args['--progress-file'], 'w')
+            self.display = display.JsonDisplay(
+                self._progress_file, wrapped=self.display)
+
+        # Optional limits for slow or broken upstreams. See README.md.
+        self.job_timeout = _get_env_seconds(env, 'PERU_PLUGIN_TIMEOUT')
+        self.failure_cache_ttl = _get_env_seconds(env,
+                                                  'PERU_FAILURE_CACHE_TTL')
+        self.retry_policy = _get_retry_policy(env)
+
+        # Setting PERU_PLUGIN_LOGS writes the full output of every plugin job
+        # to .peru/logs. Otherwise only the end of it is kept, for errors.
+        self.plugin_log_dir = None
+        if env.get('PERU_PLUGIN_LOGS'):
+            self.plugin_log_dir = os.path.join(self.state_dir, 'logs')
+
+        # Setting PERU_SPLIT_INDEX stores lastimports.index as a git split
+        # index. See cache._Cache.
+        self.split_index = bool(env.get('PERU_SPLIT_INDEX'))
+
+        # PERU_REMOTE_CACHE is a URL or a directory that's shared between
+        # machines. See peru/remote_cache.py.
+        self._remote_cache_location = env.get('PERU_REMOTE_CACHE')
+        self.remote_cache = None
+
+        # The resolved trees in peru.lock, if the project has one, and the
+        # new lock file while `peru lock` runs. See peru/lockfile.py.
+        self.lock_path = lockfile.lock_path(self.peru_file)
+        self.lock = lockfile.load(self.lock_path)
+        self.new_lock = None
+
+        # Setting PERU_FSMONITOR watches the sync dir, to make no-op syncs
+        # faster. See peru/fsmonitor.py.
+        self.fsmonitor = None
+        if env.get('PERU_FSMONITOR'):
+            # Only load the monitor (and its ctypes and sockets) when it's on.
+            from . import fsmonitor
+            if fsmonitor.is_supported():
+                self.fsmonitor = fsmonitor.FSMonitor(
+                    self.sync_dir,
+                    self.state_dir,
+                    ignore=[self.state_dir, self.cache_dir])
+
+    async def close(self):
+        if self.worker_pool is not None:
+            await self.worker_pool.close()
+        if self._progress_file is not None:
+            self._progress_file.close()
 
     async def _init_cache(self):
-        self.cache = await cache.Cache(self.cache_dir)
+        self.cache = await cache.Cache(
+            self.cache_dir,
+            split_index=self.split_index,
+            lower_roots=self.cache_layers)
+        self.failure_cache = None
+        if self.failure_cache_ttl:
+            self.failure_cache = plugin.FailureCache(self.cache.failures,
+                                                     self.failure_cache_ttl)
+        if self._remote_cache_location:
+            from . import remote_cache
+            self.remote_cache = remote_cache.RemoteCache(
+                self.cache,
+                remote_cache.get_backend(self._remote_cache_location),
+                self.display)
 
     def _set_paths(self, args, env):
         explicit_peru_file = args['--file']
@@ -81,6 +170,12 @@ class _Runtime:
                           or os.path.join(self.sync_dir, '.peru'))
         self.cache_dir = (args['--cache-dir'] or env.get('PERU_CACHE_DIR')
                           or os.path.join(self.state_dir, 'cache'))
+        # Read-only caches below the cache dir, searched in order. See
+        # cache._Cache.
+        self.cache_layers = [
+            path for path in env.get('PERU_CACHE_LAYERS', '').split(os.pathsep)
+            if path
+        ]
 
     def tmp_dir(self):
         dir = tempfile.TemporaryDirectory(dir=self._tmp_root)
@@ -94,11 +189,19 @@ class _Runtime:
             # file.
             cwd=str(Path(self.peru_file).parent),
             plugin_cache_root=self.cache.plugins_root,
+            lower_plugin_cache_roots=self.cache.lower_plugins_roots,
             parallelism_semaphore=self.fetch_semaphore,
             plugin_cache_locks=self.plugin_cache_locks,
-            tmp_root=self._tmp_root)
+            tmp_root=self._tmp_root,
+            plugin_registry=self.plugin_registry,
+            worker_pool=self.worker_pool,
+            job_timeout=self.job_timeout,
+            failure_cache=self.failure_cache,
+            retry_policy=self.retry_policy,
+            log_dir=self.plugin_log_dir,
+            cache_stats=self.cache.stats)
 
-    def set_override(self, name, path):
+    def _to_project_relative(self, path):
         if not os.path.isabs(path):
             # We can't store relative paths as given, because peru could be
             # running from a different working dir next time. But we don't want
@@ -107,19 +210,53 @@ class _Runtime:
             # a group while preserving all the overrides). So reinterpret all
             # relative paths from the project root.
             path = os.path.relpath(path, start=self.sync_dir)
-        self.overrides[name] = path
+        return path
 
-    def get_override(self, name):
-        if self.no_overrides or name not in self.overrides:
-            return None
-        path = self.overrides[name]
+    def _from_project_relative(self, path):
         if not os.path.isabs(path):
             # Relative paths are stored relative to the project root.
             # Reinterpret them relative to the cwd. See the above comment in
-            # set_override.
+            # _to_project_relative.
             path = os.path.relpath(os.path.join(self.sync_dir, path))
         return path
 
+    def set_override(self, name, path):
+        self.overrides[name] = self._to_project_relative(path)
+
+    def get_override(self, name):
+        if self.no_overrides or name not in self.overrides:
+            return None
+        return self._from_project_relative(self.overrides[name])
+
+    def set_dest(self, name, path):
+        if not name or '/' in name or os.sep in name or name.startswith('.'):
+            raise PrintableError('Invalid destination name "{}".', name)
+        self.dests[name] = self._to_project_relative(path)
+
+    def get_dest(self, name):
+        if name not in self.dests:
+            raise PrintableError(
+                'No destination named "{}". See `peru dest`.', name)
+        return self._from_project_relative(self.dests[name])
+
+    def delete_dest(self, name):
+        if name in self.dests:
+            shutil.rmtree(
+                self.get_sync_state_dir(self.get_dest(name)),
+                ignore_errors=True)
+        del self.dests[name]
+
+    def get_sync_state_dir(self, sync_dir):
+        '''The main sync dir keeps its saved tree and index (lastimports and
+        lastimports.index) right in the state dir. Any other sync dir gets a
+        subdirectory of its own, keyed by its absolute path, so that a
+        destination that's moved somewhere else starts fresh.'''
+        sync_dir = os.path.abspath(sync_dir)
+        if sync_dir == os.path.abspath(self.sync_dir):
+            return self.state_dir
+        return os.path.join(self.state_dir, 'dest_state',
+                            cache.compute_key(sync_dir))
+
     def mark_override_used(self, name):
         '''Marking overrides as used lets us print a warning when an override
         is unused.'''
@@ -177,7 +314,62 @@ def _get_parallel_fetch_limit(args):
         raise PrintableError('Argument to --jobs must be a number.')
 
 
+def _get_env_seconds(env, name):
+    value = env.get(name)
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise PrintableError('{} must be a number of seconds.', name)
+    if seconds <= 0:
+        raise PrintableError('{} must be greater than zero.', name)
+    return seconds
+
+
+def _get_retry_policy(env):
+    value = env.get('PERU_PLUGIN_RETRIES')
+    if not value:
+        return None
+    try:
+        retries = int(value)
+    except ValueError:
+        raise PrintableError('PERU_PLUGIN_RETRIES must be a number.')
+    if retries < 0:
+        raise PrintableError('PERU_PLUGIN_RETRIES must not be negative.')
+    if retries == 0:
+        return None
+    backoff = _get_env_seconds(env, 'PERU_PLUGIN_RETRY_BACKOFF')
+    exit_codes = None
+    if env.get('PERU_PLUGIN_RETRY_EXIT_CODES'):
+        try:
+            exit_codes = frozenset(
+                int(code)
+                for code in env['PERU_PLUGIN_RETRY_EXIT_CODES'].split(','))
+        except ValueError:
+            raise PrintableError('PERU_PLUGIN_RETRY_EXIT_CODES must be a '
+                                 'comma-separated list of numbers.')
+    output_pattern = None
+    if env.get('PERU_PLUGIN_RETRY_PATTERN'):
+        try:
+            output_pattern = re.compile(env['PERU_PLUGIN_RETRY_PATTERN'])
+        except re.error as e:
+            raise PrintableError('PERU_PLUGIN_RETRY_PATTERN is not a valid '
+                                 'regular expression: {}', e)
+    return plugin.RetryPolicy(
+        max_attempts=retries + 1,
+        backoff=1 if backoff is None else backoff,
+        exit_codes=exit_codes,
+        output_pattern=output_pattern)
+
+
 def get_display(args):
+    progress = args.get('--progress') or 'text'
+    if progress not in ('text', 'json'):
+        raise CommandLineError(
+            'Unknown --progress format "{}". Use "text" or "json".', progress)
+    if progress == 'json':
+        return display.JsonDisplay()
     if args['--quiet']:
         return display.QuietDisplay()
     elif args['--verbose']:
@@ -0,0 +1,155 @@
+'''Optional timing instrumentation. With `peru --trace-file=<file>`, the
+interesting phases of a run (parsing, cache keys and keyval lookups, plugin
+jobs, imports, rules, merges and the export) are recorded as spans and written
+out in the Chrome trace event format, which you can open in Perfetto
+(https://ui.perfetto.dev) or chrome://tracing.
+
+Instrumented code just wraps each phase in `with trace.span(name, **args):`.
+When tracing is off, that returns a shared no-op object, so it costs almost
+nothing.
+
+Many asyncio tasks run at once, and the trace format requires the spans on any
+one "thread" to nest properly. So each task that has a span open gets a lane
+of its own, and gives the lane back when its outermost span closes. Spans
+opened outside of any task share lane 0.'''
+
+import asyncio
+import heapq
+import json
+import os
+import time
+
+_tracer = None
+
+
+def start():
+    '''Start recording spans, and return the Tracer that collects them.'''
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop():
+    '''Stop recording, and return the Tracer that was active, if any.'''
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    return tracer
+
+
+def span(name, **args):
+    if _tracer is None:
+        return _NULL_SPAN
+    return _Span(_tracer, name, args)
+
+
+class Tracer:
+    def __init__(self):
+        self.events = []
+        self._start_time = time.perf_counter()
+        self._pid = os.getpid()
+        # task -> [lane, depth]
+        self._task_lanes = {}
+        self._free_lanes = []
+        self._next_lane = 1
+
+    def now(self):
+        '''Microseconds since the tracer started.'''
+        return (time.perf_counter() - self._start_time) * 1e6
+
+    def write(self, path):
+        metadata = [{
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': self._pid,
+            'tid': 0,
+            'args': {'name': 'peru'},
+        }]
+        with open(path, 'w') as f:
+            json.dump({
+                'traceEvents': metadata + self.events,
+                'displayTimeUnit': 'ms',
+            }, f)
+
+    def _enter_lane(self):
+        task = _current_task()
+        if task is None:
+            return 0
+        entry = self._task_lanes.get(task)
+        if entry is None:
+            if self._free_lanes:
+                lane = heapq.heappop(self._free_lanes)
+            else:
+                lane = self._next_lane
+                self._next_lane += 1
+            entry = self._task_lanes[task] = [lane, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _exit_lane(self):
+        task = _current_task()
+        if task is None:
+            return
+        entry = self._task_lanes[task]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._task_lanes[task]
+            heapq.heappush(self._free_lanes, entry[0])
+
+
+class _Span:
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._lane = self._tracer._enter_lane()
+        self._start = self._tracer.now()
+        return self
+
+    def set(self, **args):
+        '''Add args to the span after it's started, like the result of a
+        lookup.'''
+        self._args.update(args)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = self._tracer.now()
+        if exc_type is not None:
+            self._args['error'] = exc_type.__name__
+        self._tracer.events.append({
+            'name': self._name,
+            'cat': 'peru',
+            'ph': 'X',
+            'ts': self._start,
+            'dur': end - self._start,
+            'pid': self._tracer._pid,
+            'tid': self._lane,
+            'args': self._args,
+        })
+        self._tracer._exit_lane()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def set(self, **args):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _current_task():
+    try:
+        # Python 3.7+
+        return asyncio.current_task()
+    except AttributeError:
+        return asyncio.Task.current_task()
+    except RuntimeError:
+        # No event loop is running.
+        return None
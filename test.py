@@ -60,7 +60,7 @@ def main():
 
     # Run the linter.
     try:
-        subprocess.check_call(['flake8', 'peru', 'tests', '--exclude=peru/docopt'], cwd=REPO_ROOT)
+        subprocess.check_call(['flake8', 'peru', 'tests', 'benchmarks', '--exclude=peru/docopt'], cwd=REPO_ROOT)
     except FileNotFoundError:
         print('ERROR: flake8 not found', file=sys.stderr)
         sys.exit(1)
@@ -2,7 +2,7 @@ import asyncio
 from asyncio.subprocess import PIPE
 import sys
 
-from peru.async_helpers import safe_communicate
+from peru.async_helpers import OutputCapture, safe_communicate
 from shared import PeruTest, make_synchronous
 
 
@@ -31,3 +31,16 @@ class AsyncTest(PeruTest):
             *true_command, stdin=PIPE, stdout=PIPE)
         stdout, _ = await safe_communicate(proc_true)
         self.assertEqual(stdout, b"")
+
+    def test_output_capture(self):
+        capture = OutputCapture(limit=10)
+        capture.write('abc')
+        self.assertEqual('abc', capture.getvalue())
+        for i in range(100):
+            capture.write('{}\n'.format(i))
+        self.assertEqual('[283 earlier characters of output omitted]\n'
+                         '\n97\n98\n99\n', capture.getvalue())
+        # A single write bigger than the limit gets trimmed too.
+        capture.write('x' * 100)
+        self.assertEqual('[383 earlier characters of output omitted]\n' +
+                         'x' * 10, capture.getvalue())
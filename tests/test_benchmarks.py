@@ -0,0 +1,38 @@
+import io
+import json
+import os
+from contextlib import redirect_stderr, redirect_stdout
+
+from benchmarks import projects, runner
+from peru import parser
+
+import shared
+
+
+class BenchmarksTest(shared.PeruTest):
+    def test_projects_parse(self):
+        for project_class in projects.PROJECTS:
+            project = project_class(shared.create_dir(), 2, 3, 1)
+            project.generate()
+            peru_file = os.path.join(project.root, 'peru.yaml')
+            scope, imports = parser.parse_file(peru_file)
+            self.assertIn('mod1', scope.modules, project.name)
+            project.change_one_module()
+            parser.parse_file(peru_file)
+
+    def test_runner(self):
+        output = os.path.join(shared.create_dir(), 'results.json')
+        with redirect_stderr(io.StringIO()), redirect_stdout(io.StringIO()):
+            ret = runner.main([
+                '--projects=empty', '--modules=2', '--repeat=1',
+                '--output=' + output
+            ])
+        self.assertEqual(0, ret)
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(
+            ['cold sync', 'no-op sync', 'single change', 'copy'],
+            [result['scenario'] for result in report['results']])
+        no_op = report['results'][1]
+        self.assertEqual(1, no_op['git_commands'])
+        self.assertGreater(no_op['best_wall_seconds'], 0)
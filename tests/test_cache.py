@@ -1,8 +1,10 @@
 import os
+import shutil
 import time
 import unittest
 
 import peru.cache
+import peru.fsmonitor
 from shared import assert_contents, create_dir, make_synchronous, PeruTest, \
     COLON
 
@@ -439,6 +441,148 @@ class CacheTest(PeruTest):
             previous_tree=self.content_tree,
             previous_index_file=index_file)
 
+    @make_synchronous
+    async def test_incremental_export(self):
+        export_dir = create_dir()
+        index_file = os.path.join(create_dir(), 'test_index_file')
+        await self.cache.export_tree(
+            self.content_tree, export_dir, previous_index_file=index_file)
+        new_content = {
+            'a': 'foo',
+            'b/c': 'bar',
+            'b/d': 'changed',
+            'e/f': 'new',
+        }
+        new_tree = await self.cache.import_tree(create_dir(new_content))
+        # Touching a changed file isn't the same as modifying it.
+        t = time.time() + 60
+        os.utime(os.path.join(export_dir, 'b/d'), (t, t))
+        # A file outside of the change is left alone, even if it's dirty.
+        with open(os.path.join(export_dir, 'a'), 'w') as f:
+            f.write('dirty')
+        await self.cache.export_tree(
+            new_tree,
+            export_dir,
+            previous_tree=self.content_tree,
+            previous_index_file=index_file)
+        assert_contents(export_dir, dict(new_content, a='dirty'))
+        # But a dirty file inside the change is still an error.
+        with open(os.path.join(export_dir, 'b/d'), 'w') as f:
+            f.write('dirty')
+        with self.assertRaises(peru.cache.DirtyWorkingCopyError):
+            await self.cache.export_tree(
+                self.content_tree,
+                export_dir,
+                previous_tree=new_tree,
+                previous_index_file=index_file)
+        # The error deleted the index, and the full slow path recreates it.
+        self.assertFalse(os.path.exists(index_file))
+        await self.cache.export_tree(
+            self.content_tree,
+            export_dir,
+            previous_tree=new_tree,
+            force=True,
+            previous_index_file=index_file)
+        assert_contents(export_dir, self.content)
+
+    @make_synchronous
+    async def test_saved_index_format(self):
+        def index_version(path):
+            with open(path, 'rb') as f:
+                header = f.read(8)
+            self.assertEqual(b'DIRC', header[:4])
+            return int.from_bytes(header[4:], 'big')
+
+        for split_index in (False, True):
+            cache = await peru.cache.Cache(create_dir(), split_index)
+            tree = await cache.import_tree(self.content_dir)
+            export_dir = create_dir()
+            index_file = os.path.join(create_dir(), 'index')
+            await cache.export_tree(
+                tree, export_dir, previous_index_file=index_file)
+            self.assertEqual(4, index_version(index_file))
+            shared_files = [
+                f for f in os.listdir(cache.trees_path)
+                if f.startswith('sharedindex')
+            ]
+            self.assertEqual(split_index, bool(shared_files))
+            # An unreadable index gets rebuilt rather than causing an error.
+            # Losing the shared part of a split index is one way that happens.
+            if split_index:
+                for f in shared_files:
+                    os.remove(os.path.join(cache.trees_path, f))
+            else:
+                with open(index_file, 'wb') as f:
+                    f.write(b'junk')
+            os.remove(os.path.join(export_dir, 'a'))
+            await cache.export_tree(
+                tree,
+                export_dir,
+                previous_tree=tree,
+                previous_index_file=index_file)
+            assert_contents(export_dir, self.content)
+            self.assertEqual(4, index_version(index_file))
+            # With a good index, modified files are still caught, and --force
+            # still puts them back.
+            with open(os.path.join(export_dir, 'b', 'c'), 'w') as f:
+                f.write('dirty')
+            with self.assertRaises(peru.cache.DirtyWorkingCopyError):
+                await cache.export_tree(
+                    tree,
+                    export_dir,
+                    previous_tree=tree,
+                    previous_index_file=index_file)
+            await cache.export_tree(
+                tree,
+                export_dir,
+                previous_tree=tree,
+                force=True,
+                previous_index_file=index_file)
+            assert_contents(export_dir, self.content)
+
+    @unittest.skipUnless(peru.fsmonitor.is_supported(), 'needs inotify')
+    @make_synchronous
+    async def test_export_with_fsmonitor(self):
+        export_dir = create_dir()
+        state_dir = create_dir()
+        index_file = os.path.join(state_dir, 'index')
+        fsmonitor = peru.fsmonitor.FSMonitor(export_dir, state_dir)
+        self.addCleanup(fsmonitor.stop)
+
+        async def export(tree=self.content_tree,
+                         previous_tree=self.content_tree):
+            await self.cache.export_tree(
+                tree,
+                export_dir,
+                previous_tree,
+                previous_index_file=index_file,
+                fsmonitor=fsmonitor)
+
+        # The first export starts the watcher. Wait for it to come up.
+        await export(previous_tree=None)
+        for _ in range(100):
+            token, _ = fsmonitor.get_changes()
+            if token:
+                break
+            time.sleep(0.05)
+        self.assertIsNotNone(token)
+        # Once a clean export has saved a token, a no-op export doesn't need
+        # to run git at all.
+        await export()
+        count = peru.cache.DEBUG_GIT_COMMAND_COUNT
+        await export()
+        self.assertEqual(count, peru.cache.DEBUG_GIT_COMMAND_COUNT)
+        # Modified files are still caught, and deleted files are restored.
+        with open(os.path.join(export_dir, 'b', 'c'), 'w') as f:
+            f.write('dirty')
+        with self.assertRaises(peru.cache.DirtyWorkingCopyError):
+            await export()
+        os.remove(os.path.join(export_dir, 'b', 'c'))
+        await export()
+        assert_contents(export_dir, self.content)
+        await export()
+        assert_contents(export_dir, self.content)
+
     @make_synchronous
     async def test_import_ignores_dotperu(self):
         # We have a security problem similar to git's if we allow '.peru'
@@ -471,3 +615,109 @@ class CacheTest(PeruTest):
         # Check that every capitalization actually spells ".peru".
         for capitalization in peru.cache.DOTPERU_CAPITALIZATIONS:
             self.assertEqual(capitalization.lower(), ".peru")
+
+    @make_synchronous
+    async def test_git_profiler(self):
+        profiler = peru.cache.GitProfiler()
+        peru.cache.GIT_PROFILER = profiler
+        try:
+            await self.cache.read_file(self.content_tree, 'a')
+            await self.cache.export_tree(self.content_tree, create_dir())
+        finally:
+            peru.cache.GIT_PROFILER = None
+        summary = profiler.summary()
+        self.assertEqual({'read_file/get_info_for_path': 1},
+                         summary['ls-tree']['sites'])
+        self.assertEqual({'read_file/read_bytes_from_file_hash': 1},
+                         summary['cat-file']['sites'])
+        # cat-file writes the three bytes of 'foo'.
+        self.assertEqual(3, summary['cat-file']['bytes_out'])
+        self.assertIn('export_tree/checkout_files_from_index',
+                      summary['checkout-index']['sites'])
+        for stats in summary.values():
+            self.assertEqual(stats['count'], sum(stats['sites'].values()))
+            self.assertLessEqual(stats['p50'], stats['p90'])
+            self.assertLessEqual(stats['p99'], stats['max'])
+        self.assertIn('checkout-index', profiler.format_summary())
+
+    @make_synchronous
+    async def test_git_profiler_incremental_export(self):
+        export_dir = create_dir()
+        index_file = os.path.join(create_dir(), 'test_index_file')
+        await self.cache.export_tree(
+            self.content_tree, export_dir, previous_index_file=index_file)
+        new_tree = await self.cache.modify_tree(self.content_tree, {'a': None})
+        profiler = peru.cache.GitProfiler()
+        peru.cache.GIT_PROFILER = profiler
+        try:
+            await self.cache.export_tree(
+                new_tree,
+                export_dir,
+                previous_tree=self.content_tree,
+                previous_index_file=index_file)
+        finally:
+            peru.cache.GIT_PROFILER = None
+        # Options that go before the subcommand aren't mistaken for it.
+        summary = profiler.summary()
+        self.assertIn('diff-files', summary)
+        self.assertIn('add', summary)
+        self.assertNotIn('--literal-pathspecs', summary)
+
+    @make_synchronous
+    async def test_lower_roots(self):
+        self.cache.keyval['key'] = self.content_tree
+        lower_objects = os.path.join(self.cache.root, 'trees', 'objects')
+        lower_files = sorted(
+            os.path.join(dir, name) for dir, _, names in os.walk(lower_objects)
+            for name in names)
+        top_root = create_dir()
+        top = await peru.cache.Cache(top_root, lower_roots=[self.cache.root])
+        # The lower layer's keyval entries and trees are visible in the top.
+        self.assertEqual(self.content_tree, top.keyval['key'])
+        export_dir = create_dir()
+        await top.export_tree(self.content_tree, export_dir)
+        assert_contents(export_dir, self.content)
+        # New objects only go in the top.
+        new_tree = await top.modify_tree(self.content_tree, {'a': None})
+        top.keyval['key'] = new_tree
+        self.assertEqual(self.content_tree, self.cache.keyval['key'])
+        self.assertEqual(
+            lower_files,
+            sorted(
+                os.path.join(dir, name)
+                for dir, _, names in os.walk(lower_objects)
+                for name in names))
+        # Dropping the layer copies everything the top borrowed from it.
+        top = await peru.cache.Cache(top_root)
+        export_dir = create_dir()
+        await top.export_tree(self.content_tree, export_dir)
+        assert_contents(export_dir, self.content)
+
+    @make_synchronous
+    async def test_missing_lower_root(self):
+        lower_root = create_dir()
+        lower = await peru.cache.Cache(lower_root)
+        lower_tree = await lower.import_tree(create_dir({'x': 'x'}))
+        unused_root = create_dir()
+        await peru.cache.Cache(unused_root)
+        top_root = create_dir()
+        top = await peru.cache.Cache(
+            top_root, lower_roots=[lower_root, unused_root])
+        # The top's new tree is made of the lower layer's objects.
+        top.keyval['key'] = await top.merge_trees(
+            await top.get_empty_tree(), lower_tree, 'y')
+        # A layer that the top never borrowed from can just disappear.
+        shutil.rmtree(unused_root)
+        await peru.cache.Cache(top_root, lower_roots=[lower_root])
+        # But one that it did can't, and the check happens every time until
+        # the layer is back.
+        lower_moved = create_dir()
+        os.rename(lower_root, os.path.join(lower_moved, 'cache'))
+        for _ in range(2):
+            with self.assertRaises(peru.cache.CacheLayerError):
+                await peru.cache.Cache(top_root)
+        os.rename(os.path.join(lower_moved, 'cache'), lower_root)
+        top = await peru.cache.Cache(top_root)
+        export_dir = create_dir()
+        await top.export_tree(top.keyval['key'], export_dir)
+        assert_contents(export_dir, {'y/x': 'x'})
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tarfile
+import textwrap
+
+import peru.error
+
+import shared
+from shared import run_peru_command, assert_contents
+
+
+class CacheBundleTest(shared.PeruTest):
+    def setUp(self):
+        self.module_dir = shared.create_dir({'a/b': 'b', 'c': 'c'})
+        self.leaf_dir = shared.create_dir({'leaf': 'leaf'})
+        # A recursive module, to bring in a peru file and a nested module.
+        self.recursive_dir = shared.create_dir({
+            'peru.yaml':
+            textwrap.dedent('''\
+                cp module leaf:
+                    path: {}
+
+                imports:
+                    leaf: ./
+                ''').format(self.leaf_dir)
+        })
+        self.peru_yaml = textwrap.dedent('''\
+            cp module foo:
+                path: {}
+
+            cp module bar:
+                path: {}
+                recursive: true
+
+            rule sub:
+                export: a
+
+            imports:
+                foo: foo/
+                foo|sub: sub/
+                bar: bar/
+            ''').format(self.module_dir, self.recursive_dir)
+        self.bundle = os.path.join(shared.create_dir(), 'bundle.tar.gz')
+
+    def make_project(self):
+        return shared.create_dir({'peru.yaml': self.peru_yaml})
+
+    def assert_synced(self, project_dir):
+        assert_contents(
+            project_dir, {
+                'foo/a/b': 'b',
+                'foo/c': 'c',
+                'sub/b': 'b',
+                'bar/leaf': 'leaf',
+            },
+            excludes=['.peru', 'peru.yaml', 'bar/peru.yaml'])
+
+    def test_export_and_import(self):
+        first = self.make_project()
+        run_peru_command(['cache', 'export', self.bundle], first)
+        # Export doesn't sync.
+        self.assertEqual(['.peru', 'peru.yaml'], sorted(os.listdir(first)))
+        # Without the module sources, the only way to sync is from the
+        # bundle.
+        for path in (self.module_dir, self.leaf_dir, self.recursive_dir):
+            shutil.rmtree(path)
+        second = self.make_project()
+        run_peru_command(['cache', 'import', self.bundle], second)
+        output = run_peru_command(['sync', '-v'], second)
+        # Everything is a cache hit.
+        self.assertRegex(output,
+                         r'modules (\d+)/\1, rules 1/1, merges (\d+)/\2,')
+        self.assert_synced(second)
+        # Importing again is harmless.
+        run_peru_command(['cache', 'import', self.bundle], second)
+
+    def test_plugin_caches(self):
+        shared.GitRepo(self.module_dir)
+        self.peru_yaml = textwrap.dedent('''\
+            git module foo:
+                url: {}
+
+            imports:
+                foo: ./
+            ''').format(self.module_dir)
+        first = self.make_project()
+        run_peru_command(
+            ['cache', 'export', '--plugin-caches', self.bundle], first)
+        with tarfile.open(self.bundle) as bundle:
+            names = bundle.getnames()
+        self.assertTrue(any(name.startswith('plugins/git/') for name in names))
+        second = self.make_project()
+        run_peru_command(['cache', 'import', self.bundle], second)
+        first_plugins = os.path.join(first, '.peru', 'cache', 'plugins')
+        second_plugins = os.path.join(second, '.peru', 'cache', 'plugins')
+        self.assertEqual(
+            shared.read_dir(first_plugins), shared.read_dir(second_plugins))
+
+    def test_bad_bundle(self):
+        with open(self.bundle, 'w') as f:
+            f.write('junk')
+        with self.assertRaises(peru.error.PrintableError):
+            run_peru_command(['cache', 'import', self.bundle],
+                             self.make_project())
+
+    def test_bundle_missing_trees(self):
+        run_peru_command(['cache', 'export', self.bundle], self.make_project())
+        # Rebuild the bundle without its pack.
+        manifest_path = os.path.join(shared.create_dir(), 'peru-cache.json')
+        with tarfile.open(self.bundle) as bundle:
+            with bundle.extractfile('peru-cache.json') as src, \
+                    open(manifest_path, 'wb') as dest:
+                shutil.copyfileobj(src, dest)
+        with tarfile.open(self.bundle, 'w:gz') as bundle:
+            bundle.add(manifest_path, 'peru-cache.json')
+        second = self.make_project()
+        with self.assertRaises(peru.error.PrintableError):
+            run_peru_command(['cache', 'import', self.bundle], second)
+        # None of its entries were added.
+        self.assertEqual(
+            [], os.listdir(os.path.join(second, '.peru', 'cache', 'keyval')))
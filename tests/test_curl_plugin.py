@@ -2,6 +2,7 @@ import hashlib
 import importlib.util
 import io
 from os.path import abspath, join, dirname
+import tarfile
 import urllib
 
 import peru
@@ -80,6 +81,42 @@ class CurlPluginTest(shared.PeruTest):
         self.assertEqual(content, output_file.getvalue())
         self.assertEqual(hashlib.sha1(content).hexdigest(), sha1)
 
+    def test_extract_tar_stream(self):
+        content = {'a': 'foo', 'b/c': 'bar'}
+        content_dir = shared.create_dir(content)
+        for mode in 'w', 'w:gz', 'w:bz2', 'w:xz':
+            archive = io.BytesIO()
+            with tarfile.open(fileobj=archive, mode=mode) as t:
+                t.add(content_dir, arcname='.')
+            archive_bytes = archive.getvalue()
+            request = MockRequest('some url',
+                                  {'Content-Length': len(archive_bytes)},
+                                  archive_bytes)
+            reader = curl_plugin.HashingReader(request, io.StringIO())
+            dest = shared.create_dir()
+            curl_plugin.extract_tar_stream(reader, dest)
+            reader.drain()
+            shared.assert_contents(dest, content)
+            # The digest has to cover the whole download, including anything
+            # after the end-of-archive marker that tarfile didn't need.
+            self.assertEqual(
+                hashlib.sha1(archive_bytes).hexdigest(), reader.hexdigest())
+
+    def test_evil_tar_stream_rolls_back(self):
+        dest = shared.create_dir({'preexisting': 'stuff'})
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as t:
+            good = tarfile.TarInfo('good')
+            t.addfile(good, io.BytesIO(b''))
+            evil = tarfile.TarInfo('../evil')
+            t.addfile(evil, io.BytesIO(b''))
+        archive_path = shared.tmp_file()
+        with open(archive_path, 'wb') as f:
+            f.write(archive.getvalue())
+        with self.assertRaises(curl_plugin.EvilArchiveError):
+            curl_plugin.extract_tar(archive_path, dest)
+        shared.assert_contents(dest, {'preexisting': 'stuff'})
+
     def test_unpack_windows_zip(self):
         '''This zip was packed on Windows, so it doesn't include any file
         permissions. This checks that our executable-flag-restoring code
@@ -1,4 +1,5 @@
 import io
+import json
 import re
 import textwrap
 
@@ -105,6 +106,80 @@ class DisplayTest(shared.PeruTest):
         self.assertEqual(expected7, output.getlines())
         self.assertEqual(None, disp._draw_later_handle)
 
+    def test_fancy_display_redraws_only_changes(self):
+        output = FakeTerminal()
+        disp = display.FancyDisplay(output)
+        handles = [disp.get_handle('title{}'.format(i)) for i in range(3)]
+        for handle in handles:
+            handle.__enter__()
+            handle.write('start')
+        disp._draw()
+        output.writes.clear()
+
+        # Chatty progress output only keeps the last line, and a redraw only
+        # touches the line that changed, in one write.
+        handles[1].write('10%\r20%\r30%\n\n  \r')
+        disp._draw()
+        self.assertEqual(1, len(output.writes))
+        self.assertNotIn('title0', output.writes[0])
+        self.assertNotIn('title2', output.writes[0])
+        self.assertNotIn('20%', output.writes[0])
+        expected = textwrap.dedent('''\
+            ┌ title0: start 
+            ├ title1: 30% 
+            └ title2: start 
+            ''')  # noqa: W291
+        self.assertEqual(expected, output.getlines())
+
+        # Nothing changed, so nothing is written.
+        disp._draw()
+        self.assertEqual(1, len(output.writes))
+
+        for handle in handles:
+            handle.__exit__(None, None, None)
+        self.assertEqual('', output.getlines())
+
+    def test_json_display(self):
+        output = io.StringIO()
+        wrapped_output = io.StringIO()
+        disp = display.JsonDisplay(
+            output, wrapped=display.VerboseDisplay(wrapped_output))
+        disp.event('started', command='sync')
+        with disp.get_handle('title') as handle:
+            handle.write('in job\n')
+            handle.report(type='git', queue_wait=0.5)
+        disp.print('print stuff')
+        events = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(
+            ['started', 'job_started', 'job_finished', 'message'],
+            [event['event'] for event in events])
+        self.assertEqual('sync', events[0]['command'])
+        self.assertEqual('title', events[1]['module'])
+        finished = events[2]
+        self.assertEqual(('title', 'git', 0.5),
+                         (finished['module'], finished['type'],
+                          finished['queue_wait']))
+        self.assertGreaterEqual(finished['duration'], 0)
+        self.assertEqual('print stuff\n', events[3]['text'])
+        # Job output doesn't go in the JSON, but the wrapped display gets
+        # everything as usual.
+        self.assertNotIn('in job', output.getvalue())
+        expected = textwrap.dedent('''\
+            === started title ===
+            === finished title ===
+            in job
+            ===
+            print stuff
+            ''')
+        self.assertEqual(expected, wrapped_output.getvalue())
+
+    def test_last_nonempty_line(self):
+        self.assertEqual('c', display._last_nonempty_line('a\nb\rc'))
+        self.assertEqual('b', display._last_nonempty_line('a\nb \r\n  \n'))
+        self.assertEqual('a', display._last_nonempty_line('a'))
+        self.assertEqual(None, display._last_nonempty_line('\r\n \n'))
+        self.assertEqual(None, display._last_nonempty_line(''))
+
 
 class FakeTerminal:
     '''Emulates a terminal by keeping track of a list of lines. Knows how to
@@ -113,11 +188,14 @@ class FakeTerminal:
     def __init__(self):
         self.lines = [io.StringIO()]
         self.cursor_line = 0
+        # Every string passed to write(), for checking how output is batched.
+        self.writes = []
         # Flush doesn't actually do anything in fake terminal, but we want to
         # make sure it gets called before any lines are read.
         self.flushed = False
 
     def write(self, string):
+        self.writes.append(string)
         tokens = [
             display.ANSI_DISABLE_LINE_WRAP, display.ANSI_ENABLE_LINE_WRAP,
             display.ANSI_CLEAR_LINE, display.ANSI_CURSOR_UP_ONE_LINE, '\n'
@@ -1,4 +1,6 @@
+import os
 from textwrap import dedent
+import unittest
 
 import yaml
 
@@ -74,3 +76,66 @@ class EditYamlTest(shared.PeruTest):
         with open(tmp_name) as f:
             new_yaml = f.read()
         self.assertEqual(yaml_template.format("bar"), new_yaml)
+
+    def test_batch(self):
+        start_yaml = dedent("""\
+            a:
+              b: foo
+            c:
+              d: |
+                multi
+                line
+
+            e:
+              f: 1
+              g: 2""")
+        end_yaml = dedent("""\
+            a:
+              b: bar
+              x: "5"
+            c:
+              d: |
+                multi
+                line
+              x: new
+              y: newer
+
+            e:
+              f: 1
+              g: "3"
+              x: last""")
+        edited_yaml = edit_yaml.set_module_fields(start_yaml, [
+            ('c', 'x', 'new'),
+            ('e', 'x', 'last'),
+            ('a', 'b', 'bar'),
+            ('c', 'y', 'newer'),
+            ('a', 'x', '5'),
+            ('e', 'g', '3'),
+        ])
+        self.assertEqual(end_yaml, edited_yaml)
+
+    def test_batch_with_file(self):
+        tmp_name = shared.tmp_file()
+        start_yaml = yaml_template.format("foo")
+        with open(tmp_name, "w") as f:
+            f.write(start_yaml)
+        edit_yaml.set_module_fields_in_file(tmp_name, [("a", "c", "bar"),
+                                                       ("a", "e", "baz")])
+        with open(tmp_name) as f:
+            new_yaml = f.read()
+        self.assertEqual(
+            yaml_template.format("bar").replace("d:", "  e: baz\nd:"),
+            new_yaml)
+
+    @unittest.skipIf(os.name == 'nt', 'symlinks need privileges on Windows')
+    def test_with_symlinked_file(self):
+        tmp_name = shared.tmp_file()
+        with open(tmp_name, "w") as f:
+            f.write(yaml_template.format("foo"))
+        link_name = os.path.join(shared.create_dir(), 'peru.yaml')
+        os.symlink(tmp_name, link_name)
+        edit_yaml.set_module_fields_in_file(link_name, [("a", "c", "bar")])
+        # The link is still a link, and its target has the edit.
+        self.assertEqual(tmp_name, os.readlink(link_name))
+        with open(tmp_name) as f:
+            self.assertEqual(yaml_template.format("bar"), f.read())
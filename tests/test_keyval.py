@@ -29,3 +29,24 @@ class KeyValTest(shared.PeruTest):
         del keyval[key]
         self.assertFalse(key in keyval)
         self.assertFalse(key in another_keyval)
+
+    def test_lower_roots(self):
+        lower = KeyVal(shared.create_dir(), shared.create_dir())
+        lower['a'] = 'lower a'
+        lower['b'] = 'lower b'
+        keyval = KeyVal(
+            shared.create_dir(), shared.create_dir(),
+            lower_roots=[shared.create_dir(), lower._root])
+        self.assertTrue('a' in keyval)
+        self.assertEqual('lower a', keyval['a'])
+        # Writes only go to the top, and shadow the lower layers.
+        keyval['a'] = 'top a'
+        keyval['c'] = 'top c'
+        self.assertEqual('top a', keyval['a'])
+        self.assertEqual('lower a', lower['a'])
+        self.assertFalse('c' in lower)
+        self.assertSetEqual({'a', 'b', 'c'}, set(keyval))
+        self.assertEqual(3, len(keyval))
+        # Deleting from the top uncovers the lower value.
+        del keyval['a']
+        self.assertEqual('lower a', keyval['a'])
@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import textwrap
+
+from peru.async_helpers import raises_gathered
+import peru.error
+import peru.lockfile
+
+import shared
+from shared import run_peru_command, assert_contents
+
+
+class LockfileTest(shared.PeruTest):
+    def setUp(self):
+        self.module_dir = shared.create_dir({'a/b': 'b', 'c': 'c'})
+        self.project_dir = self.make_project()
+        self.cache_dir = os.path.join(self.project_dir, '.peru', 'cache')
+
+    def make_project(self):
+        return shared.create_dir({
+            'peru.yaml':
+            textwrap.dedent('''\
+                cp module foo:
+                    path: {}
+
+                rule sub:
+                    export: a
+
+                imports:
+                    foo|sub: ./
+                ''').format(self.module_dir)
+        })
+
+    def read_lock(self):
+        with open(os.path.join(self.project_dir, 'peru.lock')) as f:
+            return json.load(f)
+
+    def test_lock(self):
+        run_peru_command(['lock'], self.project_dir)
+        lock = self.read_lock()
+        self.assertEqual(1, lock['version'])
+        self.assertEqual(['foo'],
+                         [entry['name'] for entry in lock['modules'].values()])
+        self.assertEqual(['sub'],
+                         [entry['name'] for entry in lock['rules'].values()])
+        # Locking doesn't sync.
+        self.assertEqual(['.peru', 'peru.lock', 'peru.yaml'],
+                         sorted(os.listdir(self.project_dir)))
+
+    def test_locked_trees_skip_plugins(self):
+        run_peru_command(['lock'], self.project_dir)
+        # The trees are still in the cache's git objects, but the keyval
+        # entries that would point to them are gone, and so is the source.
+        shutil.rmtree(os.path.join(self.cache_dir, 'keyval'))
+        shutil.rmtree(self.module_dir)
+        output = run_peru_command(['sync', '-v'], self.project_dir)
+        self.assertIn('lock file 2/2', output)
+        assert_contents(self.project_dir, {'b': 'b'},
+                        excludes=['.peru', 'peru.yaml', 'peru.lock'])
+
+    def test_locked_trees_from_remote_packs(self):
+        remote_dir = shared.create_dir()
+        env = {'PERU_REMOTE_CACHE': remote_dir}
+        run_peru_command(['lock'], self.project_dir, env=env)
+        # Without keyval entries, the remote cache can still provide the
+        # locked trees by their hashes.
+        shutil.rmtree(os.path.join(remote_dir, 'keyval'))
+        shutil.rmtree(self.module_dir)
+        second = self.make_project()
+        shutil.copy(os.path.join(self.project_dir, 'peru.lock'), second)
+        output = run_peru_command(['sync', '-v'], second, env=env)
+        self.assertIn('lock file 2/2', output)
+        assert_contents(second, {'b': 'b'},
+                        excludes=['.peru', 'peru.yaml', 'peru.lock'])
+
+    def test_remote_entries_must_match_lock(self):
+        remote_dir = shared.create_dir()
+        env = {'PERU_REMOTE_CACHE': remote_dir}
+        run_peru_command(['lock'], self.project_dir, env=env)
+        [module_key] = self.read_lock()['modules']
+        [locked_tree] = [entry['tree']
+                         for entry in self.read_lock()['modules'].values()]
+        # Another project without a lock file changes what the remote cache
+        # has for the module, and the locked tree's pack goes away.
+        shared.write_files(self.module_dir, {'a/b': 'changed'})
+        unlocked = self.make_project()
+        run_peru_command(['sync', '--no-cache'], unlocked, env=env)
+        os.remove(
+            os.path.join(remote_dir, 'packs', locked_tree + '.pack'))
+        second = self.make_project()
+        shutil.copy(os.path.join(self.project_dir, 'peru.lock'), second)
+        with raises_gathered(peru.lockfile.LockMismatchError):
+            run_peru_command(['sync'], second, env=env)
+        # The remote entry that didn't match wasn't saved locally.
+        keyval_dir = os.path.join(second, '.peru', 'cache', 'keyval')
+        self.assertNotIn(module_key, os.listdir(keyval_dir))
+
+    def test_fetch_must_match_lock(self):
+        run_peru_command(['lock'], self.project_dir)
+        shared.write_files(self.module_dir, {'a/b': 'changed'})
+        # The cp module isn't pinned, so a normal sync stays on the locked
+        # tree.
+        run_peru_command(['sync'], self.project_dir)
+        assert_contents(self.project_dir, {'b': 'b'},
+                        excludes=['.peru', 'peru.yaml', 'peru.lock'])
+        # But fetching it again doesn't match.
+        with raises_gathered(peru.lockfile.LockMismatchError):
+            run_peru_command(['sync', '--no-cache'], self.project_dir)
+        # Until it's locked again.
+        run_peru_command(['lock', '--no-cache'], self.project_dir)
+        run_peru_command(['sync'], self.project_dir)
+        assert_contents(self.project_dir, {'b': 'changed'},
+                        excludes=['.peru', 'peru.yaml', 'peru.lock'])
+
+    def test_bad_lock_file(self):
+        with open(os.path.join(self.project_dir, 'peru.lock'), 'w') as f:
+            f.write('{"version": 1, "modules": {"junk": {}}}')
+        with self.assertRaises(peru.error.PrintableError):
+            run_peru_command(['sync'], self.project_dir)
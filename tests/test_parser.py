@@ -1,4 +1,6 @@
+import os
 from textwrap import dedent
+import time
 
 from peru import parser
 from peru.parser import parse_string, ParserError
@@ -214,3 +216,33 @@ class ParserTest(shared.PeruTest):
             ('a', 1, 8),
             ('a', 8, 9),
         ], duplicates)
+
+    def test_load_file_cache(self):
+        project = shared.create_dir({
+            'peru.yaml': 'imports:\n    foo: a/\n    foo: b/\n',
+        })
+        peru_file = os.path.join(project, 'peru.yaml')
+        cache_path = os.path.join(project, 'cache')
+        # A file modified just now isn't cached, because another edit could
+        # leave its mtime and size the same.
+        parser.load_file(peru_file, cache_path)
+        self.assertFalse(os.path.exists(cache_path))
+        old = time.time() - 60
+        os.utime(peru_file, (old, old))
+        expected = ({'imports': {'foo': 'b/'}}, [('foo', 2, 3)])
+        self.assertEqual(expected, parser.load_file(peru_file, cache_path))
+        self.assertTrue(os.path.exists(cache_path))
+        # Sneak in a change that keeps the same mtime and size, to show that
+        # the cache is what's being read.
+        shared.write_files(project, {
+            'peru.yaml': 'imports:\n    bar: a/\n    bar: b/\n',
+        })
+        os.utime(peru_file, (old, old))
+        self.assertEqual(expected, parser.load_file(peru_file, cache_path))
+        # Any real change to the stamp invalidates it.
+        os.utime(peru_file, (old + 1, old + 1))
+        self.assertEqual(({
+            'imports': {
+                'bar': 'b/'
+            }
+        }, [('bar', 2, 3)]), parser.load_file(peru_file, cache_path))
@@ -3,15 +3,20 @@ from collections import defaultdict
 import contextlib
 import hashlib
 import io
+import json
 import os
 from pathlib import Path
+import re
 import shutil
 import subprocess
 import sys
 import textwrap
 import unittest
 
+import peru.async_helpers as async_helpers
+import peru.cache
 from peru.async_helpers import run_task
+from peru.keyval import KeyVal
 import peru.plugin as plugin
 import shared
 from shared import SvnRepo, GitRepo, HgRepo, assert_contents
@@ -21,6 +26,9 @@ HG_MINIMUM_PYTHON_VERSION = (3, 6)
 
 
 class TestDisplayHandle(io.StringIO):
+    def report(self, **fields):
+        pass
+
     def __enter__(self):
         return self
 
@@ -45,6 +53,9 @@ class PluginsTest(shared.PeruTest):
         self.content = {"some": "stuff", "foo/bar": "baz"}
         self.content_dir = shared.create_dir(self.content)
         self.cache_root = shared.create_dir()
+        # Peru's loop has to exist before the locks below, or on older
+        # Pythons they'd bind to a different default loop.
+        async_helpers.get_event_loop()
         self.plugin_context = plugin.PluginContext(
             cwd='.',
             plugin_cache_root=self.cache_root,
@@ -168,6 +179,37 @@ class PluginsTest(shared.PeruTest):
             expected_content['.gitmodules'] = f.read()
         self.do_plugin_test('git', {'url': self.content_dir}, expected_content)
 
+    def test_plugin_cache_dir_stats(self):
+        GitRepo(self.content_dir)
+        stats = peru.cache.CacheStats()
+        self.plugin_context = self.plugin_context._replace(cache_stats=stats)
+        plugin_fields = {'url': self.content_dir}
+        self.do_plugin_test('git', plugin_fields, self.content)
+        self.do_plugin_test('git', plugin_fields, self.content)
+        # The second fetch reuses the first one's clone.
+        self.assertEqual({'hits': 1, 'misses': 1},
+                         stats.as_dict()['plugin cache dirs'])
+
+    def test_plugin_cache_dir_from_lower_layer(self):
+        GitRepo(self.content_dir)
+        plugin_fields = {'url': self.content_dir}
+        self.do_plugin_test('git', plugin_fields, self.content)
+        lower_root = self.cache_root
+        lower_contents = shared.read_dir(lower_root)
+        # A new cache on top gets a copy of the clone, instead of cloning.
+        stats = peru.cache.CacheStats()
+        self.cache_root = shared.create_dir()
+        self.plugin_context = self.plugin_context._replace(
+            plugin_cache_root=self.cache_root,
+            lower_plugin_cache_roots=[shared.create_dir(), lower_root],
+            cache_stats=stats)
+        output = self.do_plugin_test('git', plugin_fields, self.content)
+        self.assertEqual(0, output.count('git clone'))
+        self.assertEqual({'hits': 1, 'misses': 0},
+                         stats.as_dict()['plugin cache dirs'])
+        self.assertEqual(lower_contents, shared.read_dir(lower_root))
+        self.assertEqual(lower_contents, shared.read_dir(self.cache_root))
+
     def test_git_plugin_multiple_fetches(self):
         content_repo = GitRepo(self.content_dir)
         head = content_repo.run('git', 'rev-parse', 'HEAD')
@@ -316,6 +358,34 @@ class PluginsTest(shared.PeruTest):
                 os.path.join(fetch_dir, 'not_exe.txt'))
             shared.assert_executable(os.path.join(fetch_dir, 'exe.sh'))
 
+    def test_curl_plugin_fetch_tar_bad_checksum(self):
+        fields = {
+            'url': (shared.test_resources / 'with_exe.tar').as_uri(),
+            'unpack': 'tar',
+            'sha1': 'wrong hash',
+        }
+        fetch_dir = shared.create_dir()
+        with self.assertRaises(plugin.PluginRuntimeError):
+            self.do_plugin_test('curl', fields, {}, fetch_dir=fetch_dir)
+        # Files extracted before the checksum was known must be rolled back.
+        assert_contents(fetch_dir, {})
+
+    def test_curl_plugin_fetch_tar_not_an_archive(self):
+        page = shared.create_dir({'error.html': '<html>Not found</html>'})
+        fields = {
+            'url': Path(page, 'error.html').as_uri(),
+            'unpack': 'tar',
+        }
+        with self.assertRaises(plugin.PluginRuntimeError) as cm:
+            self.do_plugin_test('curl', fields, {})
+        self.assertIn('Not a tar archive', cm.exception.message)
+        self.assertNotIn('Traceback', cm.exception.message)
+        # With a sha1, the checksum explains it better.
+        fields['sha1'] = 'wrong hash'
+        with self.assertRaises(plugin.PluginRuntimeError) as cm:
+            self.do_plugin_test('curl', fields, {})
+        self.assertIn('Bad checksum!', cm.exception.message)
+
     def test_curl_plugin_fetch_evil_archive(self):
         # There are several evil archives checked in under tests/resources. The
         # others are checked directly as part of test_curl_plugin.py.
@@ -421,12 +491,274 @@ class PluginsTest(shared.PeruTest):
                                                  'footype', {})
             self.assertDictEqual({'name': 'val'}, output)
 
+    def test_plugin_registry_reloads_changed_definitions(self):
+        plugin_dir = os.path.join('peru', 'plugins', 'footype')
+        plugin_yaml_file = os.path.join(plugin_dir, 'plugin.yaml')
+        plugin_files = {
+            os.path.join(plugin_dir, 'fetch.py'): '',
+            plugin_yaml_file: 'sync exe: fetch.py\nrequired fields: []\n',
+        }
+        with fake_plugins(plugin_files) as fake_config_dir:
+            registry = plugin.PluginRegistry()
+            definition = registry.get_definition('footype')
+            self.assertIs(definition, registry.get_definition('footype'))
+            self.assertEqual(frozenset(), definition.fields)
+
+            full_yaml_path = os.path.join(fake_config_dir, plugin_yaml_file)
+            shared.write_files(fake_config_dir, {
+                plugin_yaml_file:
+                'sync exe: fetch.py\nrequired fields: [url]\n'
+            })
+            # Make sure the mtime moves even on coarse-grained filesystems.
+            mtime = os.stat(full_yaml_path).st_mtime + 10
+            os.utime(full_yaml_path, (mtime, mtime))
+            definition = registry.get_definition('footype')
+            self.assertEqual(frozenset(['url']), definition.fields)
+
+    def test_plugin_worker_reuse(self):
+        plugin_prefix = 'peru/plugins/workertype/'
+        worker_file = plugin_prefix + 'worker.py'
+        plugin_files = {
+            worker_file:
+            textwrap.dedent('''\
+                #! /usr/bin/env python3
+                import os
+                import subprocess
+                import sys
+
+                def main():
+                    print('pid', os.getpid())
+                    # Output from child processes has to come through too.
+                    subprocess.check_call([
+                        sys.executable, '-c', 'print("child output")'])
+                    if os.environ['PERU_MODULE_FAIL']:
+                        sys.exit(3)
+
+                if os.environ.get('PERU_PLUGIN_WORKER'):
+                    from peru import plugin_worker
+                    plugin_worker.serve(main)
+                else:
+                    main()
+                '''),
+            plugin_prefix + 'plugin.yaml':
+            textwrap.dedent('''\
+                sync exe: worker.py
+                worker exe: worker.py
+                required fields: []
+                optional fields: [fail]
+                ''')
+        }
+        pool = plugin.PluginWorkerPool()
+        context = self.plugin_context._replace(worker_pool=pool)
+        try:
+            with fake_plugins(plugin_files, [worker_file]):
+                output1 = test_plugin_fetch(context, 'workertype', {},
+                                            shared.create_dir())
+                output2 = test_plugin_fetch(context, 'workertype', {},
+                                            shared.create_dir())
+                with self.assertRaises(plugin.PluginRuntimeError) as cm:
+                    test_plugin_fetch(context, 'workertype',
+                                      {'fail': 'yes'}, shared.create_dir())
+        finally:
+            run_task(pool.close())
+        self.assertIn('child output\n', output1)
+        # Both jobs ran in the same process.
+        self.assertEqual(output1, output2)
+        self.assertIn(output1.strip(), cm.exception.message)
+
+    def test_plugin_timeout(self):
+        plugin_prefix = 'peru/plugins/sleeptype/'
+        plugin_files = {
+            plugin_prefix + 'sleep.py':
+            '#! /usr/bin/env python3\nimport time\ntime.sleep(60)\n',
+            plugin_prefix + 'plugin.yaml':
+            'sync exe: sleep.py\nrequired fields: []\n',
+        }
+        context = self.plugin_context._replace(job_timeout=0.5)
+        with fake_plugins(plugin_files, [plugin_prefix + 'sleep.py']):
+            with self.assertRaises(plugin.PluginTimeoutError):
+                test_plugin_fetch(context, 'sleeptype', {},
+                                  shared.create_dir())
+
+    def test_plugin_retry(self):
+        plugin_prefix = 'peru/plugins/flaky/'
+        plugin_files = {
+            plugin_prefix + 'flaky.py':
+            textwrap.dedent("""\
+                #! /usr/bin/env python3
+                import os
+                import sys
+                path = os.environ['PERU_MODULE_COUNTER']
+                with open(path, 'a') as f:
+                    f.write('x')
+                with open(path) as f:
+                    attempts = len(f.read())
+                print('attempt', attempts)
+                sys.exit(0 if attempts >= 3 else 42)
+                """),
+            plugin_prefix + 'plugin.yaml':
+            'sync exe: flaky.py\nrequired fields: [counter]\n',
+        }
+
+        def fetch(retry_policy, log_dir=None):
+            counter = os.path.join(shared.create_dir(), 'counter')
+            context = self.plugin_context._replace(
+                retry_policy=retry_policy, log_dir=log_dir)
+            with fake_plugins(plugin_files, [plugin_prefix + 'flaky.py']):
+                return test_plugin_fetch(context, 'flaky',
+                                         {'counter': counter},
+                                         shared.create_dir())
+
+        # Two retries are enough, and the display gets all three attempts.
+        log_dir = shared.create_dir()
+        output = fetch(
+            plugin.RetryPolicy(
+                max_attempts=3, backoff=0.01, exit_codes={42},
+                output_pattern=None),
+            log_dir=log_dir)
+        self.assertIn('attempt 3', output)
+        self.assertIn('attempt 2 of 3 failed', output)
+        # Each attempt gets its own log.
+        logs = {}
+        for log_name in os.listdir(log_dir):
+            with open(os.path.join(log_dir, log_name)) as f:
+                logs[log_name] = f.read()
+        self.assertEqual(['attempt 1\n', 'attempt 2\n', 'attempt 3\n'],
+                         sorted(logs.values()))
+        # One isn't, and the error says how many attempts were made.
+        with self.assertRaises(plugin.PluginRuntimeError) as cm:
+            fetch(
+                plugin.RetryPolicy(
+                    max_attempts=2, backoff=0.01, exit_codes=None,
+                    output_pattern=None))
+        self.assertEqual(2, cm.exception.attempts)
+        self.assertIn('after 2 attempts', cm.exception.message)
+        # Failures that don't match the policy aren't retried at all.
+        with self.assertRaises(plugin.PluginRuntimeError) as cm:
+            fetch(
+                plugin.RetryPolicy(
+                    max_attempts=3, backoff=0.01, exit_codes={1},
+                    output_pattern=re.compile('timed out')))
+        self.assertEqual(1, cm.exception.attempts)
+
+    def test_plugin_retry_starts_clean(self):
+        plugin_prefix = 'peru/plugins/messy/'
+        plugin_files = {
+            plugin_prefix + 'messy.py':
+            textwrap.dedent("""\
+                #! /usr/bin/env python3
+                import os
+                import sys
+                dest = os.environ['PERU_SYNC_DEST']
+                tmp = os.environ['PERU_PLUGIN_TMP']
+                if os.listdir(tmp):
+                    sys.exit('leftover tmp files')
+                with open(os.path.join(tmp, 'junk'), 'w') as f:
+                    f.write('junk')
+                counter = os.environ['PERU_MODULE_COUNTER']
+                if os.path.exists(counter):
+                    os.mkdir(os.path.join(dest, 'good'))
+                    sys.exit(0)
+                open(counter, 'w').close()
+                os.mkdir(os.path.join(dest, 'stray'))
+                with open(os.path.join(dest, 'stray', 'file'), 'w') as f:
+                    f.write('stray')
+                sys.exit(42)
+                """),
+            plugin_prefix + 'plugin.yaml':
+            'sync exe: messy.py\nrequired fields: [counter]\n',
+        }
+        retry_policy = plugin.RetryPolicy(
+            max_attempts=3, backoff=0.01, exit_codes={42},
+            output_pattern=None)
+        context = self.plugin_context._replace(retry_policy=retry_policy)
+        dest = shared.create_dir()
+        with fake_plugins(plugin_files, [plugin_prefix + 'messy.py']):
+            output = test_plugin_fetch(
+                context, 'messy',
+                {'counter': os.path.join(shared.create_dir(), 'counter')},
+                dest)
+        # The second attempt found an empty dest and tmp dir, and succeeded
+        # without the first attempt's stray file.
+        self.assertIn('attempt 1 of 3 failed', output)
+        self.assertNotIn('attempt 2 of 3 failed', output)
+        self.assertEqual(['good'], os.listdir(dest))
+
+    def test_plugin_output_is_bounded(self):
+        plugin_prefix = 'peru/plugins/noisy/'
+        plugin_files = {
+            plugin_prefix + 'noisy.py':
+            textwrap.dedent("""\
+                #! /usr/bin/env python3
+                import sys
+                for i in range(20000):
+                    print('progress line', i)
+                print('the real error')
+                sys.exit(1)
+                """),
+            plugin_prefix + 'plugin.yaml':
+            'sync exe: noisy.py\nrequired fields: []\n',
+        }
+        log_dir = shared.create_dir()
+        context = self.plugin_context._replace(log_dir=log_dir)
+        with fake_plugins(plugin_files, [plugin_prefix + 'noisy.py']):
+            with self.assertRaises(plugin.PluginRuntimeError) as cm:
+                test_plugin_fetch(context, 'noisy', {}, shared.create_dir())
+        # The error only has the end of the output, and says where the rest
+        # of it went.
+        message = cm.exception.message
+        self.assertLess(len(message), 2 * async_helpers.OUTPUT_CAPTURE_LIMIT)
+        self.assertTrue(message.endswith('the real error'))
+        self.assertNotIn('progress line 0\n', message)
+        [log_name] = os.listdir(log_dir)
+        self.assertIn(os.path.join(log_dir, log_name), message)
+        with open(os.path.join(log_dir, log_name)) as f:
+            log = f.read()
+        self.assertTrue(log.startswith('progress line 0\n'))
+        self.assertTrue(log.endswith('the real error\n'))
+
+    def test_failure_cache(self):
+        keyval = KeyVal(shared.create_dir(), shared.create_dir())
+        failure_cache = plugin.FailureCache(keyval, ttl=60)
+        context = self.plugin_context._replace(failure_cache=failure_cache)
+        module_dir = os.path.join(shared.create_dir(), 'notyet')
+        fields = {'path': module_dir}
+        # The first failure actually runs the plugin.
+        with self.assertRaises(plugin.PluginRuntimeError):
+            test_plugin_fetch(context, 'cp', fields, shared.create_dir())
+        # The cp plugin would succeed now, but the cached failure
+        # short-circuits it.
+        shared.write_files(module_dir, {'foo': 'bar'})
+        with self.assertRaises(plugin.PluginRecentFailureError):
+            test_plugin_fetch(context, 'cp', fields, shared.create_dir())
+        # Other modules of the same type aren't affected.
+        test_plugin_fetch(context, 'cp', {'path': shared.create_dir()},
+                          shared.create_dir())
+        # Expired entries are ignored, and success clears them.
+        for key in keyval:
+            keyval[key] = json.dumps({'time': 0, 'message': 'old'})
+        test_plugin_fetch(context, 'cp', fields, shared.create_dir())
+        self.assertEqual([], list(keyval))
+
     def test_no_such_plugin(self):
         with self.assertRaises(plugin.PluginCandidateError):
             test_plugin_fetch(self.plugin_context, 'nosuchtype!', {},
                               os.devnull)
 
 
+@contextlib.contextmanager
+def fake_plugins(files, executables=()):
+    '''Create a fake config dir with the given plugin files, and point peru
+    at it for user-defined plugins while the context is active.'''
+    fake_config_dir = shared.create_dir(files)
+    for path in executables:
+        os.chmod(os.path.join(fake_config_dir, path), 0o755)
+    config_path_variable = (
+        'LOCALAPPDATA' if os.name == 'nt' else 'XDG_CONFIG_HOME')
+    with temporary_environment(config_path_variable, fake_config_dir):
+        yield fake_config_dir
+
+
 @contextlib.contextmanager
 def temporary_environment(name, value):
     NOT_SET = object()
@@ -0,0 +1,112 @@
+import os
+import shutil
+import textwrap
+import threading
+
+from peru.async_helpers import run_task
+import peru.cache
+from peru import remote_cache
+
+import shared
+from shared import run_peru_command, assert_contents
+
+PERU_YAML = '''\
+    cp module foo:
+        path: {}
+
+    rule sub:
+        export: a
+
+    imports:
+        foo: foo/
+        foo|sub: sub/
+    '''
+
+
+class RemoteCacheTest(shared.PeruTest):
+    def setUp(self):
+        self.module_dir = shared.create_dir({'a/b': 'b', 'c': 'c'})
+        self.remote_dir = shared.create_dir()
+
+    def make_project(self):
+        project_dir = shared.create_dir()
+        with open(os.path.join(project_dir, 'peru.yaml'), 'w') as f:
+            f.write(textwrap.dedent(PERU_YAML.format(self.module_dir)))
+        return project_dir
+
+    def sync(self, project_dir, location):
+        return run_peru_command(['sync', '-v'], project_dir,
+                                env={'PERU_REMOTE_CACHE': location})
+
+    def assert_synced(self, project_dir):
+        assert_contents(
+            project_dir, {
+                'foo/a/b': 'b',
+                'foo/c': 'c',
+                'sub/b': 'b',
+            },
+            excludes=['.peru', 'peru.yaml'])
+
+    def check_shared_results(self, location):
+        first = self.make_project()
+        output = self.sync(first, location)
+        self.assertIn('remote 0/2', output)
+        self.assert_synced(first)
+        # A second project with a cache of its own gets everything from the
+        # remote cache, without fetching. The module's source is gone, so a
+        # fetch would fail.
+        shutil.rmtree(self.module_dir)
+        second = self.make_project()
+        output = self.sync(second, location)
+        self.assertIn('remote 2/2', output)
+        self.assert_synced(second)
+
+    def test_directory_backend(self):
+        self.check_shared_results(self.remote_dir)
+        self.assertEqual(2, len(os.listdir(
+            os.path.join(self.remote_dir, 'keyval'))))
+
+    def test_http_backend(self):
+        server = remote_cache.make_server(self.remote_dir)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            host, port = server.server_address[:2]
+            self.check_shared_results('http://{}:{}/'.format(host, port))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_unreachable_server(self):
+        project = self.make_project()
+        output = self.sync(project, 'http://127.0.0.1:1/')
+        self.assertIn('Remote cache disabled after an error', output)
+        self.assert_synced(project)
+
+    def test_bad_pack(self):
+        first = self.make_project()
+        self.sync(first, self.remote_dir)
+        packs_dir = os.path.join(self.remote_dir, 'packs')
+        for name in os.listdir(packs_dir):
+            with open(os.path.join(packs_dir, name), 'wb') as f:
+                f.write(b'junk')
+        # The second project falls back to fetching.
+        second = self.make_project()
+        output = self.sync(second, self.remote_dir)
+        self.assertIn('Remote cache disabled after an error', output)
+        self.assert_synced(second)
+
+    def test_pack_round_trip(self):
+        content = {'a': 'a', 'b/c': 'c'}
+        source = shared.create_dir(content)
+        cache = run_task(peru.cache.Cache(shared.create_dir()))
+        tree = run_task(cache.import_tree(source))
+        pack = run_task(cache.export_pack(tree))
+        other = run_task(peru.cache.Cache(shared.create_dir()))
+        run_task(other.import_pack(pack, tree))
+        dest = shared.create_dir()
+        run_task(other.export_tree(tree, dest))
+        assert_contents(dest, content)
+        with self.assertRaises(peru.cache.GitError):
+            run_task(other.import_pack(pack, '0' * 40))
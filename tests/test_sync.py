@@ -2,6 +2,8 @@ import contextlib
 import io
 import json
 import os
+import shutil
+import subprocess
 import sys
 import textwrap
 
@@ -300,6 +302,40 @@ class SyncTest(shared.PeruTest):
             ''', dir_b)
         self.do_integration_test(['sync'], {'a_via_b/afile': 'stuff'})
 
+    def test_peru_file_only_parsed_when_needed(self):
+        dir_b = shared.create_dir({
+            'peru.yaml': 'imports: a: b',
+            'bfile': 'bbb',
+        })
+        self.write_yaml(
+            '''\
+            imports:
+                b: b/
+
+            cp module b:
+                path: {}
+                recursive: false
+            ''', dir_b)
+        # A non-recursive module's peru file isn't parsed, so it doesn't
+        # matter that it's broken.
+        self.do_integration_test(['sync'], {
+            'b/peru.yaml': 'imports: a: b',
+            'b/bfile': 'bbb'
+        })
+        # But referring to a module inside it means parsing it.
+        self.write_yaml(
+            '''\
+            imports:
+                b.a: a/
+
+            cp module b:
+                path: {}
+                recursive: false
+            ''', dir_b)
+        with self.assertRaises(peru.error.PrintableError) as cm:
+            run_peru_command(['sync'], self.test_dir)
+        self.assertIn('YAML parser error', cm.exception.message)
+
     def test_module_rules(self):
         module_dir = shared.create_dir({'a/b': '', 'c/d': ''})
         yaml = '''\
@@ -562,6 +598,124 @@ class SyncTest(shared.PeruTest):
         output = self.do_integration_test(['sync'], {'foo': 'bar'})
         self.assertIn('WARNING unused overrides', output)
 
+    def test_dests(self):
+        module_dir = shared.create_dir({'foo': 'bar'})
+        self.write_yaml(
+            '''\
+            cp module foo:
+                path: {}
+
+            imports:
+                foo: subdir
+            ''', module_dir)
+        debug_dir = shared.create_dir()
+        release_dir = os.path.join(self.test_dir, 'build', 'release')
+        run_peru_command(['dest', 'add', 'debug', debug_dir], self.test_dir)
+        # Relative paths are interpreted from the current dir, and listed
+        # as absolute paths.
+        other_dir = os.path.join(self.test_dir, 'other')
+        os.makedirs(other_dir)
+        run_peru_command(['dest', 'add', 'release', '../build/release'],
+                         other_dir)
+        output = run_peru_command(['dest', '--json'], self.test_dir)
+        self.assertEqual({
+            'debug': debug_dir,
+            'release': release_dir
+        }, json.loads(output))
+        # Sync to one destination, without touching the project.
+        self.do_integration_test(['sync', '--dest', 'debug'], {})
+        assert_contents(debug_dir, {'subdir/foo': 'bar'})
+        # Sync to all of them, and then to the project as usual.
+        self.do_integration_test(['sync', '--all-dests'],
+                                 {'build/release/subdir/foo': 'bar'})
+        assert_contents(debug_dir, {'subdir/foo': 'bar'})
+        self.do_integration_test(['sync'], {
+            'subdir/foo': 'bar',
+            'build/release/subdir/foo': 'bar'
+        })
+        # Each destination remembers its own last imports, so changing the
+        # imports updates all of them cleanly.
+        self.write_yaml(
+            '''\
+            cp module foo:
+                path: {}
+
+            imports:
+                foo: newdir
+            ''', module_dir)
+        self.do_integration_test(['sync', '--all-dests'], {
+            'subdir/foo': 'bar',
+            'build/release/newdir/foo': 'bar'
+        })
+        assert_contents(debug_dir, {'newdir/foo': 'bar'})
+        # Errors in one destination say which one it was.
+        shared.write_files(debug_dir, {'newdir/foo': 'dirty'})
+        with raises_gathered(peru.cache.DirtyWorkingCopyError) as cm:
+            run_peru_command(['sync', '--all-dests'], self.test_dir)
+        self.assertIn(debug_dir, cm.exception.message)
+        # Clean one destination, then delete it.
+        run_peru_command(['clean', '--dest', 'debug', '--force'],
+                         self.test_dir)
+        assert_contents(debug_dir, {})
+        run_peru_command(['dest', 'delete', 'debug'], self.test_dir)
+        output = run_peru_command(['dest'], self.test_dir)
+        self.assertEqual('release: {}\n'.format(
+            os.path.join('build', 'release')), output)
+        with self.assertRaises(peru.error.PrintableError):
+            run_peru_command(['sync', '--dest', 'debug'], self.test_dir)
+
+    def test_sparse_sync(self):
+        foo_dir = shared.create_dir({'foo': 'a'})
+        bar_dir = shared.create_dir({'bar': 'a'})
+        missing_dir = os.path.join(bar_dir, 'missing')
+        self.write_yaml(
+            '''\
+            cp module foo:
+                path: {}
+
+            cp module bar:
+                path: {}
+
+            imports:
+                foo: foodir
+                bar: lib/bar
+            ''', foo_dir, missing_dir)
+        # Only the selected module gets fetched, so bar's broken path doesn't
+        # matter here.
+        self.do_integration_test(['sync', 'foo'], {'foodir/foo': 'a'})
+        self.write_yaml(
+            '''\
+            cp module foo:
+                path: {}
+
+            cp module bar:
+                path: {}
+
+            imports:
+                foo: foodir
+                bar: lib/bar
+            ''', foo_dir, bar_dir)
+        self.do_integration_test(['sync'], {
+            'foodir/foo': 'a',
+            'lib/bar/bar': 'a'
+        })
+        # Selecting by path pattern updates bar and leaves foo as it was.
+        shared.write_files(foo_dir, {'foo': 'b'})
+        shared.write_files(bar_dir, {'bar': 'b'})
+        self.do_integration_test(['sync', '--no-cache', 'lib/*'], {
+            'foodir/foo': 'a',
+            'lib/bar/bar': 'b'
+        })
+        # A path inside an import's directory selects that import.
+        self.do_integration_test(['sync', '--no-cache', 'foodir/foo'], {
+            'foodir/foo': 'b',
+            'lib/bar/bar': 'b'
+        })
+        with self.assertRaises(peru.error.PrintableError):
+            run_peru_command(['sync', 'nonexistent'], self.test_dir)
+        # Clean removes everything, whatever was synced sparsely.
+        self.do_integration_test(['clean'], {})
+
     def test_override_after_regular_sync(self):
         module_dir = shared.create_dir({'foo': 'bar'})
         self.write_yaml(
@@ -786,6 +940,192 @@ class SyncTest(shared.PeruTest):
         version_output = run_peru_command(["--version"], self.test_dir)
         self.assertEqual(peru.main.get_version(), version_output.strip())
 
+    def test_version_startup_imports(self):
+        # `peru --version` and help shouldn't load any of the machinery that
+        # real commands need. Run it in a fresh interpreter with -X importtime
+        # to see everything that gets imported.
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(PERU_MODULE_ROOT)
+        for args in (['--version'], ['help', 'sync']):
+            result = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-m', 'peru'] + args,
+                cwd=self.test_dir,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                check=True)
+            imported = set(
+                line.split('|')[-1].strip()
+                for line in result.stderr.splitlines()
+                if line.startswith('import time:'))
+            self.assertIn('peru.main', imported)
+            for heavy in ('asyncio', 'yaml', 'peru.async_helpers',
+                          'peru.cache', 'peru.plugin', 'peru.runtime'):
+                self.assertNotIn(heavy, imported, args)
+
+    def test_trace_file(self):
+        module_dir = shared.create_dir({'a': 'a', 'b': 'b'})
+        self.write_yaml(
+            '''\
+            cp module foo:
+                path: {}
+                pick: a
+
+            imports:
+                foo: ./
+            ''', module_dir)
+        trace_file = os.path.join(shared.create_dir(), 'trace.json')
+        self.do_integration_test(['--trace-file', trace_file, 'sync'],
+                                 {'a': 'a'})
+        with open(trace_file) as f:
+            events = json.load(f)['traceEvents']
+        spans = [event for event in events if event['ph'] == 'X']
+        names = set(span['name'] for span in spans)
+        for name in ('sync', 'parse', 'target', 'plugin job',
+                     'plugin job wait', 'plugin job run', 'import tree',
+                     'rule pick', 'merge imports', 'export', 'keyval lookup',
+                     'compute key'):
+            self.assertIn(name, names)
+        for span in spans:
+            self.assertGreaterEqual(span['dur'], 0)
+        [job] = [span for span in spans if span['name'] == 'plugin job']
+        self.assertEqual({'type': 'cp', 'command': 'sync'}, job['args'])
+
+    def test_progress_file(self):
+        module_dir = shared.create_dir({'a': 'a'})
+        self.write_yaml(
+            '''\
+            cp module foo:
+                path: {}
+
+            empty module bar:
+
+            imports:
+                foo: ./
+                bar: ./
+            ''', module_dir)
+        progress_file = os.path.join(shared.create_dir(), 'progress.json')
+
+        def sync_events():
+            run_peru_command(['--progress-file', progress_file, 'sync'],
+                             self.test_dir)
+            with open(progress_file) as f:
+                return [json.loads(line) for line in f]
+
+        events = sync_events()
+        self.assertEqual('started', events[0]['event'])
+        self.assertEqual('sync', events[0]['command'])
+        self.assertEqual(('finished', True, None),
+                         (events[-1]['event'], events[-1]['ok'],
+                          events[-1]['error']))
+        self.assertEqual({'hits': 0, 'misses': 2},
+                         events[-1]['cache']['modules'])
+        modules = {event['module']: event for event in events
+                   if event['event'] == 'module_finished'}
+        self.assertEqual('miss', modules['foo']['cache'])
+        self.assertEqual('cp', modules['foo']['type'])
+        self.assertEqual(1, modules['foo']['bytes'])
+        [job] = [event for event in events if event['event'] == 'job_finished'
+                 and event['module'] == 'foo']
+        self.assertEqual(('cp', 1, True),
+                         (job['type'], job['attempts'], job['ok']))
+        self.assertGreaterEqual(job['queue_wait'], 0)
+        tree = modules['foo']['tree']
+        # The second time, everything comes from cache.
+        events = sync_events()
+        modules = {event['module']: event for event in events
+                   if event['event'] == 'module_finished'}
+        self.assertEqual('hit', modules['foo']['cache'])
+        self.assertEqual(tree, modules['foo']['tree'])
+        self.assertEqual({'hits': 2, 'misses': 0},
+                         events[-1]['cache']['modules'])
+        self.assertNotIn('job_started', [event['event'] for event in events])
+
+    def test_module_imported_more_than_once(self):
+        module_dir = shared.create_dir({'a/b': 'b', 'c': 'c'})
+        self.write_yaml(
+            '''\
+            cp module foo:
+                path: {}
+
+            rule r:
+                export: a
+
+            rule s:
+                pick: c
+
+            imports:
+                foo: x/
+                foo|r: y/
+                foo|s: z/
+            ''', module_dir)
+        progress_file = os.path.join(shared.create_dir(), 'progress.json')
+        output = run_peru_command(
+            ['--progress-file', progress_file, 'sync', '-v'], self.test_dir)
+        # One fetch of foo, and one look for its peru file, no matter how
+        # many targets are waiting on them.
+        self.assertIn(
+            'cache hits: modules 0/1, rules 0/2, merges 0/1, peru files 0/1',
+            output)
+        with open(progress_file) as f:
+            events = [json.loads(line) for line in f]
+        [finished] = [event for event in events
+                      if event['event'] == 'module_finished']
+        self.assertEqual('miss', finished['cache'])
+        self.assertEqual(1, [event['event'] for event in events
+                             ].count('module_started'))
+
+    def test_cache_stats_summary(self):
+        module_dir = shared.create_dir({'a/b': 'b', 'c': 'c'})
+        self.write_yaml(
+            '''\
+            cp module foo:
+                path: {}
+                recursive: false
+
+            rule a:
+                export: a
+
+            imports:
+                foo|a: ./
+                foo: sub/
+            ''', module_dir)
+        output = run_peru_command(['sync', '-v'], self.test_dir)
+        # Both targets use foo, but it's only looked up once.
+        self.assertIn('cache hits: modules 0/1, rules 0/1, merges 0/1\n',
+                      output)
+        output = run_peru_command(['sync', '-v'], self.test_dir)
+        self.assertIn('cache hits: modules 1/1, rules 1/1, merges 1/1\n',
+                      output)
+
+    def test_cache_layers(self):
+        module_dir = shared.create_dir({'a': 'a'})
+        self.write_yaml(
+            '''\
+            cp module foo:
+                path: {}
+
+            imports:
+                foo: ./
+            ''', module_dir)
+        lower_cache = shared.create_dir()
+        run_peru_command(['sync'], self.test_dir,
+                         env={'PERU_CACHE_DIR': lower_cache})
+        lower_contents = shared.read_dir(lower_cache)
+        # A project with an empty cache on top of that one doesn't need to
+        # fetch, and doesn't write to the lower cache.
+        shutil.rmtree(module_dir)
+        project_dir = shared.create_dir()
+        shutil.copy(os.path.join(self.test_dir, 'peru.yaml'), project_dir)
+        run_peru_command(['sync'], project_dir, env={
+            'PERU_CACHE_DIR': shared.create_dir(),
+            'PERU_CACHE_LAYERS': lower_cache,
+        })
+        assert_contents(project_dir, {'a': 'a'},
+                        excludes=['.peru', 'peru.yaml'])
+        self.assertEqual(lower_contents, shared.read_dir(lower_cache))
+
     def test_duplicate_keys_warning(self):
         self.write_yaml('''\
             git module foo:
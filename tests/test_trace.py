@@ -0,0 +1,49 @@
+import asyncio
+
+from peru.async_helpers import run_task
+from peru import trace
+
+import shared
+
+
+class TraceTest(shared.PeruTest):
+    def tearDown(self):
+        trace.stop()
+
+    def test_no_tracer(self):
+        with trace.span('foo', x=1) as span:
+            span.set(y=2)
+        self.assertIsNone(trace.stop())
+
+    def test_concurrent_tasks_get_separate_lanes(self):
+        tracer = trace.start()
+
+        async def job(name):
+            with trace.span(name):
+                with trace.span(name + ' inner'):
+                    await asyncio.sleep(0)
+
+        async def main():
+            with trace.span('main'):
+                await asyncio.gather(job('a'), job('b'))
+            # Every lane is free again, so a new task reuses the lowest one.
+            await asyncio.ensure_future(job('c'))
+
+        with trace.span('outside'):
+            run_task(main())
+        self.assertIs(tracer, trace.stop())
+        lanes = {event['name']: event['tid'] for event in tracer.events}
+        self.assertEqual(0, lanes['outside'])
+        self.assertEqual(lanes['a'], lanes['a inner'])
+        self.assertEqual(lanes['b'], lanes['b inner'])
+        self.assertEqual(
+            3, len(set([lanes['main'], lanes['a'], lanes['b']])))
+        self.assertEqual(lanes['main'], lanes['c'])
+
+    def test_errors_are_recorded(self):
+        tracer = trace.start()
+        with self.assertRaises(ValueError):
+            with trace.span('foo'):
+                raise ValueError()
+        [event] = tracer.events
+        self.assertEqual({'error': 'ValueError'}, event['args'])